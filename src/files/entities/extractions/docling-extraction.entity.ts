@@ -33,20 +33,52 @@ export class DoclingExtraction extends Extraction {
   @Property()
   chunksStorageId?: string;
 
+  @Property()
+  chunksIndexStorageId?: string; // Byte ranges of the chunks in the text, pages, headings and token counts
+
+  @Property()
+  tablesStorageId?: string; // Manifest of the tables with their captions, pages and byte ranges in the tables CSV
+
+  @Property()
+  tablesCsvStorageId?: string; // CSV blocks of the tables, each block decodes on its own
+
+  @Property()
+  figuresStorageId?: string; // Manifest of the figures with their captions, pages and annotations
+
+  @Property()
+  contentEncoding?: string; // Content encoding of the artifacts, e.g. gzip
+
+  @Property()
+  ocrPages?: number[]; // Pages routed through OCR, set by the extraction worker for PDFs
+
+  @Property()
+  embeddingsStorageId?: string; // Chunk vectors, one little-endian row per chunk, without content encoding
+
+  @Property()
+  embeddingModel?: string;
+
+  @Property()
+  embeddingDimensions?: number;
+
+  @Property()
+  embeddingDtype?: 'float32' | 'float16';
+
   constructor({
     documentStorageId,
     textStorageId,
     chunksStorageId,
+    contentEncoding,
     ...rest
   }: DoclingExtractionInput) {
     super(rest);
     this.documentStorageId = documentStorageId;
     this.textStorageId = textStorageId;
     this.chunksStorageId = chunksStorageId;
+    this.contentEncoding = contentEncoding;
   }
 }
 
 export type DoclingExtractionInput = Pick<
   DoclingExtraction,
-  'jobId' | 'documentStorageId' | 'textStorageId' | 'chunksStorageId'
+  'jobId' | 'documentStorageId' | 'textStorageId' | 'chunksStorageId' | 'contentEncoding'
 >;
@@ -27,6 +27,9 @@ export class UnstructuredAPIExtraction extends Extraction {
   @Property()
   storageId?: string;
 
+  @Property()
+  chunksIndexStorageId?: string; // Byte ranges of the chunk elements in the elements JSON
+
   constructor({ storageId, ...rest }: UnstructuredAPIExtractionInput) {
     super(rest);
     this.storageId = storageId;
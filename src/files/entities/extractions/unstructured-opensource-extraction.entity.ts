@@ -27,6 +27,9 @@ export class UnstructuredOpensourceExtraction extends Extraction {
   @Property()
   storageId?: string;
 
+  @Property()
+  chunksIndexStorageId?: string; // Byte ranges of the chunk elements in the elements JSON
+
   constructor({ storageId, ...rest }: UnstructuredOpensourceExtractionInput) {
     super(rest);
     this.storageId = storageId;
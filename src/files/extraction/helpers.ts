@@ -14,6 +14,9 @@
  * limitations under the License.
  */
 
+import { promisify } from 'node:util';
+import { gunzip as gunzipCallback } from 'node:zlib';
+
 import { Loaded } from '@mikro-orm/core';
 import mime from 'mime';
 import { recursiveSplitString } from 'bee-agent-framework/internals/helpers/string';
@@ -35,6 +38,8 @@ import { EXTRACTION_BACKEND, S3_BUCKET_FILE_STORAGE } from '@/config';
 import { ORM } from '@/database';
 import { QueueName } from '@/jobs/constants';
 
+const gunzip = promisify(gunzipCallback);
+
 export const withAbort = <A, B>(value: ibm.Request<A, B>, signal?: AbortSignal) => {
   const handler = () => value.abort();
   signal?.addEventListener('abort', handler);
@@ -210,24 +215,60 @@ export async function scheduleExtraction(
 type AvailableKeys<T> = Exclude<T extends T ? keyof T : never, keyof unknown[]>;
 
 const keyByProvider = {
-  [ExtractionBackend.DOCLING]: ['documentStorageId', 'chunksStorageId', 'textStorageId'],
+  [ExtractionBackend.DOCLING]: [
+    'documentStorageId',
+    'chunksStorageId',
+    'textStorageId',
+    'chunksIndexStorageId',
+    'embeddingsStorageId',
+    'tablesStorageId',
+    'tablesCsvStorageId',
+    'figuresStorageId'
+  ],
   [ExtractionBackend.WDU]: ['storageId'],
-  [ExtractionBackend.UNSTRUCTURED_OPENSOURCE]: ['storageId'],
-  [ExtractionBackend.UNSTRUCTURED_API]: ['storageId']
+  [ExtractionBackend.UNSTRUCTURED_OPENSOURCE]: ['storageId', 'chunksIndexStorageId'],
+  [ExtractionBackend.UNSTRUCTURED_API]: ['storageId', 'chunksIndexStorageId']
 } as const satisfies Record<ExtractionBackend, AvailableKeys<typeof File.prototype.extraction>[]>;
 
+// Shard results checkpointed by the python worker while converting large documents,
+// left behind by extractions that never completed
+async function removeDoclingCheckpoints(storageId: string, signal?: AbortSignal) {
+  const Prefix = `docling/${storageId}/checkpoints/`;
+  let ContinuationToken: string | undefined;
+  do {
+    const page = await withAbort(
+      s3Client.listObjectsV2({ Bucket: S3_BUCKET_FILE_STORAGE, Prefix, ContinuationToken }),
+      signal
+    );
+    const objects = (page.Contents ?? []).flatMap(({ Key }) => (Key ? [{ Key }] : []));
+    if (objects.length > 0) {
+      await withAbort(
+        s3Client.deleteObjects({
+          Bucket: S3_BUCKET_FILE_STORAGE,
+          Delete: { Objects: objects, Quiet: true }
+        }),
+        signal
+      );
+    }
+    ContinuationToken = page.NextContinuationToken;
+  } while (ContinuationToken);
+}
+
 export async function removeExtraction(file: Loaded<File>, signal?: AbortSignal) {
   const extraction = file.extraction;
   if (!extraction) throw new Error('No extraction to remove');
 
-  await Promise.all(
-    keyByProvider[extraction.backend].map(async (property) => {
+  await Promise.all([
+    ...keyByProvider[extraction.backend].map(async (property) => {
       const Key = extraction[property as keyof typeof extraction];
       if (Key) {
         await withAbort(s3Client.deleteObject({ Bucket: S3_BUCKET_FILE_STORAGE, Key }), signal);
       }
-    })
-  );
+    }),
+    ...(extraction.backend === ExtractionBackend.DOCLING && file.storageId
+      ? [removeDoclingCheckpoints(file.storageId, signal)]
+      : [])
+  ]);
 
   file.extraction = undefined;
   await ORM.em.flush();
@@ -252,7 +293,7 @@ export async function getExtractedText(file: Loaded<File>, signal?: AbortSignal)
     }
     case ExtractionBackend.DOCLING: {
       if (!extraction.textStorageId) throw new Error('Extraction missing');
-      return readTextFile(extraction.textStorageId, signal);
+      return readTextFile(extraction.textStorageId, signal, extraction.contentEncoding);
     }
     case ExtractionBackend.UNSTRUCTURED_OPENSOURCE:
     case ExtractionBackend.UNSTRUCTURED_API: {
@@ -280,8 +321,18 @@ export async function getExtractedChunks(file: Loaded<File>, signal?: AbortSigna
         });
         return Array.from(splitter);
       }
-      const chunks = JSON.parse(
-        await readTextFile(extraction.chunksStorageId, signal)
+      const data = await readTextFile(
+        extraction.chunksStorageId,
+        signal,
+        extraction.contentEncoding
+      );
+      const chunks = (
+        extraction.chunksStorageId.endsWith('.ndjson')
+          ? data
+              .split('\n')
+              .filter((line) => line)
+              .map((line) => JSON.parse(line))
+          : JSON.parse(data)
       ) as DoclingChunksExtraction;
       return chunks.map((c) => c.text);
     }
@@ -307,7 +358,7 @@ export async function getExtractedChunks(file: Loaded<File>, signal?: AbortSigna
   }
 }
 
-async function readTextFile(key: string, signal?: AbortSignal) {
+async function readTextFile(key: string, signal?: AbortSignal, contentEncoding?: string) {
   const object = await withAbort(
     s3Client.getObject({
       Bucket: S3_BUCKET_FILE_STORAGE,
@@ -317,6 +368,9 @@ async function readTextFile(key: string, signal?: AbortSignal) {
   );
   const body = object.Body;
   if (!body) throw new Error('Invalid Body of a file');
+  if (contentEncoding === 'gzip') {
+    return (await gunzip(body as Buffer)).toString('utf-8');
+  }
   const data = body.toString('utf-8');
   return data;
 }
@@ -14,7 +14,7 @@
  * limitations under the License.
  */
 
-export type DoclingChunksExtraction = { text: string }[];
+export type DoclingChunksExtraction = { text: string; pages?: number[]; headings?: string[] }[];
 
 type UnstructuredExtractionElement = { type: string; text: string };
 export type UnstructuredExtractionDocument = UnstructuredExtractionElement[];
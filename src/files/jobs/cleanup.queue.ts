@@ -53,26 +53,27 @@ async function jobHandler(_: Job) {
           }
         );
         try {
-          if (file.storageId !== '') {
-            await s3Client
-              .deleteObject({ Bucket: S3_BUCKET_FILE_STORAGE, Key: file.storageId })
-              .promise();
-            file.storageId = '';
-            await ORM.em.flush();
-          }
-
+          // Extraction checkpoints are keyed by the storage id, remove the extraction before the file
           if (file.extraction) {
             try {
               await removeExtraction(file);
             } catch (err) {
               if (isS3Error(err) && (err as AWSError).code === 'NotFound') {
-                // Resource has been already removed, likely in the block above
+                // Resource has been already removed
               } else {
                 throw err;
               }
             }
           }
 
+          if (file.storageId !== '') {
+            await s3Client
+              .deleteObject({ Bucket: S3_BUCKET_FILE_STORAGE, Key: file.storageId })
+              .promise();
+            file.storageId = '';
+            await ORM.em.flush();
+          }
+
           const vectoreStoreFiles = await ORM.em.getRepository(VectorStoreFile).find({ file });
           if (vectoreStoreFiles.length > 0) await deleteVectorStoreFiles(vectoreStoreFiles);
 
@@ -0,0 +1,332 @@
+# Copyright 2024 IBM Corp.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Offline benchmark of the extraction worker.
+
+Jobs run through the worker's job processor against an in-process S3 server and an in-memory database,
+Redis is not needed since jobs are handed to the processor directly.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import platform
+import resource
+import sys
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+
+from bson import ObjectId
+
+from corpus import available_kinds, checksum, generate_corpus
+from fake_mongo import Database
+from fake_s3 import FakeS3
+
+APP_DIR = Path(__file__).resolve().parent.parent / "python"
+
+BUCKET = "benchmark"
+
+STORAGE_DIR = "files"
+
+
+@dataclass
+class BenchmarkJob:
+    id: str
+    data: dict
+
+
+def percentile(values: list[float], percent: float):
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * percent / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+def distribution(values: list[float]):
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else None,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None
+    }
+
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    unit = 1 if sys.platform == "darwin" else 1024
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / 2 ** 20,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit / 2 ** 20
+    }
+
+
+def configure_environment(s3_url: str, args):
+    """
+    Point the worker configuration at the stand-ins, this has to happen before the worker modules are imported.
+    """
+    os.environ.update({
+        "RUN_BULLMQ_WORKERS": "files-extraction-python",
+        "REDIS_URL": "redis://127.0.0.1:6379/0",
+        "MONGODB_URL": "mongodb://127.0.0.1:27017",
+        "MONGODB_DATABASE_NAME": "benchmark",
+        "S3_ENDPOINT": s3_url,
+        "S3_BUCKET_FILE_STORAGE": BUCKET,
+        "S3_ACCESS_KEY_ID": "benchmark",
+        "S3_SECRET_ACCESS_KEY": "benchmark",
+        "OTEL_SDK_DISABLED": "true",
+        "EXTRACTION_CACHE_ENABLED": str(args.cache).lower(),
+        "LOG_LEVEL": args.log_level
+    })
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    for setting in args.set:
+        name, _, value = setting.partition("=")
+        os.environ[name.upper()] = value
+    sys.path.insert(0, str(APP_DIR))
+
+
+def install_database():
+    import database
+
+    database.database = Database()
+    return database.database
+
+
+async def seed(s3_server: FakeS3, db: Database, samples, backend: str):
+    from fake_s3 import StoredObject
+
+    files = []
+    for sample in samples:
+        file_id = ObjectId()
+        storage_id = f"{STORAGE_DIR}/{file_id}"
+        s3_server.objects[storage_id] = StoredObject(
+            sample.content, {"Content-Type": sample.mime_type})
+        file = {
+            "_id": file_id,
+            "filename": sample.filename,
+            "bytes": len(sample.content),
+            "contentHash": hashlib.sha256(sample.content).hexdigest(),
+            "mimeType": sample.mime_type,
+            "storageId": storage_id,
+            "project": ObjectId(),
+            "extraction": {"backend": backend, "jobId": str(file_id)}
+        }
+        await db.get_collection("file").insert_one(file)
+        files.append((file, sample))
+    return files
+
+
+async def run_benchmark(args):
+    s3_server = FakeS3(BUCKET)
+    await s3_server.start()
+    configure_environment(s3_server.url, args)
+
+    from logger import setup_logging
+    setup_logging()
+
+    db = install_database()
+
+    import stages
+    stage_timings: dict[tuple[str, str], list[float]] = {}
+    stages.observers.append(lambda name, backend, seconds: stage_timings.setdefault(
+        (name, backend or "all"), []).append(seconds))
+
+    from storage import start_storage, stop_storage
+    from workers import lifecycle_hooks
+    from extraction.extraction import EXTRACTION_QUEUE_NAME, extractionWorker, processExtraction
+
+    kinds = args.kinds or available_kinds()
+    samples = generate_corpus(kinds, args.count, args.pages, args.seed)
+    report = {
+        "createdAt": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "corpus": {"kinds": kinds, "count": args.count, "pages": args.pages, "seed": args.seed,
+                   "checksum": checksum(samples), "bytes": sum(len(sample.content) for sample in samples)},
+        "settings": args.set,
+        "concurrency": extractionWorker.opts["concurrency"],
+        "backends": {}
+    }
+
+    await start_storage()
+    on_startup, on_shutdown = lifecycle_hooks[EXTRACTION_QUEUE_NAME]
+    start = time.perf_counter()
+    if on_startup is not None:
+        await on_startup()
+    report["startupSeconds"] = time.perf_counter() - start
+
+    try:
+        for backend in args.backends:
+            stage_timings.clear()
+            results = []
+            for iteration in range(args.warmup + args.iterations):
+                files = await seed(s3_server, db, samples, backend)
+                semaphore = asyncio.Semaphore(extractionWorker.opts["concurrency"])
+
+                async def run_job(file, sample):
+                    async with semaphore:
+                        job_start = time.perf_counter()
+                        error = None
+                        try:
+                            await processExtraction(BenchmarkJob(str(file["_id"]), {"fileId": file["_id"]}), None)
+                        except Exception as e:
+                            error = repr(e)
+                        return {"kind": sample.kind, "bytes": len(sample.content), "pages": sample.pages,
+                                "seconds": time.perf_counter() - job_start, "error": error}
+
+                iteration_start = time.perf_counter()
+                jobs = await asyncio.gather(*[run_job(file, sample) for file, sample in files])
+                elapsed = time.perf_counter() - iteration_start
+                if iteration < args.warmup:
+                    stage_timings.clear()
+                    continue
+                results.append((elapsed, jobs))
+
+            report["backends"][backend] = summarize(results, stage_timings)
+    finally:
+        if on_shutdown is not None:
+            await on_shutdown()
+        await stop_storage()
+        await s3_server.stop()
+
+    report["peakRssMb"] = peak_rss_mb()
+    return report
+
+
+def summarize(results, stage_timings):
+    jobs = [job for _, jobs in results for job in jobs]
+    succeeded = [job for job in jobs if job["error"] is None]
+    elapsed = sum(elapsed for elapsed, _ in results)
+    kinds = sorted({job["kind"] for job in jobs})
+    return {
+        "jobs": len(jobs),
+        "failed": len(jobs) - len(succeeded),
+        "errors": sorted({job["error"] for job in jobs if job["error"] is not None})[:10],
+        "seconds": elapsed,
+        "docsPerSecond": len(succeeded) / elapsed if elapsed > 0 else None,
+        "pagesPerSecond": sum(job["pages"] or 0 for job in succeeded) / elapsed if elapsed > 0 else None,
+        "latency": distribution([job["seconds"] for job in succeeded]),
+        "latencyByKind": {kind: distribution([job["seconds"] for job in succeeded if job["kind"] == kind]) for kind in kinds},
+        "stages": {name: distribution(values) for (name, _), values in sorted(stage_timings.items())}
+    }
+
+
+# Metrics compared against a baseline, with whether higher values are better
+COMPARED_METRICS = {
+    "docsPerSecond": True,
+    "latency.p50": False,
+    "latency.p95": False,
+    "latency.p99": False,
+}
+
+
+def metric(summary: dict, path: str):
+    value = summary
+    for part in path.split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+
+def compare(report: dict, baseline: dict, tolerance: float):
+    """
+    Return the regressions of the report beyond the relative tolerance of the baseline.
+    """
+    if baseline.get("corpus", {}).get("checksum") != report["corpus"]["checksum"]:
+        print("Warning: the baseline was measured on a different corpus", file=sys.stderr)
+    regressions = []
+    for backend, summary in report["backends"].items():
+        baseline_summary = baseline.get("backends", {}).get(backend)
+        if baseline_summary is None:
+            continue
+        for path, higher_is_better in COMPARED_METRICS.items():
+            current, previous = metric(summary, path), metric(baseline_summary, path)
+            if current is None or not previous:
+                continue
+            change = (current - previous) / previous
+            if (change < -tolerance) if higher_is_better else (change > tolerance):
+                regressions.append(
+                    f"{backend} {path}: {previous:.4f} -> {current:.4f} ({change:+.1%})")
+    return regressions
+
+
+def print_report(report: dict):
+    for backend, summary in report["backends"].items():
+        latency = summary["latency"]
+        print(f"{backend}: {summary['jobs']} jobs, {summary['failed']} failed, "
+              f"{summary['docsPerSecond'] or 0:.2f} docs/s, {summary['pagesPerSecond'] or 0:.2f} pages/s")
+        if latency["count"] > 0:
+            print(f"  latency p50 {latency['p50']:.3f}s p95 {latency['p95']:.3f}s p99 {latency['p99']:.3f}s")
+        for name, stage in summary["stages"].items():
+            print(f"  {name:<14} mean {stage['mean']:.3f}s p95 {stage['p95']:.3f}s (n={stage['count']})")
+        for error in summary["errors"]:
+            print(f"  error: {error}")
+    rss = report["peakRssMb"]
+    print(f"peak rss {rss['self']:.0f} MB, children {rss['children']:.0f} MB, startup {report['startupSeconds']:.2f}s")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", nargs="+", default=["docling"],
+                        help="extraction backends to benchmark")
+    parser.add_argument("--kinds", nargs="+", choices=["pdf", "scanned", "docx", "html"],
+                        help="document kinds of the corpus, defaults to all kinds that can be generated")
+    parser.add_argument("--count", type=int, default=5,
+                        help="documents of each kind")
+    parser.add_argument("--pages", type=int, nargs="+", default=[1, 5, 20],
+                        help="page counts of the generated PDFs, cycled through")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--iterations", type=int, default=1)
+    parser.add_argument("--warmup", type=int, default=1,
+                        help="iterations run before measuring")
+    parser.add_argument("--cache", action="store_true",
+                        help="keep the extraction cache enabled")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                        help="worker setting, e.g. --set docling_process_pool_size=2")
+    parser.add_argument("--log-level", default="warning")
+    parser.add_argument("--output", type=Path,
+                        help="write the report as JSON, e.g. to record a baseline")
+    parser.add_argument("--baseline", type=Path,
+                        help="compare against a previously written report")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="relative change tolerated before a metric counts as regressed")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    report = asyncio.run(run_benchmark(args))
+    print_report(report)
+    if args.output is not None:
+        args.output.write_text(json.dumps(report, indent=2))
+    if args.baseline is not None:
+        regressions = compare(report, json.loads(
+            args.baseline.read_text()), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+# Copyright 2024 IBM Corp.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+import zlib
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Callable, Optional
+
+WORDS = ("agent", "model", "thread", "message", "vector", "store", "file", "extraction", "document", "page",
+         "table", "figure", "chunk", "token", "project", "assistant", "tool", "run", "stream", "queue",
+         "worker", "storage", "latency", "throughput", "benchmark", "baseline", "memory", "process")
+
+PAGE_WIDTH = 612
+PAGE_HEIGHT = 792
+
+
+@dataclass
+class Sample:
+    filename: str
+    mime_type: str
+    content: bytes
+    kind: str
+    pages: Optional[int] = None
+
+
+def sentence(rng: random.Random, words: int = 12):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def paragraphs(rng: random.Random, count: int):
+    return [" ".join(sentence(rng) for _ in range(rng.randint(3, 6))) for _ in range(count)]
+
+
+def pdf_escape(text: str):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def build_pdf(page_contents: list[tuple[bytes, dict[str, bytes]]], fonts: bool) -> bytes:
+    """
+    Assemble a PDF from page content streams and the image XObjects they draw.
+    """
+    objects: list[bytes] = []
+
+    def add(body: bytes):
+        objects.append(body)
+        return len(objects)
+
+    catalog = add(b"")
+    pages = add(b"")
+    font = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>") if fonts else None
+    page_ids = []
+    for content, images in page_contents:
+        xobjects = b" ".join(
+            f"/{name} ".encode() + f"{add(image)} 0 R".encode() for name, image in images.items())
+        stream = add(b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream")
+        resources = b"<< "
+        if font is not None:
+            resources += b"/Font << /F1 %d 0 R >> " % font
+        if xobjects:
+            resources += b"/XObject << " + xobjects + b" >> "
+        resources += b">>"
+        page_ids.append(add(b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %d %d] /Resources " % (
+            pages, PAGE_WIDTH, PAGE_HEIGHT) + resources + b" /Contents %d 0 R >>" % stream))
+    objects[catalog - 1] = b"<< /Type /Catalog /Pages %d 0 R >>" % pages
+    objects[pages - 1] = b"<< /Type /Pages /Kids [" + b" ".join(
+        b"%d 0 R" % page_id for page_id in page_ids) + b"] /Count %d >>" % len(page_ids)
+
+    out = BytesIO()
+    out.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b"%010d 00000 n \n" % offset)
+    out.write(b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1, catalog, xref))
+    return out.getvalue()
+
+
+def text_page(rng: random.Random, title: str):
+    lines = [(18, title)]
+    for paragraph in paragraphs(rng, 4):
+        words = paragraph.split()
+        for start in range(0, len(words), 13):
+            lines.append((10, " ".join(words[start:start + 13])))
+        lines.append((10, ""))
+    content = bytearray(b"BT\n")
+    y = PAGE_HEIGHT - 72
+    for size, line in lines:
+        if y < 72:
+            break
+        content += f"/F1 {size} Tf 1 0 0 1 72 {y} Tm ({pdf_escape(line)}) Tj\n".encode()
+        y -= size + 6
+    content += b"ET"
+    return bytes(content)
+
+
+def text_pdf(rng: random.Random, index: int, pages: int):
+    return build_pdf([(text_page(rng, f"Document {index} section {page + 1}"), {}) for page in range(pages)], fonts=True)
+
+
+def scanned_pdf(rng: random.Random, index: int, pages: int):
+    """
+    Pages holding only a rendered image of text, without a text layer, as produced by scanners.
+    """
+    from PIL import Image, ImageDraw
+
+    page_contents = []
+    for page in range(pages):
+        image = Image.new("L", (PAGE_WIDTH * 2, PAGE_HEIGHT * 2), 255)
+        draw = ImageDraw.Draw(image)
+        y = 120
+        draw.text((120, y), f"Scanned document {index} page {page + 1}", fill=0)
+        for paragraph in paragraphs(rng, 3):
+            words = paragraph.split()
+            for start in range(0, len(words), 12):
+                y += 28
+                draw.text((120, y), " ".join(words[start:start + 12]), fill=0)
+            y += 28
+        encoded = BytesIO()
+        image.save(encoded, format="JPEG", quality=70)
+        jpeg = encoded.getvalue()
+        xobject = b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceGray " % image.size + \
+            b"/BitsPerComponent 8 /Filter /DCTDecode /Length %d >>\nstream\n" % len(jpeg) + jpeg + b"\nendstream"
+        content = b"q %d 0 0 %d 0 0 cm /Im1 Do Q" % (PAGE_WIDTH, PAGE_HEIGHT)
+        page_contents.append((content, {"Im1": xobject}))
+    return build_pdf(page_contents, fonts=False)
+
+
+def docx(rng: random.Random, index: int, sections: int):
+    from docx import Document
+
+    document = Document()
+    document.add_heading(f"Document {index}", level=0)
+    for section in range(sections):
+        document.add_heading(f"Section {section + 1}", level=1)
+        for paragraph in paragraphs(rng, 3):
+            document.add_paragraph(paragraph)
+        table = document.add_table(rows=4, cols=3)
+        for row in table.rows:
+            for cell in row.cells:
+                cell.text = rng.choice(WORDS)
+    out = BytesIO()
+    document.save(out)
+    return out.getvalue()
+
+
+def html(rng: random.Random, index: int, sections: int):
+    body = "".join(
+        f"<h2>Section {section + 1}</h2>" + "".join(f"<p>{paragraph}</p>" for paragraph in paragraphs(rng, 3)) +
+        "<table>" + "".join("<tr>" + "".join(f"<td>{rng.choice(WORDS)}</td>" for _ in range(3)) + "</tr>"
+                            for _ in range(4)) + "</table>"
+        for section in range(sections))
+    return f"<!DOCTYPE html><html><head><title>Document {index}</title></head><body><h1>Document {index}</h1>{body}</body></html>".encode()
+
+
+GENERATORS: dict[str, tuple[str, str, Callable[[random.Random, int, int], bytes]]] = {
+    "pdf": ("pdf", "application/pdf", text_pdf),
+    "scanned": ("pdf", "application/pdf", scanned_pdf),
+    "docx": ("docx", "application/vnd.openxmlformats-officedocument.wordprocessingml.document", docx),
+    "html": ("html", "text/html", html),
+}
+
+
+def available_kinds():
+    kinds = ["pdf", "html"]
+    try:
+        import PIL  # noqa: F401
+        kinds.append("scanned")
+    except ImportError:
+        pass
+    try:
+        import docx  # noqa: F401
+        kinds.append("docx")
+    except ImportError:
+        pass
+    return kinds
+
+
+def generate_corpus(kinds: list[str], count: int, pages: list[int], seed: int = 0) -> list[Sample]:
+    """
+    Generate count samples of each kind, cycling through the page counts. Every sample has distinct content.
+    """
+    rng = random.Random(seed)
+    samples = []
+    for kind in kinds:
+        extension, mime_type, generate = GENERATORS[kind]
+        for index in range(count):
+            page_count = pages[index % len(pages)]
+            content = generate(rng, index, page_count)
+            samples.append(Sample(filename=f"{kind}-{index}.{extension}", mime_type=mime_type, content=content, kind=kind,
+                                  pages=page_count if extension == "pdf" else None))
+    return samples
+
+
+def checksum(samples: list[Sample]):
+    return f"{zlib.crc32(b''.join(sample.content for sample in samples)):08x}"
@@ -0,0 +1,241 @@
+# Copyright 2024 IBM Corp.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+from dataclasses import dataclass
+
+from pymongo import DeleteOne, InsertOne, ReplaceOne, UpdateOne
+
+MISSING = object()
+
+
+def get_path(doc: dict, path: str):
+    value = doc
+    for part in path.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return MISSING
+        value = value[part]
+    return value
+
+
+def set_path(doc: dict, path: str, value):
+    *parents, last = path.split(".")
+    for part in parents:
+        doc = doc.setdefault(part, {})
+    doc[last] = value
+
+
+def unset_path(doc: dict, path: str):
+    *parents, last = path.split(".")
+    for part in parents:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(last, None)
+
+
+def matches_condition(value, condition) -> bool:
+    if isinstance(condition, dict) and any(key.startswith("$") for key in condition):
+        for operator, operand in condition.items():
+            if operator == "$in" and value not in operand:
+                return False
+            if operator == "$nin" and value in operand:
+                return False
+            if operator == "$ne" and value == operand:
+                return False
+            if operator == "$exists" and (value is not MISSING) != operand:
+                return False
+            if operator in ("$lt", "$lte", "$gt", "$gte") and (value is MISSING or value is None):
+                return False
+            if operator == "$lt" and not value < operand:
+                return False
+            if operator == "$lte" and not value <= operand:
+                return False
+            if operator == "$gt" and not value > operand:
+                return False
+            if operator == "$gte" and not value >= operand:
+                return False
+        return True
+    return (None if value is MISSING else value) == condition
+
+
+def matches(doc: dict, filter: dict) -> bool:
+    return all(matches_condition(get_path(doc, path), condition) for path, condition in filter.items())
+
+
+def apply_update(doc: dict, update: dict):
+    for operator, fields in update.items():
+        for path, value in fields.items():
+            if operator == "$set":
+                set_path(doc, path, copy.deepcopy(value))
+            elif operator == "$unset":
+                unset_path(doc, path)
+            elif operator == "$inc":
+                current = get_path(doc, path)
+                set_path(doc, path, (0 if current is MISSING else current) + value)
+            elif operator == "$setOnInsert":
+                pass
+            else:
+                raise NotImplementedError(f"Update operator {operator}")
+
+
+@dataclass
+class UpdateResult:
+    matched_count: int
+    modified_count: int
+    upserted_id: object = None
+
+
+@dataclass
+class DeleteResult:
+    deleted_count: int
+
+
+@dataclass
+class BulkWriteResult:
+    matched_count: int = 0
+    modified_count: int = 0
+    inserted_count: int = 0
+    deleted_count: int = 0
+    upserted_count: int = 0
+
+
+class Cursor:
+    def __init__(self, docs: list[dict]):
+        self.docs = docs
+
+    def sort(self, key, direction=1):
+        self.docs.sort(key=lambda doc: get_path(doc, key), reverse=direction < 0)
+        return self
+
+    def limit(self, count: int):
+        if count > 0:
+            self.docs = self.docs[:count]
+        return self
+
+    async def to_list(self, length=None):
+        return self.docs if length is None else self.docs[:length]
+
+    def __aiter__(self):
+        return self.iterate()
+
+    async def iterate(self):
+        for doc in self.docs:
+            yield doc
+
+
+class Collection:
+    """
+    In-memory collection implementing the subset of the async pymongo API used by the workers.
+    """
+
+    def __init__(self):
+        self.docs: dict = {}
+
+    def find_docs(self, filter: dict):
+        if set(filter.keys()) == {"_id"} and not isinstance(filter["_id"], dict):
+            doc = self.docs.get(filter["_id"])
+            return [] if doc is None else [doc]
+        return [doc for doc in self.docs.values() if matches(doc, filter)]
+
+    async def find_one(self, filter: dict, *args, **kwargs):
+        docs = self.find_docs(filter)
+        return copy.deepcopy(docs[0]) if len(docs) > 0 else None
+
+    def find(self, filter: dict = {}, *args, **kwargs):
+        return Cursor([copy.deepcopy(doc) for doc in self.find_docs(filter)])
+
+    async def count_documents(self, filter: dict):
+        return len(self.find_docs(filter))
+
+    async def insert_one(self, doc: dict):
+        self.docs[doc["_id"]] = copy.deepcopy(doc)
+
+    async def insert_many(self, docs: list[dict], ordered=True):
+        for doc in docs:
+            await self.insert_one(doc)
+
+    async def update_one(self, filter: dict, update: dict, upsert=False):
+        docs = self.find_docs(filter)
+        if len(docs) == 0:
+            if not upsert:
+                return UpdateResult(0, 0)
+            doc = {path: value for path, value in filter.items()
+                   if not isinstance(value, dict)}
+            apply_update(doc, {**update, "$set": {
+                **update.get("$setOnInsert", {}), **update.get("$set", {})}})
+            self.docs[doc["_id"]] = doc
+            return UpdateResult(0, 0, doc["_id"])
+        apply_update(docs[0], update)
+        return UpdateResult(1, 1)
+
+    async def update_many(self, filter: dict, update: dict):
+        docs = self.find_docs(filter)
+        for doc in docs:
+            apply_update(doc, update)
+        return UpdateResult(len(docs), len(docs))
+
+    async def replace_one(self, filter: dict, replacement: dict, upsert=False):
+        docs = self.find_docs(filter)
+        if len(docs) == 0 and not upsert:
+            return UpdateResult(0, 0)
+        doc = copy.deepcopy(replacement)
+        doc.setdefault("_id", docs[0]["_id"] if len(docs) > 0 else filter.get("_id"))
+        self.docs[doc["_id"]] = doc
+        return UpdateResult(len(docs), len(docs), None if len(docs) > 0 else doc["_id"])
+
+    async def delete_one(self, filter: dict):
+        docs = self.find_docs(filter)
+        if len(docs) == 0:
+            return DeleteResult(0)
+        del self.docs[docs[0]["_id"]]
+        return DeleteResult(1)
+
+    async def delete_many(self, filter: dict):
+        docs = self.find_docs(filter)
+        for doc in docs:
+            del self.docs[doc["_id"]]
+        return DeleteResult(len(docs))
+
+    async def bulk_write(self, requests: list, ordered=True):
+        result = BulkWriteResult()
+        for request in requests:
+            if isinstance(request, UpdateOne):
+                outcome = await self.update_one(request._filter, request._doc, upsert=bool(request._upsert))
+            elif isinstance(request, ReplaceOne):
+                outcome = await self.replace_one(request._filter, request._doc, upsert=bool(request._upsert))
+            elif isinstance(request, InsertOne):
+                await self.insert_one(request._doc)
+                result.inserted_count += 1
+                continue
+            elif isinstance(request, DeleteOne):
+                result.deleted_count += (await self.delete_one(request._filter)).deleted_count
+                continue
+            else:
+                raise NotImplementedError(f"Bulk operation {type(request).__name__}")
+            result.matched_count += outcome.matched_count
+            result.modified_count += outcome.modified_count
+            result.upserted_count += outcome.upserted_id is not None
+        return result
+
+
+class Database:
+    def __init__(self):
+        self.collections: dict[str, Collection] = {}
+
+    def get_collection(self, name: str) -> Collection:
+        return self.collections.setdefault(name, Collection())
+
+    def __getitem__(self, name: str) -> Collection:
+        return self.get_collection(name)
@@ -0,0 +1,221 @@
+# Copyright 2024 IBM Corp.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from urllib.parse import unquote
+from xml.sax.saxutils import escape
+
+from aiohttp import web
+
+
+@dataclass
+class StoredObject:
+    body: bytes
+    headers: dict[str, str]
+    modified: datetime = field(
+        default_factory=lambda: datetime.now(timezone.utc))
+
+    @property
+    def etag(self):
+        return f'"{hashlib.md5(self.body).hexdigest()}"'
+
+
+STORED_HEADERS = ("Content-Type", "Content-Encoding")
+
+
+def decode_aws_chunked(body: bytes) -> bytes:
+    """
+    Decode a streaming payload of the aws-chunked content encoding, dropping chunk signatures and trailers.
+    """
+    data = bytearray()
+    position = 0
+    while True:
+        end = body.index(b"\r\n", position)
+        size = int(body[position:end].split(b";")[0], 16)
+        if size == 0:
+            return bytes(data)
+        data += body[end + 2:end + 2 + size]
+        position = end + 2 + size + 2
+
+
+def error(status: int, code: str):
+    return web.Response(status=status, content_type="application/xml",
+                        text=f"<?xml version=\"1.0\" encoding=\"UTF-8\"?><Error><Code>{code}</Code></Error>")
+
+
+def xml(text: str):
+    return web.Response(content_type="application/xml", text=f"<?xml version=\"1.0\" encoding=\"UTF-8\"?>{text}")
+
+
+class FakeS3:
+    """
+    In-memory S3 stand-in for a single bucket, serving path-style requests of the operations used by the workers.
+    """
+
+    def __init__(self, bucket: str):
+        self.bucket = bucket
+        self.objects: dict[str, StoredObject] = {}
+        self.uploads: dict[str, tuple[str, dict[str, str], dict[int, bytes]]] = {}
+        self.runner = None
+        self.url = None
+
+    async def start(self):
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_route("*", "/{path:.*}", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    async def read_body(self, request: web.Request):
+        body = await request.read()
+        if "aws-chunked" in request.headers.get("Content-Encoding", "") or request.headers.get(
+                "x-amz-content-sha256", "").startswith("STREAMING-"):
+            body = decode_aws_chunked(body)
+        return body
+
+    def stored_headers(self, request: web.Request):
+        headers = {name: request.headers[name]
+                   for name in STORED_HEADERS if name in request.headers}
+        if "Content-Encoding" in headers:
+            encodings = [encoding.strip() for encoding in headers["Content-Encoding"].split(
+                ",") if encoding.strip() != "aws-chunked"]
+            if len(encodings) > 0:
+                headers["Content-Encoding"] = ",".join(encodings)
+            else:
+                del headers["Content-Encoding"]
+        return headers
+
+    async def handle(self, request: web.Request):
+        bucket, _, key = unquote(request.match_info["path"]).partition("/")
+        if bucket != self.bucket:
+            return error(404, "NoSuchBucket")
+        query = request.query
+        if key == "":
+            if request.method in ("GET", "HEAD"):
+                return self.list_objects(query)
+            return web.Response()
+        if request.method == "PUT" and "uploadId" in query:
+            return await self.upload_part(request, key)
+        if request.method == "PUT" and "x-amz-copy-source" in request.headers:
+            return self.copy_object(request, key)
+        if request.method == "PUT":
+            obj = StoredObject(await self.read_body(request), self.stored_headers(request))
+            self.objects[key] = obj
+            return web.Response(headers={"ETag": obj.etag})
+        if request.method == "POST" and "uploads" in query:
+            upload_id = uuid.uuid4().hex
+            self.uploads[upload_id] = (key, self.stored_headers(request), {})
+            return xml(f"<InitiateMultipartUploadResult><Bucket>{self.bucket}</Bucket><Key>{escape(key)}</Key>"
+                       f"<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>")
+        if request.method == "POST" and "uploadId" in query:
+            return self.complete_upload(query["uploadId"])
+        if request.method == "DELETE" and "uploadId" in query:
+            self.uploads.pop(query["uploadId"], None)
+            return web.Response(status=204)
+        if request.method == "DELETE":
+            self.objects.pop(key, None)
+            return web.Response(status=204)
+        if request.method in ("GET", "HEAD"):
+            return self.get_object(request, key)
+        return error(405, "MethodNotAllowed")
+
+    def get_object(self, request: web.Request, key: str):
+        obj = self.objects.get(key)
+        if obj is None:
+            return error(404, "NoSuchKey")
+        headers = {"ETag": obj.etag, "Last-Modified": format_datetime(
+            obj.modified, usegmt=True), "Accept-Ranges": "bytes", **obj.headers}
+        body = obj.body
+        status = 200
+        range_header = request.headers.get("Range")
+        if range_header is not None and range_header.startswith("bytes="):
+            first, _, last = range_header[len("bytes="):].partition("-")
+            if first == "":
+                start, end = max(len(body) - int(last), 0), len(body) - 1
+            else:
+                start = int(first)
+                end = min(int(last), len(body) - 1) if last else len(body) - 1
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(body)}"
+            body = body[start:end + 1]
+            status = 206
+        if request.method == "HEAD":
+            headers["Content-Length"] = str(len(body))
+            return web.Response(status=status, headers=headers)
+        return web.Response(status=status, body=body, headers=headers)
+
+    def copy_object(self, request: web.Request, key: str):
+        source = unquote(request.headers["x-amz-copy-source"]).lstrip("/")
+        source_bucket, _, source_key = source.partition("/")
+        obj = self.objects.get(source_key) if source_bucket == self.bucket else None
+        if obj is None:
+            return error(404, "NoSuchKey")
+        self.objects[key] = StoredObject(obj.body, dict(obj.headers))
+        return xml(f"<CopyObjectResult><ETag>{escape(obj.etag)}</ETag>"
+                   f"<LastModified>{obj.modified.isoformat()}</LastModified></CopyObjectResult>")
+
+    async def upload_part(self, request: web.Request, key: str):
+        upload = self.uploads.get(request.query["uploadId"])
+        if upload is None:
+            return error(404, "NoSuchUpload")
+        body = await self.read_body(request)
+        upload[2][int(request.query["partNumber"])] = body
+        return web.Response(headers={"ETag": f'"{hashlib.md5(body).hexdigest()}"'})
+
+    def complete_upload(self, upload_id: str):
+        upload = self.uploads.pop(upload_id, None)
+        if upload is None:
+            return error(404, "NoSuchUpload")
+        key, headers, parts = upload
+        obj = StoredObject(
+            b"".join(parts[number] for number in sorted(parts)), headers)
+        self.objects[key] = obj
+        return xml(f"<CompleteMultipartUploadResult><Bucket>{self.bucket}</Bucket><Key>{escape(key)}</Key>"
+                   f"<ETag>{escape(obj.etag)}</ETag></CompleteMultipartUploadResult>")
+
+    def list_objects(self, query):
+        prefix = query.get("prefix", "")
+        delimiter = query.get("delimiter")
+        max_keys = int(query.get("max-keys", 1000))
+        after = query.get("continuation-token") or query.get("start-after", "")
+        keys = sorted(key for key in self.objects if key.startswith(prefix) and key > after)
+        contents, prefixes = [], []
+        for key in keys:
+            if delimiter and delimiter in key[len(prefix):]:
+                common = key[:len(prefix) + key[len(prefix):].index(delimiter) + 1]
+                if common not in prefixes:
+                    prefixes.append(common)
+                continue
+            contents.append(key)
+        truncated = len(contents) > max_keys
+        contents = contents[:max_keys]
+        entries = "".join(
+            f"<Contents><Key>{escape(key)}</Key><LastModified>{self.objects[key].modified.isoformat()}</LastModified>"
+            f"<ETag>{escape(self.objects[key].etag)}</ETag><Size>{len(self.objects[key].body)}</Size>"
+            f"<StorageClass>STANDARD</StorageClass></Contents>" for key in contents)
+        entries += "".join(
+            f"<CommonPrefixes><Prefix>{escape(common)}</Prefix></CommonPrefixes>" for common in prefixes)
+        token = f"<NextContinuationToken>{escape(contents[-1])}</NextContinuationToken>" if truncated else ""
+        return xml(f"<ListBucketResult><Name>{self.bucket}</Name><Prefix>{escape(prefix)}</Prefix>"
+                   f"<KeyCount>{len(contents) + len(prefixes)}</KeyCount><MaxKeys>{max_keys}</MaxKeys>"
+                   f"<IsTruncated>{str(truncated).lower()}</IsTruncated>{token}{entries}</ListBucketResult>")
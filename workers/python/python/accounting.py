@@ -0,0 +1,133 @@
+# Copyright 2024 IBM Corp.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Optional
+
+from config import config
+from database import database
+from metrics import Counter
+
+logger = logging.getLogger()
+
+USAGE_COLLECTION = "extraction_usage"
+# Writes attempted for the records left on close, a second apart
+CLOSE_ATTEMPTS = 3
+CLOSE_RETRY_SECONDS = 1
+
+usage_records = Counter("extraction_usage_records_total", "Usage records by outcome of their write.", ("outcome",))
+
+
+@dataclass
+class Usage:
+    """
+    Resources spent extracting a file, None where the backend does not measure them.
+    """
+    cpu_seconds: Optional[float] = None
+    pages: Optional[int] = None
+    ocr_pages: Optional[int] = None
+    artifact_bytes: int = 0
+
+
+class UsageRecorder:
+    """
+    Buffers usage records of extractions and writes them to the database together.
+
+    Records are written once max_size of them are buffered or max_wait seconds after the first one arrived.
+    Records of a failed write are kept for the next one, up to max_pending records.
+    """
+
+    def __init__(self, max_size: int, max_wait: float, max_pending: int):
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.max_pending = max_pending
+        self.records: list[dict] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.tasks: set[asyncio.Task] = set()
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def record(self, file, backend: str, usage: Usage, cached: bool = False):
+        if not self.enabled:
+            return
+        self.records.append({
+            "fileId": file["_id"],
+            "project": file.get("project"),
+            "backend": backend,
+            "cached": cached,
+            "inputBytes": file["bytes"],
+            "cpuSeconds": usage.cpu_seconds,
+            "pages": usage.pages,
+            "ocrPages": usage.ocr_pages,
+            "artifactBytes": usage.artifact_bytes,
+            "createdAt": datetime.now(timezone.utc)
+        })
+        self.schedule()
+
+    def schedule(self):
+        if len(self.records) >= self.max_size:
+            self.flush()
+        elif self.timer is None and len(self.records) > 0:
+            self.timer = asyncio.get_running_loop().call_later(self.max_wait, self.flush)
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        records, self.records = self.records, []
+        if len(records) > 0:
+            task = asyncio.create_task(self.write(records))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def write(self, records: list[dict]):
+        try:
+            await database.get_collection(USAGE_COLLECTION).insert_many(records, ordered=False)
+            usage_records.inc(len(records), outcome="written")
+        except Exception:
+            kept = records[:max(self.max_pending - len(self.records), 0)]
+            usage_records.inc(len(records) - len(kept), outcome="dropped")
+            logger.warning(f"Unable to write {len(records)} usage records, {len(kept)} kept", exc_info=True)
+            self.records[:0] = kept
+            if self.timer is None and len(self.records) > 0:
+                self.timer = asyncio.get_running_loop().call_later(self.max_wait, self.flush)
+
+    async def close(self):
+        """
+        Write the buffered records, retrying failed writes a few times before dropping the records left.
+        """
+        for attempt in range(CLOSE_ATTEMPTS):
+            if attempt > 0:
+                await asyncio.sleep(CLOSE_RETRY_SECONDS)
+            self.flush()
+            while len(self.tasks) > 0:
+                await asyncio.gather(*list(self.tasks))
+            if len(self.records) == 0:
+                return
+        # The failed write rescheduled them
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        usage_records.inc(len(self.records), outcome="dropped")
+        logger.error(f"Dropping {len(self.records)} usage records left unwritten on close")
+        self.records = []
+
+
+usage_recorder = UsageRecorder(config.extraction_usage_batch_size, config.extraction_usage_batch_wait_seconds,
+                               config.extraction_usage_batch_size * 10)
@@ -0,0 +1,106 @@
+# Copyright 2024 IBM Corp.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Optional
+
+from config import config
+
+logger = logging.getLogger()
+
+
+@dataclass
+class Cost:
+    memory_mb: float
+    cpu: float
+
+
+def estimate_cost(file_size: int, page_count: Optional[int] = None) -> Cost:
+    """
+    Estimate resources needed to convert a document of the given size and page count.
+    """
+    memory_mb = config.extraction_memory_base_mb + \
+        config.extraction_memory_per_input_mb * file_size / 1024 / 1024
+    if page_count is not None:
+        memory_mb += config.extraction_memory_per_page_mb * page_count
+    # Conversions are bound by a single core
+    return Cost(memory_mb=memory_mb, cpu=1)
+
+
+class AdmissionController:
+    """
+    Holds conversions while the in-flight work is estimated to exceed the memory or CPU budget.
+
+    A single conversion is always admitted so that documents larger than the budget are not starved.
+    """
+
+    def __init__(self, memory_budget_mb: float, cpu_budget: float):
+        self.memory_budget_mb = memory_budget_mb
+        self.cpu_budget = cpu_budget
+        self.memory_mb = 0.0
+        self.cpu = 0.0
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+
+    def fits(self, cost: Cost):
+        if self.in_flight == 0:
+            return True
+        if self.memory_budget_mb > 0 and self.memory_mb + cost.memory_mb > self.memory_budget_mb:
+            return False
+        if self.cpu_budget > 0 and self.cpu + cost.cpu > self.cpu_budget:
+            return False
+        return True
+
+    @asynccontextmanager
+    async def admit(self, cost: Cost):
+        async with self.condition:
+            if not self.fits(cost):
+                logger.info(
+                    f"Holding conversion of estimated {cost.memory_mb:.0f}MB, {self.memory_mb:.0f}MB in flight")
+            await self.condition.wait_for(lambda: self.fits(cost))
+            self.memory_mb += cost.memory_mb
+            self.cpu += cost.cpu
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.memory_mb -= cost.memory_mb
+                self.cpu -= cost.cpu
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+
+admission_controller = AdmissionController(
+    config.extraction_memory_budget_mb, config.extraction_cpu_budget)
+
+backend_semaphores: dict[str, asyncio.Semaphore] = {
+    backend: asyncio.Semaphore(concurrency) for backend, concurrency in config.extraction_backend_concurrency.items()
+}
+
+
+@asynccontextmanager
+async def backend_slot(backend: str):
+    """
+    Limit the number of concurrent extractions for the backend when configured.
+    """
+    semaphore = backend_semaphores.get(backend)
+    if semaphore is None:
+        yield
+        return
+    async with semaphore:
+        yield
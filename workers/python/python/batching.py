@@ -0,0 +1,65 @@
+# Copyright 2024 IBM Corp.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from typing import Any, Awaitable, Callable, Optional
+
+
+class Batcher:
+    """
+    Gathers items submitted by concurrent jobs and handles them together.
+
+    A batch is flushed once it holds max_size items or max_wait seconds after its first item arrived.
+    The handler returns an error, or None, for each item, errors are raised in the submitting job.
+    """
+
+    def __init__(self, handler: Callable[[list], Awaitable[list[Optional[Exception]]]], max_size: int, max_wait: float):
+        self.handler = handler
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.items: list[tuple[Any, asyncio.Future]] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.tasks: set[asyncio.Task] = set()
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        self.items.append((item, future))
+        if len(self.items) >= self.max_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.max_wait, self.flush)
+        await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        items, self.items = self.items, []
+        if len(items) > 0:
+            task = asyncio.create_task(self.handle(items))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def handle(self, items: list[tuple[Any, asyncio.Future]]):
+        try:
+            errors = await self.handler([item for item, _ in items])
+        except Exception as e:
+            errors = [e] * len(items)
+        for (_, future), error in zip(items, errors):
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
@@ -0,0 +1,139 @@
+# Copyright 2024 IBM Corp.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import struct
+import sys
+from array import array
+from typing import Callable, Iterable, Optional
+
+# Layout of the index, integers are little-endian:
+#   magic, u32 version, u32 header length, UTF-8 JSON header, columns in the order of the header
+# The header holds the chunk count, the tokenizer, the heading paths and the columns with their array typecodes.
+MAGIC = b"CHKI"
+VERSION = 1
+
+# text_start and text_end are byte offsets into the text artifact, -1 when the chunk was not located in it.
+# Pages are 1-based, 0 when unknown. headings indexes the heading paths of the header.
+COLUMNS = (
+    ("text_start", "q"),
+    ("text_end", "q"),
+    ("tokens", "I"),
+    ("page_first", "I"),
+    ("page_last", "I"),
+    ("headings", "I")
+)
+
+# Chunks are located by the start of their first line and the end of their last line
+ANCHOR_BYTES = 128
+
+
+def count_words(text: str):
+    return len(text.split())
+
+
+def anchor_variants(line: str):
+    # Markdown exports escape underscores
+    variants = [line.encode("utf-8")]
+    if "_" in line:
+        variants.append(line.replace("_", "\\_").encode("utf-8"))
+    return variants
+
+
+class ChunkIndex:
+    """
+    Columnar index of the chunks of a document, letting readers fetch single chunks with ranged reads of the text.
+    """
+
+    def __init__(self, text: Optional[bytes] = None, count_tokens: Optional[Callable[[str], int]] = None,
+                 tokenizer: str = "whitespace"):
+        self.text = text
+        self.cursor = 0
+        self.count_tokens = count_tokens or count_words
+        self.tokenizer = tokenizer
+        self.columns = {name: array(typecode) for name, typecode in COLUMNS}
+        self.headings: dict[tuple[str, ...], int] = {(): 0}
+
+    def find(self, line: str, start: int, suffix: bool):
+        for variant in anchor_variants(line):
+            anchor = variant[-ANCHOR_BYTES:] if suffix else variant[:ANCHOR_BYTES]
+            position = self.text.find(anchor, start)
+            if position >= 0:
+                return position + len(anchor) if suffix else position
+        return -1
+
+    def locate(self, text: str) -> tuple[int, int]:
+        """
+        Find the chunk in the text following the previous chunk, chunks without verbatim text such as tables are not found.
+        """
+        lines = [line.strip() for line in text.splitlines() if line.strip()]
+        if self.text is None or len(lines) == 0:
+            return -1, -1
+        start = -1
+        for line in lines:
+            start = self.find(line, self.cursor, False)
+            if start >= 0:
+                break
+        if start < 0:
+            return -1, -1
+        end = -1
+        for line in reversed(lines):
+            end = self.find(line, start, True)
+            if end >= 0:
+                break
+        if end < 0:
+            return -1, -1
+        self.cursor = end
+        return start, end
+
+    def add(self, text: str, pages: list[int], headings: list[str], start: Optional[int] = None, end: Optional[int] = None):
+        if start is None or end is None:
+            start, end = self.locate(text)
+        path = tuple(headings)
+        if path not in self.headings:
+            self.headings[path] = len(self.headings)
+        values = {
+            "text_start": start,
+            "text_end": end,
+            "tokens": self.count_tokens(text),
+            "page_first": min(pages) if len(pages) > 0 else 0,
+            "page_last": max(pages) if len(pages) > 0 else 0,
+            "headings": self.headings[path]
+        }
+        for name, value in values.items():
+            self.columns[name].append(value)
+
+    def track(self, chunks: Iterable[dict]):
+        """
+        Index the chunks as they are consumed.
+        """
+        for chunk in chunks:
+            self.add(chunk["text"], chunk.get("pages", []), chunk.get("headings", []))
+            yield chunk
+
+    def encode(self) -> bytes:
+        header = json.dumps({
+            "count": len(self.columns["tokens"]),
+            "tokenizer": self.tokenizer,
+            "headings": [list(path) for path in self.headings],
+            "columns": [[name, typecode, self.columns[name].itemsize] for name, typecode in COLUMNS]
+        }, separators=(",", ":")).encode("utf-8")
+        parts = [MAGIC, struct.pack("<II", VERSION, len(header)), header]
+        for name, _ in COLUMNS:
+            column = self.columns[name]
+            if sys.byteorder == "big":
+                column = array(column.typecode, column)
+                column.byteswap()
+            parts.append(column.tobytes())
+        return b"".join(parts)
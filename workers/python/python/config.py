@@ -12,7 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Optional
+from typing import Literal, Optional
 
 from pydantic import Field, computed_field
 from pydantic_settings import BaseSettings, SettingsConfigDict
@@ -20,6 +20,16 @@ from pydantic_settings import BaseSettings, SettingsConfigDict
 from enums import ExtractionBackend
 
 
+def parse_pairs(raw: Optional[str], value_type, key_type=str) -> dict:
+    if not raw:
+        return {}
+    pairs = {}
+    for pair in raw.split(','):
+        key, value = pair.split('=', 1)
+        pairs[key_type(key.strip())] = value_type(value.strip())
+    return pairs
+
+
 class Config(BaseSettings):
     model_config = SettingsConfigDict(
         env_file='../../.env', env_file_encoding='utf-8', env_ignore_empty=True, extra='ignore')
@@ -27,6 +37,17 @@ class Config(BaseSettings):
     port: int = 8080
 
     log_level: str = 'info'
+    # Comma separated list of logger=level pairs overriding log_level, e.g. docling=warning,torch=error
+    log_levels_raw: Optional[str] = Field(default=None, alias='log_levels')
+
+    @computed_field
+    @property
+    def log_levels(self) -> dict[str, str]:
+        return parse_pairs(self.log_levels_raw, str)
+
+    # Records of a single call site beyond the limit are dropped until the window ends, 0 disables rate limiting
+    log_rate_limit: int = 20
+    log_rate_limit_window_seconds: float = 10
 
     run_bullmq_workers_raw: str = Field(alias='run_bullmq_workers')
 
@@ -35,6 +56,18 @@ class Config(BaseSettings):
     def run_bullmq_workers(self) -> list[str]:
         return self.run_bullmq_workers_raw.split(',')
 
+    # Comma separated list of name=value pairs, e.g. files-extraction-python=4
+    worker_concurrency_raw: Optional[str] = Field(
+        default=None, alias='worker_concurrency')
+
+    @computed_field
+    @property
+    def worker_concurrency(self) -> dict[str, int]:
+        return parse_pairs(self.worker_concurrency_raw, int)
+
+    # On shutdown, jobs in flight get this long to finish before they are handed back to the queue
+    worker_drain_grace_seconds: float = 20
+
     redis_url: str
     redis_ca_cert: Optional[str] = None
 
@@ -44,17 +77,163 @@ class Config(BaseSettings):
 
     unstructured_api_url: Optional[str] = None
     unstructured_api_key: Optional[str] = None
+    unstructured_num_processes: int = 2
+    unstructured_max_connections: Optional[int] = None
 
     s3_endpoint: str
     s3_bucket_file_storage: str
     s3_access_key_id: str
     s3_secret_access_key: str
+    s3_max_pool_connections: int = 20
+    s3_connect_timeout: float = 10
+    s3_read_timeout: float = 60
+    # Sources up to this size are downloaded into memory instead of a temporary file
+    s3_in_memory_download_max_size: int = 10485760
+    s3_multipart_threshold: int = 16777216
+    s3_multipart_chunksize: int = 8388608
+    # Source files are kept on local disk across jobs up to this size, 0 disables the cache
+    disk_cache_max_bytes: int = 0
+    disk_cache_path: str = '/tmp/extraction-cache'
 
     otel_sdk_disabled: bool = False
+    # Fraction of traces exported, traces failing or lasting otel_traces_slow_seconds are always exported
+    otel_traces_sample_ratio: float = 1.0
+    otel_traces_slow_seconds: float = 30
+    # Traces waiting for their root span to end, the oldest are dropped beyond the limit
+    otel_traces_max_pending: int = 1000
+
+    # Bearer token of the admin endpoints, they are not served when unset
+    admin_token: Optional[str] = None
+    # Prefix of the profiles written to the file storage bucket
+    diagnostics_prefix: str = 'diagnostics'
+    profiling_sample_interval_ms: float = 10
+    # Jobs running longer are profiled until they finish, 0 disables automatic profiling
+    profiling_slow_job_seconds: float = 0
 
     docling_do_table_structure: bool = True
     docling_pdf_do_ocr: bool = True
+    # Route only PDF pages without a text layer through OCR, applies when docling_pdf_do_ocr is enabled.
+    # Runs of pages routed alike are converted separately, chunks do not cross them
+    docling_adaptive_ocr: bool = False
+    # Shorter runs are routed like the pages before them, so that documents are not split into small pieces
+    docling_adaptive_ocr_min_pages: int = 8
+    docling_ocr_min_chars: int = 16
+    docling_ocr_min_image_coverage: float = 0.05
     docling_advanced_chunker: bool = True
+    # Embed chunks with the model of the chunker tokenizer and store the vectors next to the chunks
+    docling_embeddings: bool = False
+    docling_embedding_dtype: Literal['float32', 'float16'] = 'float16'
+    docling_embedding_batch_size: int = 32
+    # Conversions run in this many processes, on threads of the worker when 0. Docling versions without a lock of
+    # their own around PDFium, which is not thread-safe, convert one document at a time on threads, whatever the
+    # concurrency of the backend and the sharding of PDFs: use the pool to convert concurrently with them.
+    docling_process_pool_size: int = 0
+    # Limits of the conversions in pool processes, a process breaching them is killed and the job fails, 0 disables a limit
+    docling_conversion_timeout_seconds: float = 600
+    docling_process_max_rss_mb: int = 0
+    # Pool processes are replaced after this many conversions or once their memory grows past the threshold
+    docling_process_max_jobs: int = 200
+    docling_process_recycle_rss_mb: int = 0
+    docling_max_num_pages: int = 100
+    docling_max_file_size: int = 20971520
+    # PDFs with more pages are converted as concurrent page-range shards, 0 disables sharding
+    docling_shard_pages: int = 0
+    # Shard results of PDFs with more pages are checkpointed to storage so that retried jobs resume, 0 disables checkpoints.
+    # Such PDFs are converted in shards of this many pages when sharding is disabled
+    docling_checkpoint_pages: int = 0
+    # ndjson streams chunks to storage instead of materializing them as a JSON list
+    docling_chunks_format: Literal['json', 'ndjson'] = 'json'
+
+    # Comma separated list of backend=value pairs, e.g. docling=4,unstructured-opensource=2
+    extraction_backend_concurrency_raw: Optional[str] = Field(
+        default=None, alias='extraction_backend_concurrency')
+
+    @computed_field
+    @property
+    def extraction_backend_concurrency(self) -> dict[ExtractionBackend, int]:
+        return parse_pairs(self.extraction_backend_concurrency_raw, int, ExtractionBackend)
+
+    # Comma separated list of backends loaded and warmed up before the worker reports ready, e.g. docling,unstructured-opensource.
+    # Other backends are loaded by their first job
+    extraction_warm_up_backends_raw: Optional[str] = Field(
+        default=None, alias='extraction_warm_up_backends')
+
+    @computed_field
+    @property
+    def extraction_warm_up_backends(self) -> list[ExtractionBackend]:
+        if not self.extraction_warm_up_backends_raw:
+            return []
+        return [ExtractionBackend(backend.strip()) for backend in self.extraction_warm_up_backends_raw.split(',')]
+
+    extraction_cache_enabled: bool = True
+    # Jobs are gathered into batches of up to this size when above 1
+    extraction_batch_size: int = 0
+    extraction_batch_wait_ms: int = 200
+    # Content encoding of the extraction artifacts, e.g. gzip
+    extraction_content_encoding: Optional[Literal['gzip']] = None
+
+    # Budgets of the admission control, 0 disables the respective limit
+    extraction_memory_budget_mb: int = 0
+    extraction_cpu_budget: float = 0
+    extraction_memory_base_mb: int = 500
+    extraction_memory_per_page_mb: float = 20
+    extraction_memory_per_input_mb: float = 4
+
+    # Comma separated list of lane=capacity pairs in routing order, e.g. interactive=2,bulk=4, the last lane takes the rest.
+    # Jobs are routed to a queue per lane, e.g. files-extraction-python-bulk, processed with the capacity as concurrency.
+    extraction_lanes_raw: Optional[str] = Field(
+        default=None, alias='extraction_lanes')
+    # Comma separated list of lane=bytes pairs, files up to the size are routed to the lane
+    extraction_lane_max_bytes_raw: Optional[str] = Field(
+        default=None, alias='extraction_lane_max_bytes')
+    # Comma separated list of lane=mime types pairs, mime types separated by |, only files of these types are routed to the lane
+    extraction_lane_mime_types_raw: Optional[str] = Field(
+        default=None, alias='extraction_lane_mime_types')
+    # Comma separated list of project=lane pairs, pinning all files of the project to the lane
+    extraction_project_lanes_raw: Optional[str] = Field(
+        default=None, alias='extraction_project_lanes')
+
+    @computed_field
+    @property
+    def extraction_lanes(self) -> dict[str, int]:
+        return parse_pairs(self.extraction_lanes_raw, int)
+
+    @computed_field
+    @property
+    def extraction_lane_max_bytes(self) -> dict[str, int]:
+        return parse_pairs(self.extraction_lane_max_bytes_raw, int)
+
+    @computed_field
+    @property
+    def extraction_lane_mime_types(self) -> dict[str, set[str]]:
+        return parse_pairs(self.extraction_lane_mime_types_raw, lambda value: set(value.split('|')))
+
+    @computed_field
+    @property
+    def extraction_project_lanes(self) -> dict[str, str]:
+        return parse_pairs(self.extraction_project_lanes_raw, str)
+
+    # Jobs of a project over its share of the lane are moved back to the lane queue for this long
+    extraction_lane_defer_ms: int = 2000
+    # Projects with jobs in a lane within this window share its capacity
+    extraction_lane_demand_window_seconds: float = 30
+
+    # Jobs per second each project may start across all workers, 0 disables the limit
+    extraction_project_rate: float = 0
+    # Jobs a project may start at once after being idle
+    extraction_project_burst: int = 20
+    # Comma separated list of project=rate pairs overriding the rate, 0 exempts the project
+    extraction_project_rates_raw: Optional[str] = Field(
+        default=None, alias='extraction_project_rates')
+
+    @computed_field
+    @property
+    def extraction_project_rates(self) -> dict[str, float]:
+        return parse_pairs(self.extraction_project_rates_raw, float)
+
+    # Usage records of extractions are written in batches of up to this size, 0 disables the accounting
+    extraction_usage_batch_size: int = 100
+    extraction_usage_batch_wait_seconds: float = 10
 
 
 config = Config()
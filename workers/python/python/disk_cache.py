@@ -0,0 +1,172 @@
+# Copyright 2024 IBM Corp.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from typing import Optional
+
+from config import config
+from metrics import Counter, Gauge
+
+logger = logging.getLogger()
+
+cache_requests = Counter("disk_cache_requests_total", "Disk cache lookups by outcome.", ("outcome",))
+cache_bytes = Gauge("disk_cache_bytes", "Size of the disk cache.")
+
+# Temporary files older than this were left behind by writers that crashed, others may still be written to
+STALE_TEMPORARY_SECONDS = 3600
+
+
+def link_or_copy(source: str, target: str):
+    try:
+        os.link(source, target)
+    except OSError:
+        # Across file systems
+        shutil.copyfile(source, target)
+
+
+class DiskCache:
+    """
+    Bounded cache of storage objects on local disk, keyed by storage id and ETag, evicting the least recently used.
+
+    State lives on disk only, so that the cache is shared with the processes of the unstructured pipeline.
+    Entries are written under a temporary name and renamed, their modification time tracks their last use.
+    The ETag last cached for each storage id is kept next to them, so that downloads can be made conditional on it.
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self.remove_stale_temporaries()
+
+    def remove_stale_temporaries(self):
+        # Change time rather than modification time, a hard link keeps the modification time of its source
+        stale_before = time.time() - STALE_TEMPORARY_SECONDS
+        with os.scandir(self.path) as scan:
+            for item in scan:
+                if not item.name.startswith("."):
+                    continue
+                try:
+                    if item.stat().st_ctime < stale_before:
+                        os.remove(item.path)
+                except FileNotFoundError:
+                    pass
+
+    def entry(self, storage_id: str, etag: str):
+        return os.path.join(self.path, hashlib.sha256(f"{storage_id}\0{etag}".encode()).hexdigest())
+
+    def tag(self, storage_id: str):
+        return os.path.join(self.path, f"{hashlib.sha256(storage_id.encode()).hexdigest()}.etag")
+
+    def latest_etag(self, storage_id: str) -> Optional[str]:
+        """
+        Return the ETag of the object last cached under the storage id, for conditional downloads.
+        """
+        tag = self.tag(storage_id)
+        try:
+            with open(tag) as file:
+                etag = file.read()
+            # Evicted along with the entries of the same age
+            os.utime(tag)
+        except FileNotFoundError:
+            return None
+        return etag
+
+    def lookup(self, storage_id: str, etag: str) -> Optional[str]:
+        entry = self.entry(storage_id, etag)
+        try:
+            os.utime(entry)
+        except FileNotFoundError:
+            cache_requests.inc(outcome="miss")
+            return None
+        cache_requests.inc(outcome="hit")
+        return entry
+
+    def read(self, storage_id: str, etag: str) -> Optional[bytes]:
+        entry = self.lookup(storage_id, etag)
+        if entry is None:
+            return None
+        try:
+            with open(entry, "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            # Evicted meanwhile
+            return None
+
+    def restore(self, storage_id: str, etag: str, target: str) -> bool:
+        entry = self.lookup(storage_id, etag)
+        if entry is None:
+            return False
+        try:
+            link_or_copy(entry, target)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put_bytes(self, storage_id: str, etag: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        with tempfile.NamedTemporaryFile(dir=self.path, prefix=".", delete=False) as file:
+            file.write(data)
+        self.commit(file.name, storage_id, etag)
+
+    def put_file(self, storage_id: str, etag: str, path: str):
+        if os.path.getsize(path) > self.max_bytes:
+            return
+        temporary = os.path.join(self.path, f".{os.getpid()}-{threading.get_ident()}")
+        link_or_copy(path, temporary)
+        self.commit(temporary, storage_id, etag)
+
+    def commit(self, temporary: str, storage_id: str, etag: str):
+        os.replace(temporary, self.entry(storage_id, etag))
+        with tempfile.NamedTemporaryFile("w", dir=self.path, prefix=".", delete=False) as file:
+            file.write(etag)
+        os.replace(file.name, self.tag(storage_id))
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            total = 0
+            with os.scandir(self.path) as scan:
+                for item in scan:
+                    if item.name.startswith("."):
+                        continue
+                    try:
+                        stat = item.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, item.path))
+                    total += stat.st_size
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+            cache_bytes.set(total)
+
+
+disk_cache = DiskCache(config.disk_cache_path,
+                       config.disk_cache_max_bytes) if config.disk_cache_max_bytes > 0 else None
@@ -0,0 +1,59 @@
+# Copyright 2024 IBM Corp.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import json
+from typing import Iterable, Optional
+
+# Compact encoding, skipping the circular reference check is safe for the plain dicts we serialize
+json_encoder = json.JSONEncoder(
+    ensure_ascii=False, separators=(",", ":"), check_circular=False)
+
+
+def encode_json(obj, content_encoding: Optional[str] = None) -> bytes:
+    return encode_text(json_encoder.encode(obj), content_encoding)
+
+
+def encode_text(text: str, content_encoding: Optional[str] = None) -> bytes:
+    return compress(text.encode("utf-8"), content_encoding)
+
+
+def open_encoded(path: str, content_encoding: Optional[str] = None):
+    """
+    Open a file for writing bytes that are encoded on the fly.
+    """
+    if content_encoding is None:
+        return open(path, "wb")
+    if content_encoding == "gzip":
+        return gzip.open(path, "wb", compresslevel=3)
+    raise ValueError(f"Unsupported content encoding {content_encoding}")
+
+
+def write_ndjson(path: str, objs: Iterable, content_encoding: Optional[str] = None):
+    """
+    Write objects as newline delimited JSON, consuming the iterable incrementally.
+    """
+    with open_encoded(path, content_encoding) as file:
+        for obj in objs:
+            file.write(json_encoder.encode(obj).encode("utf-8"))
+            file.write(b"\n")
+
+
+def compress(body: bytes, content_encoding: Optional[str] = None) -> bytes:
+    if content_encoding is None:
+        return body
+    if content_encoding == "gzip":
+        # Favour speed, artifacts are mostly text which compresses well at low levels
+        return gzip.compress(body, compresslevel=3)
+    raise ValueError(f"Unsupported content encoding {content_encoding}")
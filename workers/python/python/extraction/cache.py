@@ -0,0 +1,98 @@
+# Copyright 2024 IBM Corp.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import logging
+from datetime import datetime, timezone
+
+from botocore.exceptions import ClientError
+
+from config import config
+from database import database
+
+logger = logging.getLogger()
+
+CACHE_COLLECTION = "extraction_cache"
+
+# Bump when the artifacts produced for the same input change
+CACHE_VERSION = 3
+
+
+def cache_key(file, backend: str, options: dict):
+    content_hash = file.get("contentHash")
+    if content_hash is None:
+        return None
+    serialized = json.dumps(
+        [CACHE_VERSION, content_hash, backend, options], sort_keys=True)
+    return hashlib.sha256(serialized.encode()).hexdigest()
+
+
+async def restore_from_cache(s3, file, backend: str, options: dict, targets: dict[str, str]):
+    """
+    Copy cached artifacts of identical content to the target keys of the file.
+
+    Artifacts are copied rather than shared since they are deleted together with their file.
+    Returns the metadata stored with the artifacts on a cache hit, None otherwise.
+    """
+    if not config.extraction_cache_enabled:
+        return None
+    key = cache_key(file, backend, options)
+    if key is None:
+        return None
+    collection = database.get_collection(CACHE_COLLECTION)
+    entry = await collection.find_one({"_id": key})
+    if entry is None:
+        return None
+
+    artifacts = entry["artifacts"]
+    if artifacts.keys() != targets.keys():
+        return None
+    try:
+        for field, target in targets.items():
+            if artifacts[field] == target:
+                continue
+            await s3.copy_object(
+                Bucket=config.s3_bucket_file_storage,
+                Key=target,
+                CopySource={"Bucket": config.s3_bucket_file_storage,
+                            "Key": artifacts[field]}
+            )
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") not in ("NoSuchKey", "404"):
+            raise
+        # Source artifacts were removed together with their file
+        await collection.delete_one({"_id": key})
+        return None
+
+    logger.info(f"Extraction cache hit for file {file['_id']}")
+    return entry.get("metadata", {})
+
+
+async def store_in_cache(file, backend: str, options: dict, artifacts: dict[str, str], metadata: dict = {}):
+    if not config.extraction_cache_enabled:
+        return
+    key = cache_key(file, backend, options)
+    if key is None:
+        return
+    await database.get_collection(CACHE_COLLECTION).replace_one({"_id": key}, {
+        "_id": key,
+        "contentHash": file["contentHash"],
+        "backend": backend,
+        "options": options,
+        "artifacts": artifacts,
+        "metadata": metadata,
+        "fileId": file["_id"],
+        "createdAt": datetime.now(timezone.utc)
+    }, upsert=True)
@@ -0,0 +1,101 @@
+# Copyright 2024 IBM Corp.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+
+from config import config
+from encoding import encode_json
+from extraction.cache import CACHE_VERSION
+from metrics import Counter
+from storage import download_bytes, upload
+
+logger = logging.getLogger()
+
+checkpoint_shards = Counter("extraction_checkpoint_shards_total", "Checkpointed shards by outcome.",
+                            ("outcome",))
+
+
+def decode_shard(body: bytes):
+    document, markdown, chunks = json.loads(gzip.decompress(body))
+    # The conversion time was spent by an earlier attempt
+    return document, markdown, chunks, {}
+
+
+class Checkpoints:
+    """
+    Shard results of a document stored under its artifacts while it is converted,
+    so that a retried job converts only the shards missing.
+
+    Results are only reused under the same pipeline options.
+    """
+
+    def __init__(self, s3, root: str, options: dict):
+        fingerprint = hashlib.sha256(json.dumps(
+            [CACHE_VERSION, options], sort_keys=True).encode()).hexdigest()[:16]
+        self.s3 = s3
+        self.root = f"{root}/"
+        self.prefix = f"{root}/{fingerprint}/"
+
+    def key(self, start: int, end: int, do_ocr: bool):
+        return f"{self.prefix}{start}-{end}-{'ocr' if do_ocr else 'text'}.json.gz"
+
+    async def list_keys(self, prefix: str) -> list[str]:
+        keys = []
+        paginator = self.s3.get_paginator("list_objects_v2")
+        async for page in paginator.paginate(Bucket=config.s3_bucket_file_storage, Prefix=prefix):
+            keys.extend(obj["Key"] for obj in page.get("Contents", []))
+        return keys
+
+    async def restore(self, plan: list[tuple[int, int, bool]]) -> dict[int, tuple]:
+        """
+        Return the checkpointed results by index of the shard in the plan.
+        """
+        existing = set(await self.list_keys(self.prefix))
+        restored = {}
+
+        async def restore_shard(index: int, key: str):
+            try:
+                body = await download_bytes(self.s3, key)
+                restored[index] = await asyncio.to_thread(decode_shard, body)
+            except Exception:
+                logger.warning(f"Unable to restore checkpoint {key}", exc_info=True)
+        await asyncio.gather(*[
+            restore_shard(index, self.key(*shard)) for index, shard in enumerate(plan) if self.key(*shard) in existing
+        ])
+        checkpoint_shards.inc(len(restored), outcome="restored")
+        return restored
+
+    async def save(self, start: int, end: int, do_ocr: bool, result: tuple):
+        document, markdown, chunks, _ = result
+        try:
+            body = await asyncio.to_thread(encode_json, [document, markdown, chunks], "gzip")
+            await upload(self.s3, self.key(start, end, do_ocr), body, "application/gzip")
+            checkpoint_shards.inc(outcome="saved")
+        except Exception:
+            # The conversion goes on, a retry converts the shard again
+            logger.warning(
+                f"Unable to checkpoint pages {start}-{end}", exc_info=True)
+
+    async def clear(self):
+        """
+        Remove the checkpoints of all pipeline options once the artifacts are written.
+        """
+        keys = await self.list_keys(self.root)
+        await asyncio.gather(*[
+            self.s3.delete_object(Bucket=config.s3_bucket_file_storage, Key=key) for key in keys
+        ])
@@ -13,88 +13,427 @@
 # limitations under the License.
 
 import asyncio
+import logging
+import os
 import tempfile
-import json
-import aioboto3
-
-from docling.datamodel.base_models import InputFormat
-from docling.document_converter import DocumentConverter, PdfFormatOption
-from docling_core.transforms.chunker.hierarchical_chunker import HierarchicalChunker
-from docling_core.transforms.chunker.hybrid_chunker import HybridChunker
-from docling.datamodel.pipeline_options import PdfPipelineOptions
+import time
+from functools import partial
+from io import BytesIO
+from typing import Optional
 
+from docling_core.types.io import DocumentStream
+from pymongo import UpdateOne
 
 from config import config
 from database import database
+from enums import ExtractionBackend
+from storage import s3_client, download_bytes, download_if_changed, upload, upload_file
+from disk_cache import cache_requests, disk_cache
+from extraction.cache import restore_from_cache, store_in_cache
+from extraction.extraction import fail_removed_files
+from extraction.checkpoints import Checkpoints
+from extraction.embeddings import EMBEDDING_MODEL
+from admission import admission_controller, estimate_cost
+from accounting import Usage, usage_recorder
+from stages import DOWNLOAD, MONGO_UPDATE, UPLOAD, measure_cpu, record_timings, stage
+from metrics import input_pages
+from profiling import profiled
+from supervisor import SupervisedPool
+from extraction.docling_converter import DOCLING_LOCKS_PDFIUM, analyze_pages, convert, convert_batch, convert_shard, init_converter, merge_shards, split_pdf, warm_up
+from extraction.shards import plan_shards
+
+logger = logging.getLogger()
 
 EXTRACTION_DIR = "docling"
 
 S3_URL = f"s3://{config.s3_bucket_file_storage}"
 
-converter = DocumentConverter(format_options={
-    InputFormat.PDF: PdfFormatOption(
-        pipeline_options=PdfPipelineOptions(
-            do_table_structure=config.docling_do_table_structure,
-            do_ocr=config.docling_pdf_do_ocr)
-    )
-})
-chunker = HybridChunker(
-    tokenizer="BAAI/bge-small-en-v1.5") if config.docling_advanced_chunker else HierarchicalChunker()
+WARM_UP = ExtractionBackend.DOCLING in config.extraction_warm_up_backends
 
+# Conversion runs on the default thread pool unless a process pool is configured,
+# each pool process holds its own warm converter and chunker.
+pool = SupervisedPool(
+    "docling",
+    config.docling_process_pool_size,
+    # Replacement processes are warmed up as well
+    initializer=warm_up if WARM_UP else init_converter,
+    timeout=config.docling_conversion_timeout_seconds,
+    max_rss_mb=config.docling_process_max_rss_mb,
+    recycle_rss_mb=config.docling_process_recycle_rss_mb,
+    max_jobs=config.docling_process_max_jobs
+) if config.docling_process_pool_size > 0 else None
 
-async def docling_extraction(file):
+if pool is None and not DOCLING_LOCKS_PDFIUM and (
+        config.extraction_backend_concurrency.get(ExtractionBackend.DOCLING, 1) > 1 or config.docling_shard_pages > 0):
+    logger.warning("This docling version does not lock PDFium, conversions on threads run one at a time, "
+                   "set docling_process_pool_size to run them concurrently")
+
+
+async def start_executor() -> dict[str, float]:
+    """
+    Start all pool processes upfront so that their converters are loaded before the first jobs arrive,
+    warming up the converter when configured.
+
+    Returns the time spent on each warm-up step, the slowest process when the pool is enabled.
+    """
+    if pool is None:
+        return await asyncio.to_thread(warm_up) if WARM_UP else {}
+    results = await pool.start()
+    logger.info(
+        f"Docling process pool started with {config.docling_process_pool_size} processes")
+    timings = {}
+    for result in results:
+        for name, seconds in (result or {}).items():
+            timings[name] = max(timings.get(name, 0), seconds)
+    return timings
+
+
+def shutdown_executor():
+    if pool is not None:
+        pool.shutdown()
+
+
+async def run_converter(fn, *args, usage: Optional[Usage] = None):
+    """
+    Run the conversion function on the pool, adding the CPU time it took to the usage when given.
+    """
+    if pool is not None:
+        result, cpu_seconds = await pool.run(partial(measure_cpu, time.process_time, fn), *args)
+    else:
+        # Only conversions on the default thread pool can be profiled, pool processes are out of reach.
+        # Threads started by the models are not accounted to the calling thread.
+        result, cpu_seconds = await asyncio.get_running_loop().run_in_executor(
+            None, profiled(partial(measure_cpu, time.thread_time, fn)), *args)
+    if usage is not None:
+        usage.cpu_seconds = (usage.cpu_seconds or 0) + cpu_seconds
+    return result
+
+
+async def convert_sharded(file, source_doc: str | DocumentStream, ocr_pages: list[bool], content_encoding: Optional[str],
+                          chunks_path: Optional[str], shard_pages: int, checkpoints: Optional[Checkpoints] = None,
+                          usage: Optional[Usage] = None):
+    """
+    Convert page-range shards of the PDF concurrently and merge them into single artifacts.
+
+    Shards split pages that need OCR from the rest, only the former are converted with OCR.
+    Checkpointed shards are reused and newly converted ones are checkpointed.
+    """
+    page_count = len(ocr_pages)
+    if page_count > config.docling_max_num_pages:
+        raise RuntimeError(
+            f"Document has {page_count} pages, the limit is {config.docling_max_num_pages}")
+    if file["bytes"] > config.docling_max_file_size:
+        raise RuntimeError(
+            f"Document has {file['bytes']} bytes, the limit is {config.docling_max_file_size}")
+
+    plan = plan_shards(ocr_pages, shard_pages)
+    restored = await checkpoints.restore(plan) if checkpoints is not None else {}
+    missing = [index for index in range(len(plan)) if index not in restored]
+    shards = await asyncio.to_thread(split_pdf, source_doc, [plan[index][:2] for index in missing])
+    logger.info(
+        f"Converting {page_count} pages of file {file['_id']} in {len(plan)} shards, {len(restored)} restored")
+
+    async def convert_missing(index: int, shard: bytes):
+        start, end, do_ocr = plan[index]
+        result = await run_converter(convert_shard, DocumentStream(
+            name=file["filename"], stream=BytesIO(shard)), start, do_ocr, usage=usage)
+        if checkpoints is not None:
+            await checkpoints.save(start, end, do_ocr, result)
+        restored[index] = result
+    await asyncio.gather(*[convert_missing(index, shard) for index, shard in zip(missing, shards)])
+    results = [restored[index] for index in range(len(plan))]
+    # Indexing and embedding need the chunker and the embedding model, which are loaded where conversions run
+    return await run_converter(merge_shards, results, content_encoding, chunks_path, usage=usage)
+
+
+def pipeline_options():
+    return {
+        "do_table_structure": config.docling_do_table_structure,
+        "pdf_do_ocr": config.docling_pdf_do_ocr,
+        "adaptive_ocr": config.docling_adaptive_ocr,
+        **({"adaptive_ocr_min_pages": config.docling_adaptive_ocr_min_pages} if config.docling_adaptive_ocr else {}),
+        "advanced_chunker": config.docling_advanced_chunker,
+        "content_encoding": config.extraction_content_encoding,
+        "chunks_format": config.docling_chunks_format,
+        **({"embedding_dtype": config.docling_embedding_dtype} if config.docling_embeddings else {})
+    }
+
+
+def artifact_keys(storage_id: str):
+    artifacts = {
+        "documentStorageId": f"{EXTRACTION_DIR}/{storage_id}/document.json",
+        "chunksStorageId": f"{EXTRACTION_DIR}/{storage_id}/chunks.{config.docling_chunks_format}",
+        "textStorageId": f"{EXTRACTION_DIR}/{storage_id}/text.md",
+        "chunksIndexStorageId": f"{EXTRACTION_DIR}/{storage_id}/chunks.idx",
+        "tablesStorageId": f"{EXTRACTION_DIR}/{storage_id}/tables.json",
+        "tablesCsvStorageId": f"{EXTRACTION_DIR}/{storage_id}/tables.csv",
+        "figuresStorageId": f"{EXTRACTION_DIR}/{storage_id}/figures.json"
+    }
+    if config.docling_embeddings:
+        artifacts["embeddingsStorageId"] = f"{EXTRACTION_DIR}/{storage_id}/embeddings.{config.docling_embedding_dtype}"
+    return artifacts
+
+
+def streamed_chunks_path(tmp_dir: str):
+    # Chunks are streamed into a local file which is then uploaded in parts, keeping memory bounded
+    return f"{tmp_dir}/chunks.ndjson" if config.docling_chunks_format == "ndjson" else None
+
+
+def read_cached(storage_id: str, etag: str, path: Optional[str]) -> tuple[bool, Optional[bytes]]:
+    if path is None:
+        data = disk_cache.read(storage_id, etag)
+        return data is not None, data
+    return disk_cache.restore(storage_id, etag, path), None
+
+
+def put_cached(storage_id: str, etag: str, path: Optional[str], data: Optional[bytes]):
+    if path is None:
+        disk_cache.put_bytes(storage_id, etag, data)
+    else:
+        disk_cache.put_file(storage_id, etag, path)
+
+
+async def download_cached(s3, storage_id: str, path: Optional[str]) -> Optional[bytes]:
+    """
+    Download through the disk cache, conditionally on the ETag last cached for the storage id.
+
+    Returns the body, None when written to path.
+    """
+    etag = await asyncio.to_thread(disk_cache.latest_etag, storage_id)
+    downloaded = await download_if_changed(s3, storage_id, etag, path)
+    if downloaded is None:
+        found, data = await asyncio.to_thread(read_cached, storage_id, etag, path)
+        if found:
+            return data
+        # Evicted since its ETag was read
+        downloaded = await download_if_changed(s3, storage_id, None, path)
+    else:
+        cache_requests.inc(outcome="miss")
+    etag, data = downloaded
+    await asyncio.to_thread(put_cached, storage_id, etag, path, data)
+    return data
+
+
+async def download_source(s3, file, tmp_dir: str):
     storage_id = file["storageId"]
     file_name = file["filename"]
+    source_doc = None if file["bytes"] <= config.s3_in_memory_download_max_size else f"{tmp_dir}/{file_name}"
+    if disk_cache is not None:
+        data = await download_cached(s3, storage_id, source_doc)
+    elif source_doc is None:
+        data = await download_bytes(s3, storage_id)
+    else:
+        await s3.download_file(config.s3_bucket_file_storage, storage_id, source_doc)
+    # Use file_name to support file type discrimination.
+    return DocumentStream(name=file_name, stream=BytesIO(data)) if source_doc is None else source_doc
 
-    session = aioboto3.Session()
-    async with session.resource("s3",
-                                endpoint_url=config.s3_endpoint,
-                                aws_access_key_id=config.s3_access_key_id,
-                                aws_secret_access_key=config.s3_secret_access_key,
-                                aws_session_token=None,
-                                ) as s3:
-        with tempfile.TemporaryDirectory() as tmp_dir:
-           # Use file_name to support file type discrimination.
-            source_doc = f"{tmp_dir}/{file_name}"
-
-            await s3.meta.client.download_file(config.s3_bucket_file_storage, storage_id, source_doc)
-
-            result = await asyncio.to_thread(converter.convert, source_doc, max_num_pages=100, max_file_size=20971520)
-            doc = result.document
-            dict = doc.export_to_dict()
-            markdown = doc.export_to_markdown()
-            chunks = [{"text": c.text}
-                      for c in list(await asyncio.to_thread(chunker.chunk, doc))]
-
-            document_storage_id = f"{EXTRACTION_DIR}/{storage_id}/document.json"
-            await s3.meta.client.put_object(
-                Bucket=f"{config.s3_bucket_file_storage}",
-                Key=document_storage_id,
-                Body=json.dumps(dict),
-                ContentType="application/json"
-            )
-            text_storage_id = f"{EXTRACTION_DIR}/{storage_id}/text.md"
-            await s3.meta.client.put_object(
-                Bucket=f"{config.s3_bucket_file_storage}",
-                Key=text_storage_id,
-                Body=markdown,
-                ContentType="text/markdown"
-            )
-            chunks_storage_id = f"{EXTRACTION_DIR}/{storage_id}/chunks.json"
-            await s3.meta.client.put_object(
-                Bucket=f"{config.s3_bucket_file_storage}",
-                Key=chunks_storage_id,
-                Body=json.dumps(chunks),
-                ContentType="application/json"
-            )
-
-    result = await database.get_collection('file').update_one(
-        {"_id": file["_id"]}, {"$set": {
-            "extraction.jobId": None,
-            "extraction.documentStorageId": document_storage_id,
-            "extraction.chunksStorageId": chunks_storage_id,
-            "extraction.textStorageId": text_storage_id
-        }})
+
+async def upload_artifacts(s3, artifacts: dict[str, str], document: bytes, markdown: bytes, chunks: bytes | str,
+                           chunks_index: bytes, embeddings: Optional[dict], floating_items: tuple[bytes, bytes, bytes],
+                           content_encoding: Optional[str]) -> int:
+    """
+    Upload the artifacts, returning their total size.
+    """
+    tables_csv, tables, figures = floating_items
+    await asyncio.gather(
+        upload(s3, artifacts["documentStorageId"], document,
+               "application/json", content_encoding),
+        upload(s3, artifacts["textStorageId"], markdown,
+               "text/markdown", content_encoding),
+        upload_file(s3, artifacts["chunksStorageId"], chunks, "application/x-ndjson", content_encoding) if isinstance(chunks, str) else upload(
+            s3, artifacts["chunksStorageId"], chunks, "application/json", content_encoding),
+        upload(s3, artifacts["tablesStorageId"], tables,
+               "application/json", content_encoding),
+        upload(s3, artifacts["tablesCsvStorageId"], tables_csv,
+               "text/csv", content_encoding),
+        upload(s3, artifacts["figuresStorageId"], figures,
+               "application/json", content_encoding),
+        # Binary artifacts barely compress, they are stored without content encoding
+        upload(s3, artifacts["chunksIndexStorageId"], chunks_index, "application/octet-stream"),
+        *([upload(s3, artifacts["embeddingsStorageId"], embeddings["vectors"], "application/octet-stream")]
+          if embeddings is not None else [])
+    )
+    bodies = [document, markdown, chunks_index, tables_csv, tables, figures] + \
+        ([embeddings["vectors"]] if embeddings is not None else [])
+    return sum(len(body) for body in bodies) + (os.path.getsize(chunks) if isinstance(chunks, str) else len(chunks))
+
+
+def ocr_page_numbers(ocr_pages: Optional[list[bool]]):
+    if ocr_pages is None:
+        return None
+    return [page + 1 for page, do_ocr in enumerate(ocr_pages) if do_ocr]
+
+
+def extraction_metadata(ocr_pages: Optional[list[bool]], embeddings: Optional[dict]):
+    """
+    Fields of the extraction describing its artifacts, also kept in the cache for files restored from it.
+    """
+    metadata = {"ocrPages": ocr_page_numbers(ocr_pages)}
+    if embeddings is not None:
+        metadata["embeddingModel"] = EMBEDDING_MODEL
+        metadata["embeddingDimensions"] = embeddings["dimensions"]
+        metadata["embeddingDtype"] = config.docling_embedding_dtype
+    return metadata
+
+
+def extraction_update(artifacts: dict[str, str], content_encoding: Optional[str], metadata: dict):
+    return {"$set": {
+        "extraction.jobId": None,
+        **{f"extraction.{field}": key for field, key in artifacts.items()},
+        "extraction.contentEncoding": content_encoding,
+        **{f"extraction.{field}": value for field, value in metadata.items()}
+    }}
+
+
+async def docling_extraction(file):
+    artifacts = artifact_keys(file["storageId"])
+    options = pipeline_options()
+    content_encoding = config.extraction_content_encoding
+
+    async with s3_client() as s3:
+        cached = await restore_from_cache(s3, file, ExtractionBackend.DOCLING, options, artifacts)
+        usage = Usage()
+        if cached is not None:
+            metadata = cached
+        else:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                with stage(DOWNLOAD, ExtractionBackend.DOCLING):
+                    source_doc = await download_source(s3, file, tmp_dir)
+                chunks_path = streamed_chunks_path(tmp_dir)
+
+                routing = await asyncio.to_thread(analyze_pages, source_doc)
+                page_count = len(routing) if routing is not None else None
+                if page_count is not None:
+                    input_pages.observe(page_count, backend=ExtractionBackend.DOCLING)
+                shard_pages = config.docling_shard_pages or config.docling_checkpoint_pages
+                checkpoints = Checkpoints(s3, f"{EXTRACTION_DIR}/{file['storageId']}/checkpoints", options) if page_count is not None and \
+                    0 < config.docling_checkpoint_pages < page_count else None
+                usage.pages = page_count
+                async with admission_controller.admit(estimate_cost(file["bytes"], page_count)):
+                    if routing is not None and (0 < shard_pages < page_count or 0 < sum(routing) < page_count):
+                        document, markdown, chunks, chunks_index, embeddings, floating_items, timings = await convert_sharded(
+                            file, source_doc, routing, content_encoding, chunks_path, shard_pages, checkpoints, usage)
+                        usage.ocr_pages = sum(routing)
+                    else:
+                        do_ocr = any(routing) if routing else config.docling_pdf_do_ocr
+                        document, markdown, chunks, chunks_index, embeddings, floating_items, timings = await run_converter(
+                            convert, source_doc, content_encoding, chunks_path, do_ocr, usage=usage)
+                        if page_count is not None:
+                            usage.ocr_pages = page_count if do_ocr else 0
+                record_timings(timings, ExtractionBackend.DOCLING)
+                metadata = extraction_metadata(routing, embeddings)
+
+                with stage(UPLOAD, ExtractionBackend.DOCLING):
+                    usage.artifact_bytes = await upload_artifacts(s3, artifacts, document, markdown, chunks, chunks_index,
+                                                                  embeddings, floating_items, content_encoding)
+                if checkpoints is not None:
+                    await checkpoints.clear()
+
+    with stage(MONGO_UPDATE, ExtractionBackend.DOCLING):
+        result = await database.get_collection('file').update_one(
+            {"_id": file["_id"]}, extraction_update(artifacts, content_encoding, metadata))
 
     if result.modified_count == 0:
         raise RuntimeError("File not found")
+
+    usage_recorder.record(file, ExtractionBackend.DOCLING, usage, cached is not None)
+    if cached is None:
+        await store_in_cache(file, ExtractionBackend.DOCLING, options, artifacts, metadata)
+
+
+async def docling_extraction_batch(files: list) -> list[Optional[Exception]]:
+    """
+    Extract several files with a single convert_all invocation and a single database write.
+
+    Returns the error of each file, None when its extraction succeeded.
+    """
+    options = pipeline_options()
+    content_encoding = config.extraction_content_encoding
+    errors: list[Optional[Exception]] = [None] * len(files)
+    artifacts = [artifact_keys(file["storageId"]) for file in files]
+    metadata: list[dict] = [{}] * len(files)
+    routed: list[Optional[list[bool]]] = [None] * len(files)
+    usages = [Usage() for _ in files]
+
+    async with s3_client() as s3:
+        cached = await asyncio.gather(*[
+            restore_from_cache(s3, file, ExtractionBackend.DOCLING, options, file_artifacts) for file, file_artifacts in zip(files, artifacts)
+        ])
+        for i, hit in enumerate(cached):
+            if hit is not None:
+                metadata[i] = hit
+        pending = [i for i in range(len(files)) if cached[i] is None]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for i in pending:
+                os.mkdir(f"{tmp_dir}/{i}")
+            with stage(DOWNLOAD, ExtractionBackend.DOCLING):
+                sources = await asyncio.gather(*[
+                    download_source(s3, files[i], f"{tmp_dir}/{i}") for i in pending
+                ], return_exceptions=True)
+            for i, source in zip(pending, sources):
+                if isinstance(source, Exception):
+                    errors[i] = source
+            pending = [i for i, source in zip(
+                pending, sources) if not isinstance(source, Exception)]
+            sources = [source for source in sources if not isinstance(
+                source, Exception)]
+
+            routings = await asyncio.to_thread(lambda: [analyze_pages(source) for source in sources])
+            # Documents of a batch are converted whole, those with any page needing OCR are converted with OCR
+            groups: dict[bool, list[int]] = {}
+            for position, (i, routing) in enumerate(zip(pending, routings)):
+                routed[i] = [any(routing)] * len(routing) if routing else None
+                groups.setdefault(any(routing) if routing else config.docling_pdf_do_ocr, []).append(position)
+
+            results = [None] * len(pending)
+            cpu_seconds = [0.0] * len(pending)
+            if len(pending) > 0:
+                cost = estimate_cost(sum(files[i]["bytes"] for i in pending))
+                group_usages = [Usage() for _ in groups]
+                async with admission_controller.admit(cost):
+                    group_results = await asyncio.gather(*[
+                        run_converter(convert_batch, [sources[position] for position in positions], content_encoding,
+                                      [streamed_chunks_path(f"{tmp_dir}/{pending[position]}") for position in positions], do_ocr,
+                                      usage=group_usage)
+                        for (do_ocr, positions), group_usage in zip(groups.items(), group_usages)
+                    ])
+                for positions, outputs, group_usage in zip(groups.values(), group_results, group_usages):
+                    # The CPU time of a batch is shared by its documents in proportion to the time spent on each
+                    spent = [sum(output[-1].values()) if not isinstance(output, Exception) else 0 for output in outputs]
+                    for position, output, seconds in zip(positions, outputs, spent):
+                        results[position] = output
+                        cpu_seconds[position] = group_usage.cpu_seconds * seconds / sum(spent) if sum(spent) > 0 else 0
+
+            async def upload_result(i, result, cpu: float):
+                if isinstance(result, Exception):
+                    errors[i] = result
+                    return
+                document, markdown, chunks, chunks_index, embeddings, floating_items, timings = result
+                record_timings(timings, ExtractionBackend.DOCLING)
+                metadata[i] = extraction_metadata(routed[i], embeddings)
+                usages[i] = Usage(cpu_seconds=cpu, pages=len(routed[i]) if routed[i] is not None else None,
+                                  ocr_pages=sum(routed[i]) if routed[i] is not None else None)
+                try:
+                    with stage(UPLOAD, ExtractionBackend.DOCLING):
+                        usages[i].artifact_bytes = await upload_artifacts(s3, artifacts[i], document, markdown, chunks,
+                                                                          chunks_index, embeddings, floating_items, content_encoding)
+                except Exception as e:
+                    errors[i] = e
+            await asyncio.gather(*[upload_result(i, result, cpu) for i, result, cpu in zip(pending, results, cpu_seconds)])
+
+    succeeded = [i for i in range(len(files)) if errors[i] is None]
+    if len(succeeded) > 0:
+        with stage(MONGO_UPDATE, ExtractionBackend.DOCLING):
+            result = await database.get_collection('file').bulk_write([
+                UpdateOne({"_id": files[i]["_id"]}, extraction_update(
+                    artifacts[i], content_encoding, metadata[i]))
+                for i in succeeded
+            ], ordered=False)
+        succeeded = await fail_removed_files(files, succeeded, errors, result.matched_count)
+        for i in succeeded:
+            usage_recorder.record(files[i], ExtractionBackend.DOCLING, usages[i], cached[i] is not None)
+        await asyncio.gather(*[
+            store_in_cache(files[i], ExtractionBackend.DOCLING, options, artifacts[i], metadata[i])
+            for i in succeeded if cached[i] is None
+        ])
+    return errors
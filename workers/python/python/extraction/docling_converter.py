@@ -0,0 +1,378 @@
+# Copyright 2024 IBM Corp.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import threading
+import time
+from contextlib import nullcontext
+from functools import wraps
+from io import BytesIO
+from typing import Iterable, Optional
+
+from docling.datamodel.base_models import ConversionStatus, InputFormat
+from docling.document_converter import DocumentConverter, PdfFormatOption
+from docling_core.transforms.chunker.hierarchical_chunker import HierarchicalChunker
+from docling_core.transforms.chunker.hybrid_chunker import HybridChunker
+from docling.datamodel.pipeline_options import PdfPipelineOptions
+from docling_core.types.io import DocumentStream
+import pypdfium2
+import pypdfium2.raw as pdfium_c
+
+from config import config
+from chunk_index import ChunkIndex
+from encoding import compress, encode_json, write_ndjson
+from extraction.embeddings import EMBEDDING_MODEL, encode_embeddings, init_embedder
+from extraction.floating_items import encode_floating_items
+from extraction.shards import merge_documents, merge_short_runs, offset_pages
+from stages import CHUNK, CONVERT, EMBED, SERIALIZE, timed
+
+# This module is imported by the conversion worker processes, keep it free of database and queue imports.
+
+try:
+    # Docling takes this lock around its own calls into PDFium, which is not thread-safe
+    from docling.utils.locks import pypdfium2_lock
+    DOCLING_LOCKS_PDFIUM = True
+except ImportError:
+    pypdfium2_lock = threading.Lock()
+    DOCLING_LOCKS_PDFIUM = False
+
+# Converters by whether they OCR PDF pages
+converters: dict[bool, DocumentConverter] = {}
+chunker: HybridChunker | HierarchicalChunker | None = None
+
+
+def create_converter(do_ocr: bool):
+    return DocumentConverter(format_options={
+        InputFormat.PDF: PdfFormatOption(
+            pipeline_options=PdfPipelineOptions(
+                do_table_structure=config.docling_do_table_structure,
+                do_ocr=do_ocr)
+        )
+    })
+
+
+def get_converter(do_ocr: bool):
+    if do_ocr not in converters:
+        converter = create_converter(do_ocr)
+        # Pipelines are created lazily by docling, build the PDF one upfront so that the first job finds it warm.
+        converter.initialize_pipeline(InputFormat.PDF)
+        converters[do_ocr] = converter
+    return converters[do_ocr]
+
+
+def create_chunker():
+    return HybridChunker(
+        tokenizer=EMBEDDING_MODEL) if config.docling_advanced_chunker else HierarchicalChunker()
+
+
+def init_converter():
+    """
+    Load the converter, chunker and embedding model, used as the initializer of the conversion processes.
+    """
+    global chunker
+    get_converter(config.docling_pdf_do_ocr)
+    if config.docling_pdf_do_ocr and config.docling_adaptive_ocr:
+        get_converter(False)
+    if chunker is None:
+        chunker = create_chunker()
+    if config.docling_embeddings:
+        init_embedder(chunker._tokenizer if isinstance(chunker, HybridChunker) else None)
+
+
+def pdfium_locked(func):
+    @wraps(func)
+    def locked(*args, **kwargs):
+        with pypdfium2_lock:
+            return func(*args, **kwargs)
+    return locked
+
+
+def pdfium_conversion():
+    # Docling versions without the lock call PDFium unguarded, conversions then hold ours for their whole duration
+    return nullcontext() if DOCLING_LOCKS_PDFIUM else pypdfium2_lock
+
+
+@pdfium_locked
+def blank_pdf():
+    pdf = pypdfium2.PdfDocument.new()
+    try:
+        pdf.new_page(612, 792)
+        buffer = BytesIO()
+        pdf.save(buffer)
+        return buffer.getvalue()
+    finally:
+        pdf.close()
+
+
+def warm_up():
+    """
+    Load the converter, chunker and embedding model, then run them once on a blank page
+    so that lazily initialized models and runtimes are ready for the first job.
+
+    Returns the time spent on each step, used as the initializer of the conversion processes when warming up.
+    """
+    timings = {}
+    with timed(timings, "load"):
+        init_converter()
+    source = blank_pdf()
+    for do_ocr, converter in list(converters.items()):
+        with timed(timings, "convert_ocr" if do_ocr else "convert"), pdfium_conversion():
+            doc = converter.convert(DocumentStream(
+                name="warm-up.pdf", stream=BytesIO(source))).document
+    with timed(timings, "chunk"):
+        chunks = [serialize_chunk(c) for c in chunker.chunk(doc)]
+        # A blank page has no chunks, the tokenizer is called once on its own
+        create_chunk_index(b"").add("warm up", [], [])
+    if config.docling_embeddings:
+        with timed(timings, "embed"):
+            encode_embeddings([chunk["text"] for chunk in chunks] or ["warm up"])
+    return timings
+
+
+def serialize_chunk(chunk, page_offset: int = 0):
+    pages = sorted({prov.page_no + page_offset
+                   for item in chunk.meta.doc_items for prov in item.prov})
+    return {"text": chunk.text, "pages": pages, "headings": chunk.meta.headings or []}
+
+
+def encode_chunks(chunks: Iterable[dict], content_encoding: Optional[str] = None, chunks_path: Optional[str] = None):
+    """
+    Encode chunks as a JSON list, or stream them into chunks_path as NDJSON when given, returning the path.
+    """
+    if chunks_path is None:
+        return encode_json(list(chunks), content_encoding)
+    write_ndjson(chunks_path, chunks, content_encoding)
+    return chunks_path
+
+
+def collect_texts(chunks: Iterable[dict], texts: list[str]):
+    for chunk in chunks:
+        texts.append(chunk["text"])
+        yield chunk
+
+
+def create_chunk_index(text: bytes):
+    if isinstance(chunker, HybridChunker):
+        tokenizer = chunker._tokenizer
+        return ChunkIndex(text, lambda chunk_text: len(tokenizer.tokenize(chunk_text, max_length=None)), EMBEDDING_MODEL)
+    return ChunkIndex(text)
+
+
+def encode_chunk_artifacts(chunks: Iterable[dict], text: bytes, timings: dict[str, float], content_encoding: Optional[str] = None,
+                           chunks_path: Optional[str] = None):
+    """
+    Encode chunks like encode_chunks along with their index into the text,
+    and embed their texts when embeddings are enabled, None otherwise.
+    """
+    index = create_chunk_index(text)
+    texts = []
+    with timed(timings, CHUNK):
+        chunks = index.track(chunks)
+        if config.docling_embeddings:
+            chunks = collect_texts(chunks, texts)
+        encoded = encode_chunks(chunks, content_encoding, chunks_path)
+        encoded_index = index.encode()
+    if not config.docling_embeddings:
+        return encoded, encoded_index, None
+    with timed(timings, EMBED):
+        embeddings = encode_embeddings(texts)
+    return encoded, encoded_index, embeddings
+
+
+def convert_document(source_doc: str | DocumentStream, max_num_pages: int, max_file_size: int, do_ocr: bool):
+    init_converter()
+    with pdfium_conversion():
+        result = get_converter(do_ocr).convert(
+            source_doc, max_num_pages=max_num_pages, max_file_size=max_file_size)
+    return result.document
+
+
+def export(doc, timings: dict[str, float], content_encoding: Optional[str] = None, chunks_path: Optional[str] = None):
+    with timed(timings, SERIALIZE):
+        serialized = doc.export_to_dict()
+        document = encode_json(serialized, content_encoding)
+        floating_items = encode_floating_items(serialized, content_encoding)
+        text = doc.export_to_markdown().encode("utf-8")
+        markdown = compress(text, content_encoding)
+    chunks, chunks_index, embeddings = encode_chunk_artifacts(
+        (serialize_chunk(c) for c in chunker.chunk(doc)), text, timings, content_encoding, chunks_path)
+    return document, markdown, chunks, chunks_index, embeddings, floating_items, timings
+
+
+def convert(source_doc: str | DocumentStream, content_encoding: Optional[str] = None, chunks_path: Optional[str] = None, do_ocr: bool = config.docling_pdf_do_ocr):
+    """
+    Convert and chunk the document, returning the encoded artifacts (document JSON, markdown, chunks, chunk index),
+    the chunk embeddings when enabled, the tables and figures (tables CSV, tables manifest, figures manifest)
+    and stage timings.
+
+    Serialization happens here so that it stays off the event loop and only bytes cross the process boundary.
+    """
+    timings = {}
+    with timed(timings, CONVERT):
+        doc = convert_document(
+            source_doc, config.docling_max_num_pages, config.docling_max_file_size, do_ocr)
+    return export(doc, timings, content_encoding, chunks_path)
+
+
+def convert_batch(sources: list[str | DocumentStream], content_encoding: Optional[str] = None, chunks_paths: Optional[list[Optional[str]]] = None, do_ocr: bool = config.docling_pdf_do_ocr):
+    """
+    Convert several documents with a single convert_all invocation.
+
+    Returns the encoded artifacts and timings like convert does for each document, or the error of its conversion.
+    """
+    init_converter()
+    chunks_paths = chunks_paths or [None] * len(sources)
+    results = iter(get_converter(do_ocr).convert_all(
+        sources, raises_on_error=False, max_num_pages=config.docling_max_num_pages, max_file_size=config.docling_max_file_size))
+    outputs = []
+    start = time.perf_counter()
+    for chunks_path in chunks_paths:
+        # Documents are converted as the results are iterated
+        with pdfium_conversion():
+            result = next(results, None)
+        if result is None:
+            break
+        timings = {CONVERT: time.perf_counter() - start}
+        if result.status not in (ConversionStatus.SUCCESS, ConversionStatus.PARTIAL_SUCCESS):
+            outputs.append(RuntimeError(
+                f"Conversion failed with status {result.status}"))
+        else:
+            try:
+                outputs.append(
+                    export(result.document, timings, content_encoding, chunks_path))
+            except Exception as e:
+                outputs.append(RuntimeError(str(e)))
+        start = time.perf_counter()
+    if len(outputs) < len(sources):
+        outputs.extend(RuntimeError("Conversion result missing")
+                       for _ in range(len(sources) - len(outputs)))
+    return outputs
+
+
+@pdfium_locked
+def split_pdf(source_doc: str | DocumentStream, ranges: list[tuple[int, int]]) -> list[bytes]:
+    """
+    Split the PDF into documents of the given page ranges.
+    """
+    source = source_doc.stream.getvalue() if isinstance(
+        source_doc, DocumentStream) else source_doc
+    pdf = pypdfium2.PdfDocument(source)
+    try:
+        shards = []
+        for start, end in ranges:
+            shard = pypdfium2.PdfDocument.new()
+            try:
+                shard.import_pages(pdf, list(range(start, end)))
+                buffer = BytesIO()
+                shard.save(buffer)
+                shards.append(buffer.getvalue())
+            finally:
+                shard.close()
+        return shards
+    finally:
+        pdf.close()
+
+
+def convert_shard(source_doc: DocumentStream, page_offset: int, do_ocr: bool = config.docling_pdf_do_ocr):
+    """
+    Convert and chunk a page range of a document, page numbers in the results are relative to the whole document.
+    """
+    timings = {}
+    with timed(timings, CONVERT):
+        doc = convert_document(
+            source_doc, sys.maxsize, sys.maxsize, do_ocr)
+    with timed(timings, CHUNK):
+        chunks = [serialize_chunk(c, page_offset) for c in chunker.chunk(doc)]
+    with timed(timings, SERIALIZE):
+        document = offset_pages(doc.export_to_dict(), page_offset)
+        markdown = doc.export_to_markdown()
+    return document, markdown, chunks, timings
+
+
+def merge_shards(results: list[tuple[dict, str, list, dict[str, float]]], content_encoding: Optional[str] = None, chunks_path: Optional[str] = None):
+    """
+    Merge the results of convert_shard, ordered by page range, and encode them like convert does.
+
+    Timings are summed over the shards.
+    """
+    # Shards restored from checkpoints leave nothing loaded
+    init_converter()
+    timings = {}
+    for *_, shard_timings in results:
+        for name, seconds in shard_timings.items():
+            timings[name] = timings.get(name, 0) + seconds
+    with timed(timings, SERIALIZE):
+        merged = merge_documents([document for document, *_ in results])
+        document = encode_json(merged, content_encoding)
+        floating_items = encode_floating_items(merged, content_encoding)
+        text = "\n\n".join(markdown for _, markdown, *_ in results).encode("utf-8")
+        markdown = compress(text, content_encoding)
+    chunks, chunks_index, embeddings = encode_chunk_artifacts(
+        (chunk for _, _, shard_chunks, _ in results for chunk in shard_chunks), text, timings, content_encoding, chunks_path)
+    return document, markdown, chunks, chunks_index, embeddings, floating_items, timings
+
+
+def needs_ocr(page) -> bool:
+    """
+    A page needs OCR when it has next to no text layer while images cover a part of it, as scanned pages do.
+    """
+    textpage = page.get_textpage()
+    try:
+        if textpage.count_chars() >= config.docling_ocr_min_chars:
+            return False
+    finally:
+        textpage.close()
+    width, height = page.get_size()
+    if width <= 0 or height <= 0:
+        return False
+    image_area = 0
+    for image in page.get_objects(filter=(pdfium_c.FPDF_PAGEOBJ_IMAGE,)):
+        left, bottom, right, top = image.get_pos()
+        image_area += max(min(right, width) - max(left, 0), 0) * \
+            max(min(top, height) - max(bottom, 0), 0)
+    return image_area / (width * height) >= config.docling_ocr_min_image_coverage
+
+
+@pdfium_locked
+def analyze_pages(source_doc: str | DocumentStream) -> Optional[list[bool]]:
+    """
+    Return whether each page of a PDF document needs OCR, None for other formats.
+
+    Pages are only inspected when adaptive OCR is enabled, otherwise they follow docling_pdf_do_ocr.
+    """
+    if isinstance(source_doc, DocumentStream):
+        if not source_doc.name.lower().endswith(".pdf"):
+            return None
+        source = source_doc.stream.getvalue()
+    else:
+        if not source_doc.lower().endswith(".pdf"):
+            return None
+        source = source_doc
+    try:
+        pdf = pypdfium2.PdfDocument(source)
+    except pypdfium2.PdfiumError:
+        return None
+    try:
+        if not (config.docling_pdf_do_ocr and config.docling_adaptive_ocr):
+            return [config.docling_pdf_do_ocr] * len(pdf)
+        ocr_pages = []
+        for index in range(len(pdf)):
+            page = pdf[index]
+            try:
+                ocr_pages.append(needs_ocr(page))
+            finally:
+                page.close()
+        return merge_short_runs(ocr_pages, config.docling_adaptive_ocr_min_pages)
+    finally:
+        pdf.close()
@@ -0,0 +1,71 @@
+# Copyright 2024 IBM Corp.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Optional
+
+import numpy as np
+import torch
+from transformers import AutoModel, AutoTokenizer, PreTrainedTokenizerBase
+
+from config import config
+
+# The chunker sizes chunks with the tokenizer of the same model
+EMBEDDING_MODEL = "BAAI/bge-small-en-v1.5"
+
+DTYPES = {"float32": "<f4", "float16": "<f2"}
+
+model = None
+tokenizer: Optional[PreTrainedTokenizerBase] = None
+
+
+def init_embedder(loaded_tokenizer: Optional[PreTrainedTokenizerBase] = None):
+    """
+    Load the embedding model, reusing the tokenizer already loaded by the chunker when given.
+    """
+    global model, tokenizer
+    if model is not None:
+        return
+    tokenizer = loaded_tokenizer or AutoTokenizer.from_pretrained(EMBEDDING_MODEL)
+    model = AutoModel.from_pretrained(EMBEDDING_MODEL).eval()
+
+
+def embed(texts: list[str]) -> np.ndarray:
+    """
+    Embed the texts into L2 normalized CLS vectors, as bge models are meant to be used.
+
+    Texts are batched by length so that batches carry little padding.
+    """
+    init_embedder()
+    vectors = np.zeros((len(texts), model.config.hidden_size), dtype=np.float32)
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    batch_size = config.docling_embedding_batch_size
+    with torch.inference_mode():
+        for start in range(0, len(order), batch_size):
+            indices = order[start:start + batch_size]
+            inputs = tokenizer([texts[i] for i in indices], padding=True, truncation=True,
+                               max_length=model.config.max_position_embeddings, return_tensors="pt")
+            output = model(**inputs).last_hidden_state[:, 0]
+            vectors[indices] = torch.nn.functional.normalize(output, dim=-1).numpy()
+    return vectors
+
+
+def encode_embeddings(texts: list[str]):
+    """
+    Embed the texts into a row-major little-endian matrix with one row per text.
+    """
+    vectors = embed(texts)
+    return {
+        "vectors": vectors.astype(DTYPES[config.docling_embedding_dtype]).tobytes(),
+        "dimensions": vectors.shape[1]
+    }
@@ -12,14 +12,27 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
+import importlib
 import logging
+import time
+from typing import Optional
 
 from bullmq import Job
 from opentelemetry import trace
 
-from workers import create_worker
+from workers import create_worker, defer_job, queues, wait_for_children
 from enums import ExtractionBackend
 from database import database
+from config import config
+from admission import backend_slot
+from accounting import usage_recorder
+from batching import Batcher
+from lanes import Lane, lane_scheduler
+from quotas import project_quotas
+from profiling import profiler
+from stages import MONGO_FETCH, stage
+from metrics import extraction_jobs, extractions_in_flight, input_bytes
 
 tracer = trace.get_tracer("job-trace")
 
@@ -28,38 +41,306 @@ logger = logging.getLogger()
 EXTRACTION_QUEUE_NAME = "files-extraction-python"
 
 
+async def find_file(file_id):
+    with stage(MONGO_FETCH):
+        file = await database.get_collection('file').find_one({"_id": file_id})
+    if file is None:
+        raise RuntimeError("File not found")
+    return file
+
+
+async def fail_removed_files(files: list, succeeded: list[int], errors: list[Optional[Exception]], matched_count: int) -> list[int]:
+    """
+    Fail the files of a bulk update that matched fewer files than updated, as removed while they were extracted.
+
+    Returns the indices of the files still succeeded.
+    """
+    if matched_count >= len(succeeded):
+        return succeeded
+    found = {file["_id"] for file in await database.get_collection('file').find(
+        {"_id": {"$in": [files[i]["_id"] for i in succeeded]}}, {"_id": 1}).to_list()}
+    for i in succeeded:
+        if files[i]["_id"] not in found:
+            errors[i] = RuntimeError("File not found")
+    return [i for i in succeeded if errors[i] is None]
+
+
+def get_backend(file):
+    extraction = file.get("extraction")
+    if extraction is None:
+        raise RuntimeError("Extraction not found")
+    return extraction.get("backend")
+
+
+async def dispatch(file, backend, job_id):
+    if backend == ExtractionBackend.UNSTRUCTURED_OPENSOURCE or backend == ExtractionBackend.UNSTRUCTURED_API:
+        try:
+            from extraction.unstructured import unstructuredExtraction
+            async with backend_slot(backend):
+                await unstructuredExtraction(file, backend)
+        except ImportError:
+            logger.exception(
+                f"Unable to import unstructured, throwing away job {job_id}")
+            return "discarded"
+    elif backend == ExtractionBackend.DOCLING:
+        try:
+            from extraction.docling import docling_extraction
+            async with backend_slot(backend):
+                await docling_extraction(file)
+        except ImportError:
+            logger.exception(
+                f"Unable to import docling, throwing away job {job_id}")
+            return "discarded"
+    else:
+        raise RuntimeError("Unsupported backend")
+    return "completed"
+
+
+async def extract(file, job_id):
+    backend = get_backend(file)
+    input_bytes.observe(file["bytes"], backend=backend)
+    extractions_in_flight.inc(backend=backend)
+    try:
+        outcome = await dispatch(file, backend, job_id)
+    except Exception:
+        extraction_jobs.inc(backend=backend, outcome="failed")
+        raise
+    finally:
+        extractions_in_flight.dec(backend=backend)
+    extraction_jobs.inc(backend=backend, outcome=outcome)
+
+
+def record_outcomes(backend, errors: list[Optional[Exception]]):
+    for error in errors:
+        extraction_jobs.inc(
+            backend=backend, outcome="completed" if error is None else "failed")
+
+
+async def extract_batch(file_ids: list) -> list[Optional[Exception]]:
+    """
+    Extract files of a batch of jobs, small docling files and unstructured files are processed together, the rest one by one.
+    """
+    with stage(MONGO_FETCH):
+        files = {file["_id"]: file for file in await database.get_collection('file').find({"_id": {"$in": file_ids}}).to_list()}
+    errors: list[Optional[Exception]] = [None] * len(file_ids)
+
+    batched = []
+    batched_unstructured: dict[str, list[int]] = {}
+    for i, file_id in enumerate(file_ids):
+        file = files.get(file_id)
+        try:
+            if file is None:
+                raise RuntimeError("File not found")
+            backend = get_backend(file)
+            if backend == ExtractionBackend.DOCLING and file["bytes"] <= config.s3_in_memory_download_max_size:
+                batched.append(i)
+            elif backend == ExtractionBackend.UNSTRUCTURED_OPENSOURCE or backend == ExtractionBackend.UNSTRUCTURED_API:
+                batched_unstructured.setdefault(backend, []).append(i)
+        except RuntimeError as e:
+            errors[i] = e
+
+    async def extract_single(i):
+        try:
+            await extract(files[file_ids[i]], file_ids[i])
+        except Exception as e:
+            errors[i] = e
+
+    async def extract_batched():
+        if len(batched) == 0:
+            return
+        try:
+            from extraction.docling import docling_extraction_batch
+        except ImportError:
+            logger.exception("Unable to import docling, throwing away batch")
+            extraction_jobs.inc(len(batched), backend=ExtractionBackend.DOCLING, outcome="discarded")
+            return
+        for i in batched:
+            input_bytes.observe(files[file_ids[i]]["bytes"], backend=ExtractionBackend.DOCLING)
+        extractions_in_flight.inc(len(batched), backend=ExtractionBackend.DOCLING)
+        try:
+            async with backend_slot(ExtractionBackend.DOCLING):
+                batch_errors = await docling_extraction_batch([files[file_ids[i]] for i in batched])
+        except Exception as e:
+            batch_errors = [e] * len(batched)
+        finally:
+            extractions_in_flight.dec(len(batched), backend=ExtractionBackend.DOCLING)
+        record_outcomes(ExtractionBackend.DOCLING, batch_errors)
+        for i, error in zip(batched, batch_errors):
+            errors[i] = error
+
+    async def extract_batched_unstructured(backend, indices: list[int]):
+        try:
+            from extraction.unstructured import extract_files
+        except ImportError:
+            logger.exception(
+                "Unable to import unstructured, throwing away batch")
+            extraction_jobs.inc(len(indices), backend=backend, outcome="discarded")
+            return
+        for i in indices:
+            input_bytes.observe(files[file_ids[i]]["bytes"], backend=backend)
+        extractions_in_flight.inc(len(indices), backend=backend)
+        try:
+            async with backend_slot(backend):
+                batch_errors = await extract_files([files[file_ids[i]] for i in indices], backend)
+        except Exception as e:
+            batch_errors = [e] * len(indices)
+        finally:
+            extractions_in_flight.dec(len(indices), backend=backend)
+        record_outcomes(backend, batch_errors)
+        for i, error in zip(indices, batch_errors):
+            errors[i] = error
+
+    batched_indices = set(batched).union(*batched_unstructured.values())
+    await asyncio.gather(extract_batched(), *[
+        extract_batched_unstructured(backend, indices) for backend, indices in batched_unstructured.items()
+    ], *[
+        extract_single(i) for i in range(len(file_ids)) if errors[i] is None and i not in batched_indices
+    ])
+    return errors
+
+
+batcher = Batcher(extract_batch, config.extraction_batch_size,
+                  config.extraction_batch_wait_ms / 1000) if config.extraction_batch_size > 1 else None
+
+
+async def run_extraction(file_id, job_id, file=None):
+    if batcher is not None:
+        await batcher.submit(file_id)
+        return
+    await extract(file if file is not None else await find_file(file_id), job_id)
+
+
+def job_file_id(job: Job):
+    file_id = job.data.get('fileId')
+    if file_id is None:
+        raise RuntimeError("fileId not found")
+    return file_id
+
+
+def lane_queue_name(lane: Lane):
+    return f"{EXTRACTION_QUEUE_NAME}-{lane.name}"
+
+
+async def take_quota(job: Job, job_token, span, project: str):
+    # A deferred job comes back with the token it reserved, a retried one takes another
+    if job.data.get("quotaAttempt") == job.attemptsMade:
+        return
+    wait_ms = await project_quotas.take(project)
+    if wait_ms > 0:
+        span.set_attribute("job.deferred", True)
+        await job.updateData({**job.data, "quotaAttempt": job.attemptsMade})
+        await defer_job(job, job_token, wait_ms)
+
+
+async def route_to_lane(job: Job, job_token, file_id, span):
+    """
+    Hand the job over to the queue of its lane as a child job, the job completes or fails along with it.
+    """
+    lane_name = job.data.get("lane")
+    if lane_name is None:
+        lane = lane_scheduler.route(await find_file(file_id))
+        lane_name = lane.name
+        await queues[lane_queue_name(lane)].add(job.name, job.data, {
+            "jobId": job.id,
+            "parent": {"id": job.id, "queue": job.queueQualifiedName},
+            "attempts": job.attempts,
+            "failParentOnFailure": True,
+            # Extracting the file again reuses the job id
+            "removeOnComplete": True,
+            "removeOnFail": True
+        })
+        # Added after the child, the job is fetched again once its child completed
+        await job.updateData({**job.data, "lane": lane_name})
+    span.set_attribute("lane", lane_name)
+    await wait_for_children(job, job_token)
+
+
 async def processExtraction(job: Job, job_token):
     # TODO remove tracing once BULLMQ has instrumentation
     with tracer.start_as_current_span("job") as span:
-        data = job.data
-        file_id = data.get('fileId')
-        if file_id is None:
-            raise RuntimeError("fileId not found")
+        file_id = job_file_id(job)
+        if lane_scheduler.enabled:
+            await route_to_lane(job, job_token, file_id, span)
+            return
 
-        file = await database.get_collection('file').find_one({"_id": file_id})
-        if file is None:
-            raise RuntimeError("File not found")
-        extraction = file.get("extraction")
-        if extraction is None:
-            raise RuntimeError("Extraction not found")
-        backend = extraction.get("backend")
-
-        if backend == ExtractionBackend.UNSTRUCTURED_OPENSOURCE or backend == ExtractionBackend.UNSTRUCTURED_API:
-            try:
-                from extraction.unstructured import unstructuredExtraction
-                await unstructuredExtraction(file, backend)
-            except ImportError:
-                logger.exception(
-                    f"Unable to import unstructured, throwing away job {job.id}")
-        elif backend == ExtractionBackend.DOCLING:
+        with profiler.job(job.id):
+            if not project_quotas.enabled:
+                await run_extraction(file_id, job.id)
+                return
+            file = await find_file(file_id)
+            await take_quota(job, job_token, span, str(file.get("project")))
+            await run_extraction(file_id, job.id, file)
+
+
+def lane_processor(lane: Lane):
+    async def processLaneExtraction(job: Job, job_token):
+        with tracer.start_as_current_span("job") as span, profiler.job(job.id):
+            span.set_attribute("lane", lane.name)
+            file_id = job_file_id(job)
+            file = await find_file(file_id)
+            project = str(file.get("project"))
+            # The lane comes first, a job deferred for its quota keeps the token it reserved
+            if not lane_scheduler.try_acquire(lane, project):
+                span.set_attribute("job.deferred", True)
+                await defer_job(job, job_token, config.extraction_lane_defer_ms)
             try:
-                from extraction.docling import docling_extraction
-                await docling_extraction(file)
-            except ImportError:
-                logger.exception(
-                    f"Unable to import docling, throwing away job {job.id}")
-        else:
-            raise RuntimeError("Unsupported backend")
+                await take_quota(job, job_token, span, project)
+                await run_extraction(file_id, job.id, file)
+            finally:
+                lane_scheduler.release(lane, project)
+    return processLaneExtraction
+
+
+async def warm_up_backend(backend) -> dict[str, float]:
+    timings = {}
+    start = time.perf_counter()
+    # Imports run off the event loop so that probes are answered meanwhile
+    if backend == ExtractionBackend.DOCLING:
+        docling = await asyncio.to_thread(importlib.import_module, "extraction.docling")
+        timings["import"] = time.perf_counter() - start
+        return {**timings, **await docling.start_executor()}
+    if backend == ExtractionBackend.UNSTRUCTURED_OPENSOURCE or backend == ExtractionBackend.UNSTRUCTURED_API:
+        unstructured = await asyncio.to_thread(importlib.import_module, "extraction.unstructured")
+        timings["import"] = time.perf_counter() - start
+        return {**timings, **await unstructured.warm_up(backend)}
+    raise RuntimeError(f"Backend {backend} is not supported by this worker")
+
+
+async def start_extraction():
+    """
+    Load and warm up the backends the worker is configured for, returning the time spent on each step.
+    """
+    backends = list(dict.fromkeys(config.extraction_warm_up_backends))
+    if config.docling_process_pool_size > 0 and ExtractionBackend.DOCLING not in backends:
+        backends.append(ExtractionBackend.DOCLING)
+    steps = {}
+    for backend in backends:
+        try:
+            timings = await warm_up_backend(backend)
+        except ImportError:
+            logger.exception(f"Unable to import {backend}, not warmed up")
+            continue
+        steps.update({f"{backend}.{name}": seconds for name, seconds in timings.items()})
+        logger.info(f"Backend {backend} warmed up in {sum(timings.values()):.1f}s: " +
+                    ", ".join(f"{name} {seconds:.1f}s" for name, seconds in timings.items()))
+    return steps
+
+
+async def shutdown_extraction():
+    await usage_recorder.close()
+    if config.docling_process_pool_size > 0:
+        try:
+            from extraction.docling import shutdown_executor
+            await asyncio.to_thread(shutdown_executor)
+        except ImportError:
+            pass
+
 
+extractionWorker = create_worker(EXTRACTION_QUEUE_NAME, processExtraction, {
+    # Let the process pool be saturated by concurrent jobs and batches be filled, with lanes the jobs are only routed here
+    "concurrency": max(config.docling_process_pool_size, config.extraction_batch_size, lane_scheduler.capacity, 1)
+}, on_startup=start_extraction, on_shutdown=shutdown_extraction)
 
-extractionWorker = create_worker(EXTRACTION_QUEUE_NAME, processExtraction, {})
+# Each lane takes its jobs from a queue of its own, so that a full lane does not hold up the others
+laneWorkers = [create_worker(lane_queue_name(lane), lane_processor(lane), {"concurrency": lane.capacity},
+                             run_with=EXTRACTION_QUEUE_NAME) for lane in lane_scheduler.lanes]
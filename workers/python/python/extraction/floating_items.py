@@ -0,0 +1,130 @@
+# Copyright 2024 IBM Corp.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import csv
+from io import StringIO
+from typing import Optional
+
+from encoding import compress, encode_json
+
+# Tables and pictures of serialized docling documents, exported on their own so that readers
+# don't have to load the whole document model for them.
+#
+# Tables are written as CSV blocks, one per table, concatenated into a single artifact. The tables manifest lists
+# the byte range of each block in the stored artifact; with content encoding, each block is a separate gzip member,
+# so ranges decode on their own while the whole artifact still decodes as one stream.
+
+REF_PREFIX = "#/"
+
+
+def resolve_text(document: dict, ref: dict) -> str:
+    parts = ref.get("$ref", "").removeprefix(REF_PREFIX).split("/")
+    if len(parts) != 2 or parts[0] != "texts":
+        return ""
+    texts = document.get("texts", [])
+    index = int(parts[1])
+    return texts[index].get("text", "") if index < len(texts) else ""
+
+
+def caption(document: dict, item: dict) -> str:
+    return " ".join(text for text in (resolve_text(document, ref) for ref in item.get("captions", [])) if text)
+
+
+def location(item: dict):
+    provs = item.get("prov", [])
+    return {
+        "pages": sorted({prov["page_no"] for prov in provs}),
+        "bbox": provs[0]["bbox"] if len(provs) > 0 else None
+    }
+
+
+def table_grid(data: dict) -> list[list[Optional[dict]]]:
+    """
+    Lay the cells out on the rows and columns of the table, spanning cells fill every position they span.
+    """
+    rows = data.get("num_rows", 0)
+    columns = data.get("num_cols", 0)
+    grid: list[list[Optional[dict]]] = [[None] * columns for _ in range(rows)]
+    for cell in data.get("table_cells", []):
+        for i in range(min(cell["start_row_offset_idx"], rows), min(cell["end_row_offset_idx"], rows)):
+            for j in range(min(cell["start_col_offset_idx"], columns), min(cell["end_col_offset_idx"], columns)):
+                grid[i][j] = cell
+    return grid
+
+
+def header_rows(grid: list[list[Optional[dict]]]) -> int:
+    count = 0
+    for row in grid:
+        if not any(cell is not None and cell.get("column_header", False) for cell in row):
+            break
+        count += 1
+    return count
+
+
+def encode_csv(grid: list[list[Optional[dict]]]) -> bytes:
+    buffer = StringIO()
+    csv.writer(buffer).writerows(
+        [cell["text"] if cell is not None else "" for cell in row] for row in grid)
+    return buffer.getvalue().encode("utf-8")
+
+
+def encode_tables(document: dict, content_encoding: Optional[str] = None):
+    blocks = []
+    tables = []
+    offset = 0
+    for table in document.get("tables", []):
+        grid = table_grid(table.get("data", {}))
+        block = compress(encode_csv(grid), content_encoding)
+        tables.append({
+            "ref": table.get("self_ref"),
+            "label": table.get("label"),
+            **location(table),
+            "caption": caption(document, table),
+            "rows": len(grid),
+            "columns": len(grid[0]) if len(grid) > 0 else 0,
+            "headerRows": header_rows(grid),
+            "start": offset,
+            "end": offset + len(block)
+        })
+        blocks.append(block)
+        offset += len(block)
+    # An empty body would not decode with content encoding
+    body = b"".join(blocks) if len(blocks) > 0 else compress(b"", content_encoding)
+    return body, encode_json({"tables": tables}, content_encoding)
+
+
+def describe_picture(document: dict, picture: dict):
+    figure = {
+        "ref": picture.get("self_ref"),
+        "label": picture.get("label"),
+        **location(picture),
+        "caption": caption(document, picture)
+    }
+    for annotation in picture.get("annotations", []):
+        if annotation.get("kind") == "classification":
+            figure["classes"] = [{"name": predicted["class_name"], "confidence": predicted["confidence"]}
+                                 for predicted in annotation.get("predicted_classes", [])]
+        elif annotation.get("kind") == "description":
+            figure["description"] = annotation.get("text")
+    return figure
+
+
+def encode_floating_items(document: dict, content_encoding: Optional[str] = None):
+    """
+    Encode the tables as CSV along with their manifest, and the manifest of the figures with their captions.
+    """
+    tables, tables_manifest = encode_tables(document, content_encoding)
+    figures = encode_json({"figures": [describe_picture(document, picture)
+                          for picture in document.get("pictures", [])]}, content_encoding)
+    return tables, tables_manifest, figures
@@ -0,0 +1,97 @@
+# Copyright 2024 IBM Corp.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Shards are page ranges of a document converted on their own, merged back into a single serialized document.
+# Kept free of docling imports, the documents are handled in their serialized form.
+
+REF_PREFIX = "#/"
+ITEM_LISTS = ("groups", "texts", "pictures", "tables", "key_value_items")
+
+
+def plan_shards(ocr_pages: list[bool], shard_pages: int) -> list[tuple[int, int, bool]]:
+    """
+    Split the pages into ranges of pages with the same OCR routing, of at most shard_pages pages when above 0.
+
+    Returns the start, end and OCR routing of each range.
+    """
+    shards = []
+    start = 0
+    for page in range(1, len(ocr_pages) + 1):
+        if page == len(ocr_pages) or ocr_pages[page] != ocr_pages[start] or (0 < shard_pages <= page - start):
+            shards.append((start, page, ocr_pages[start]))
+            start = page
+    return shards
+
+
+def merge_short_runs(ocr_pages: list[bool], min_pages: int) -> list[bool]:
+    """
+    Route runs of fewer than min_pages pages like the pages before them, the first run like the pages after it.
+    """
+    runs = plan_shards(ocr_pages, 0)
+    merged = []
+    for index, (start, end, do_ocr) in enumerate(runs):
+        if end - start < min_pages and len(runs) > 1:
+            do_ocr = merged[-1] if len(merged) > 0 else runs[index + 1][2]
+        merged.extend([do_ocr] * (end - start))
+    return merged
+
+
+def offset_pages(document: dict, page_offset: int):
+    if page_offset == 0:
+        return document
+    document["pages"] = {
+        str(int(page_no) + page_offset): {**page, "page_no": page["page_no"] + page_offset} for page_no, page in document.get("pages", {}).items()
+    }
+    for list_name in ITEM_LISTS:
+        for item in document.get(list_name, []):
+            for prov in item.get("prov", []):
+                prov["page_no"] += page_offset
+    return document
+
+
+def rebase_refs(value, offsets: dict[str, int]):
+    """
+    Shift JSON pointers of the document items by the sizes of the item lists they are appended to.
+    """
+    if isinstance(value, dict):
+        return {key: rebase_ref(item, offsets) if key in ("$ref", "self_ref") else rebase_refs(item, offsets) for key, item in value.items()}
+    if isinstance(value, list):
+        return [rebase_refs(item, offsets) for item in value]
+    return value
+
+
+def rebase_ref(ref: str, offsets: dict[str, int]):
+    parts = ref.removeprefix(REF_PREFIX).split("/")
+    if len(parts) != 2 or parts[0] not in offsets:
+        return ref
+    return f"{REF_PREFIX}{parts[0]}/{int(parts[1]) + offsets[parts[0]]}"
+
+
+def merge_documents(documents: list[dict]):
+    """
+    Merge serialized documents of consecutive page ranges into a single document.
+    """
+    merged = documents[0]
+    for document in documents[1:]:
+        offsets = {list_name: len(merged.get(list_name, []))
+                   for list_name in ITEM_LISTS}
+        document = rebase_refs(document, offsets)
+        for list_name in ITEM_LISTS:
+            merged.setdefault(list_name, []).extend(
+                document.get(list_name, []))
+        for root in ("body", "furniture"):
+            merged[root].setdefault("children", []).extend(
+                document[root].get("children", []))
+        merged.setdefault("pages", {}).update(document.get("pages", {}))
+    return merged
@@ -13,30 +13,141 @@
 # limitations under the License.
 
 import asyncio
+import importlib
+import json
+import tempfile
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Generator, Optional
+from uuid import NAMESPACE_DNS, uuid5
 
-from unstructured_ingest.v2.pipeline.pipeline import Pipeline
-from unstructured_ingest.v2.interfaces import ProcessorConfig
+from pymongo import UpdateOne
+from unstructured_ingest.v2.pipeline.pipeline import Pipeline, PipelineError
+from unstructured_ingest.v2.interfaces import DownloadResponse, FileData, ProcessorConfig, SourceIdentifiers
 from unstructured_ingest.v2.processes.partitioner import PartitionerConfig
 from unstructured_ingest.v2.processes.connectors.fsspec.s3 import (
-    S3IndexerConfig, S3DownloaderConfig, S3ConnectionConfig, S3AccessConfig)
+    S3Downloader, S3Indexer, S3IndexerConfig, S3DownloaderConfig, S3ConnectionConfig, S3AccessConfig)
 from unstructured_ingest.v2.processes.connectors.fsspec.s3 import (
-    S3ConnectionConfig, S3AccessConfig, S3UploaderConfig)
+    S3ConnectionConfig, S3AccessConfig, S3Uploader, S3UploaderConfig)
 from unstructured_ingest.v2.processes.chunker import ChunkerConfig
 
 from config import config
 from enums import ExtractionBackend
 from database import database
+from admission import admission_controller, estimate_cost
+from accounting import Usage, usage_recorder
+from storage import s3_client
+from disk_cache import disk_cache
+from extraction.cache import restore_from_cache, store_in_cache
+from extraction.extraction import fail_removed_files
+from chunk_index import ChunkIndex
+from encoding import json_encoder
+from stages import CONVERT, MONGO_UPDATE, stage, timed
+from profiling import profiled
 
 EXTRACTION_DIR = "unstructured"
 
 S3_URL = f"s3://{config.s3_bucket_file_storage}"
 
+CHUNKING_STRATEGY = "by_title"
+
+
+@dataclass
+class StorageIdsIndexer(S3Indexer):
+    """
+    Indexes the given storage ids of the file storage bucket instead of listing a prefix.
+    """
+    storage_ids: list[str] = field(default_factory=list)
+    missing: list[str] = field(default_factory=list)
+
+    def get_file_data(self) -> list[dict[str, Any]]:
+        file_data = []
+        self.missing = []
+        for storage_id in self.storage_ids:
+            try:
+                info = self.fs.info(
+                    f"{config.s3_bucket_file_storage}/{storage_id}")
+            except FileNotFoundError:
+                self.missing.append(storage_id)
+                continue
+            file_data.append({**info, "Key": info["name"]})
+        return file_data
+
+    def run(self, **kwargs: Any) -> Generator[FileData, None, None]:
+        for file_data in self.get_file_data():
+            file_path = self.get_path(file_data=file_data)
+            additional_metadata = self.sterilize_info(file_data=file_data)
+            additional_metadata["original_file_path"] = file_path
+            yield FileData(
+                identifier=file_identifier(file_path),
+                connector_type=self.connector_type,
+                # Without rel_path the full path is used for uploads, matching the single file indexing
+                source_identifiers=SourceIdentifiers(
+                    filename=Path(file_path).name,
+                    rel_path=None,
+                    fullpath=file_path,
+                ),
+                metadata=self.get_metadata(file_data=file_data),
+                additional_metadata=additional_metadata,
+                display_name=file_path,
+            )
+
+
+@dataclass
+class CachingS3Downloader(S3Downloader):
+    """
+    Downloads through the disk cache shared with the docling backend, keyed by the ETag found by the indexer.
+    """
+
+    def is_async(self) -> bool:
+        return False
+
+    def run(self, file_data: FileData, **kwargs: Any) -> DownloadResponse:
+        # Paths of the indexer are prefixed by the bucket
+        _, _, storage_id = file_data.additional_metadata["original_file_path"].partition("/")
+        etag = file_data.metadata.version
+        if disk_cache is None or etag is None:
+            return super().run(file_data=file_data, **kwargs)
+        download_path = self.get_download_path(file_data=file_data)
+        download_path.parent.mkdir(parents=True, exist_ok=True)
+        if disk_cache.restore(storage_id, etag, download_path.as_posix()):
+            return self.generate_download_response(file_data=file_data, download_path=download_path)
+        response = super().run(file_data=file_data, **kwargs)
+        disk_cache.put_file(storage_id, etag, download_path.as_posix())
+        return response
 
-async def unstructuredExtraction(file, backend):
-    storage_id = file.get("storageId")
-    if storage_id is None:
-        raise RuntimeError("storageId not found")
 
+@dataclass
+class IndexingS3Uploader(S3Uploader):
+    """
+    Re-encodes the chunk elements compactly and uploads them along with their index,
+    writing the usage of each file to usage_dir under its identifier for the worker to read after the run.
+    """
+    usage_dir: str = ""
+
+    def index(self, path: Path, file_data: FileData):
+        elements, chunks_index, last_page = index_elements(path.read_bytes())
+        path.write_bytes(elements)
+        upload_path = self.get_upload_path(file_data=file_data)
+        self.fs.write_bytes(path=upload_path.with_suffix(".idx").as_posix(), value=chunks_index)
+        Path(self.usage_dir, f"{file_data.identifier}.json").write_text(json.dumps(
+            {"pages": last_page, "artifact_bytes": len(elements) + len(chunks_index)}))
+
+    def run(self, path: Path, file_data: FileData, **kwargs: Any) -> None:
+        self.index(path, file_data)
+        return super().run(path=path, file_data=file_data, **kwargs)
+
+    async def run_async(self, path: Path, file_data: FileData, **kwargs: Any) -> None:
+        self.index(path, file_data)
+        return await super().run_async(path=path, file_data=file_data, **kwargs)
+
+
+def file_identifier(file_path: str):
+    return str(uuid5(NAMESPACE_DNS, file_path))
+
+
+def create_pipeline(backend):
     s3_connection_config = S3ConnectionConfig(
         endpoint_url=config.s3_endpoint,
         access_config=S3AccessConfig(
@@ -45,8 +156,15 @@ async def unstructuredExtraction(file, backend):
         )
     )
     pipeline = Pipeline.from_configs(
-        context=ProcessorConfig(),
-        indexer_config=S3IndexerConfig(remote_url=f"{S3_URL}/{storage_id}"),
+        context=ProcessorConfig(
+            work_dir=tempfile.mkdtemp(prefix=f"{backend}-"),
+            # Intermediate results are not reused across runs of the long-lived pipeline
+            delete_cache=True,
+            num_processes=config.unstructured_num_processes,
+            disable_parallelism=config.unstructured_num_processes <= 1,
+            max_connections=config.unstructured_max_connections
+        ),
+        indexer_config=S3IndexerConfig(remote_url=S3_URL),
         downloader_config=S3DownloaderConfig(),
         source_connection_config=s3_connection_config,
         partitioner_config=PartitionerConfig(
@@ -58,15 +176,172 @@ async def unstructuredExtraction(file, backend):
             chunk_by_api=backend == ExtractionBackend.UNSTRUCTURED_API,
             chunking_endpoint=config.unstructured_api_url,
             chunk_api_key=config.unstructured_api_key,
-            chunking_strategy="by_title",
+            chunking_strategy=CHUNKING_STRATEGY,
         ),
         destination_connection_config=s3_connection_config,
         uploader_config=S3UploaderConfig(
             remote_url=f"{S3_URL}/{EXTRACTION_DIR}")
     )
-    await asyncio.to_thread(pipeline.run)
+    indexer = pipeline.indexer_step.process
+    pipeline.indexer_step.process = StorageIdsIndexer(
+        index_config=indexer.index_config, connection_config=indexer.connection_config)
+    downloader = pipeline.downloader_step.process
+    pipeline.downloader_step.process = CachingS3Downloader(
+        connection_config=downloader.connection_config, download_config=downloader.download_config)
+    uploader = pipeline.uploader_step.process
+    pipeline.uploader_step.process = IndexingS3Uploader(
+        connection_config=uploader.connection_config, upload_config=uploader.upload_config,
+        usage_dir=tempfile.mkdtemp(prefix=f"{backend}-usage-"))
+    return pipeline
+
+
+# Idle pipelines by backend. Pipelines are built once and reused, each runs one set of files at a time in its own
+# work_dir, so that as many are built as runs of the backend overlap, at most the backend concurrency when configured.
+idle_pipelines: dict[str, list[Pipeline]] = {}
+
+
+@asynccontextmanager
+async def acquire_pipeline(backend):
+    idle = idle_pipelines.setdefault(backend, [])
+    pipeline = idle.pop() if len(idle) > 0 else await asyncio.to_thread(create_pipeline, backend)
+    try:
+        yield pipeline
+    finally:
+        idle.append(pipeline)
+
+
+async def warm_up(backend) -> dict[str, float]:
+    """
+    Build the pipelines of the backend and load the partitioning libraries before the first job.
+    """
+    timings = {}
+    with timed(timings, "pipeline"):
+        size = config.extraction_backend_concurrency.get(backend, 1)
+        pipelines = await asyncio.to_thread(lambda: [create_pipeline(backend) for _ in range(size)])
+        idle_pipelines.setdefault(backend, []).extend(pipelines)
+    if backend == ExtractionBackend.UNSTRUCTURED_OPENSOURCE:
+        with timed(timings, "partition"):
+            await asyncio.to_thread(importlib.import_module, "unstructured.partition.auto")
+    return timings
+
+
+def run_pipeline(pipeline: Pipeline, storage_ids: list[str]) -> tuple[dict[str, Any], dict[str, Usage]]:
+    """
+    Process the files in a single pipeline run, returning the failures and the usage of the other files by storage id.
+
+    Files fail together when the run fails as a whole, e.g. on a failed precheck or connection.
+    """
+    pipeline.indexer_step.process.storage_ids = storage_ids
+    # Statuses are left over by the previous run when this one fails before starting
+    pipeline.context.status = {}
+    try:
+        pipeline.run()
+    except Exception as e:
+        if not isinstance(e, PipelineError) or not pipeline.context.status:
+            return {storage_id: f"[{type(e).__name__}] {e}" for storage_id in storage_ids}, {}
+    status = dict(pipeline.context.status)
+    failures = {}
+    usages = {}
+    for storage_id in storage_ids:
+        identifier = file_identifier(f"{config.s3_bucket_file_storage}/{storage_id}")
+        usage_path = Path(pipeline.uploader_step.process.usage_dir, f"{identifier}.json")
+        if identifier in status:
+            failures[storage_id] = status[identifier]
+        elif usage_path.exists():
+            # The pipeline partitions in its own processes or remotely, its CPU time is not measured
+            usages[storage_id] = Usage(**json.loads(usage_path.read_text()))
+        else:
+            failures[storage_id] = "extraction not uploaded"
+        usage_path.unlink(missing_ok=True)
+    for storage_id in pipeline.indexer_step.process.missing:
+        failures[storage_id] = "source file not found"
+    return failures, usages
+
+
+def extraction_storage_id(storage_id: str):
+    return f"{EXTRACTION_DIR}/{config.s3_bucket_file_storage}/{storage_id}.json"
+
+
+def artifact_keys(storage_id: str):
+    return {
+        "storageId": extraction_storage_id(storage_id),
+        "chunksIndexStorageId": f"{EXTRACTION_DIR}/{config.s3_bucket_file_storage}/{storage_id}.idx"
+    }
+
+
+def index_elements(body: bytes):
+    """
+    Re-encode the chunk elements compactly and index the byte range of each element in the result.
+
+    Returns the elements, their index and the last page they come from, None when unknown.
+    """
+    index = ChunkIndex()
+    parts = []
+    position = 1
+    last_page = None
+    for element in json.loads(body):
+        encoded = json_encoder.encode(element).encode("utf-8")
+        if len(parts) > 0:
+            position += 1
+        page = element.get("metadata", {}).get("page_number")
+        index.add(element.get("text", ""), [page] if page else [], [], position, position + len(encoded))
+        if page:
+            last_page = max(page, last_page or 0)
+        parts.append(encoded)
+        position += len(encoded)
+    return b"[" + b",".join(parts) + b"]", index.encode(), last_page
+
+
+async def extract_files(files: list, backend) -> list[Optional[Exception]]:
+    """
+    Extract the files in a single pipeline run, returning the error of each file, None when its extraction succeeded.
+    """
+    options = {"chunking_strategy": CHUNKING_STRATEGY}
+    errors: list[Optional[Exception]] = [None] * len(files)
+    artifacts = [artifact_keys(file["storageId"]) for file in files]
+    usages = [Usage() for _ in files]
+
+    async with s3_client() as s3:
+        cached = await asyncio.gather(*[
+            restore_from_cache(s3, file, backend, options, file_artifacts) for file, file_artifacts in zip(files, artifacts)
+        ])
+
+    pending = [file for file, hit in zip(files, cached) if hit is None]
+    if len(pending) > 0:
+        async with acquire_pipeline(backend) as pipeline, admission_controller.admit(estimate_cost(sum(file["bytes"] for file in pending))):
+            # The pipeline downloads, partitions, chunks and uploads in one run
+            with stage(CONVERT, backend):
+                failures, pipeline_usages = await asyncio.to_thread(
+                    profiled(run_pipeline), pipeline, [file["storageId"] for file in pending])
+        for i, file in enumerate(files):
+            if file["storageId"] in failures:
+                errors[i] = RuntimeError(
+                    f"Extraction failed: {failures[file['storageId']]}")
+            elif file["storageId"] in pipeline_usages:
+                usages[i] = pipeline_usages[file["storageId"]]
+
+    succeeded = [i for i in range(len(files)) if errors[i] is None]
+    if len(succeeded) > 0:
+        with stage(MONGO_UPDATE, backend):
+            result = await database.get_collection('file').bulk_write([
+                UpdateOne({"_id": files[i]["_id"]}, {"$set": {
+                          "extraction.jobId": None, **{f"extraction.{field}": key for field, key in artifacts[i].items()}}})
+                for i in succeeded
+            ], ordered=False)
+        succeeded = await fail_removed_files(files, succeeded, errors, result.matched_count)
+        for i in succeeded:
+            usage_recorder.record(files[i], backend, usages[i], cached[i] is not None)
+        await asyncio.gather(*[
+            store_in_cache(files[i], backend, options, artifacts[i]) for i in succeeded if cached[i] is None
+        ])
+    return errors
+
+
+async def unstructuredExtraction(file, backend):
+    storage_id = file.get("storageId")
+    if storage_id is None:
+        raise RuntimeError("storageId not found")
 
-    result = await database.get_collection('file').update_one(
-        {"_id": file["_id"]}, {"$set": {"extraction.jobId": None, "extraction.storageId": f"{EXTRACTION_DIR}/{config.s3_bucket_file_storage}/{storage_id}.json"}})
-    if result.modified_count == 0:
-        raise RuntimeError("File not found")
+    [error] = await extract_files([file], backend)
+    if error is not None:
+        raise error
@@ -13,6 +13,10 @@
 # limitations under the License.
 
 from docling.document_converter import DocumentConverter, InputFormat
+from transformers import AutoModel, AutoTokenizer
+
+# Same as extraction.embeddings.EMBEDDING_MODEL, the worker configuration is not available at build time
+EMBEDDING_MODEL = "BAAI/bge-small-en-v1.5"
 
 
 def main():
@@ -25,5 +29,9 @@ def main():
     for format in InputFormat:
         converter.initialize_pipeline(format)
 
+    # Chunker tokenizer and embedding model
+    AutoTokenizer.from_pretrained(EMBEDDING_MODEL)
+    AutoModel.from_pretrained(EMBEDDING_MODEL)
+
 if __name__ == "__main__":
     main()
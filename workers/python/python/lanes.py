@@ -0,0 +1,110 @@
+# Copyright 2024 IBM Corp.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+from config import config
+from metrics import Gauge
+
+
+@dataclass
+class Lane:
+    name: str
+    capacity: int
+    max_bytes: Optional[int] = None
+    mime_types: Optional[set[str]] = None
+    in_flight: dict[str, int] = field(default_factory=dict)
+    # Last time each project had a job in the lane
+    demand: dict[str, float] = field(default_factory=dict)
+
+    def accepts(self, file) -> bool:
+        if self.max_bytes is not None and file["bytes"] > self.max_bytes:
+            return False
+        if self.mime_types is not None and file.get("mimeType") not in self.mime_types:
+            return False
+        return True
+
+    def total(self):
+        return sum(self.in_flight.values())
+
+    def share(self, now: float, window: float):
+        """
+        Slots each project may hold, the capacity is split evenly among projects with recent demand.
+        """
+        for project, seen in list(self.demand.items()):
+            if now - seen > window and self.in_flight.get(project, 0) == 0:
+                del self.demand[project]
+        return max(math.ceil(self.capacity / max(len(self.demand), 1)), 1)
+
+
+class LaneScheduler:
+    """
+    Routes jobs to lanes by file size, mime type and project, each lane with its own queue and capacity.
+
+    Within a lane, projects get an even share of the capacity while other projects are waiting for it.
+    Jobs over the share of their project are deferred by the caller instead of holding a worker slot.
+    """
+
+    def __init__(self, lanes: list[Lane], project_lanes: dict[str, str], demand_window: float):
+        self.lanes = lanes
+        self.by_name = {lane.name: lane for lane in lanes}
+        self.project_lanes = project_lanes
+        self.demand_window = demand_window
+
+    @property
+    def enabled(self):
+        return len(self.lanes) > 0
+
+    @property
+    def capacity(self):
+        return sum(lane.capacity for lane in self.lanes)
+
+    def route(self, file) -> Lane:
+        pinned = self.project_lanes.get(str(file.get("project")))
+        if pinned in self.by_name:
+            return self.by_name[pinned]
+        for lane in self.lanes[:-1]:
+            if lane.accepts(file):
+                return lane
+        return self.lanes[-1]
+
+    def try_acquire(self, lane: Lane, project: str) -> bool:
+        now = time.monotonic()
+        lane.demand[project] = now
+        in_flight = lane.in_flight.get(project, 0)
+        if lane.total() >= lane.capacity or in_flight >= lane.share(now, self.demand_window):
+            return False
+        lane.in_flight[project] = in_flight + 1
+        return True
+
+    def release(self, lane: Lane, project: str):
+        lane.in_flight[project] -= 1
+        lane.demand[project] = time.monotonic()
+        if lane.in_flight[project] == 0:
+            del lane.in_flight[project]
+
+
+lane_scheduler = LaneScheduler([
+    Lane(name, capacity, config.extraction_lane_max_bytes.get(name),
+         config.extraction_lane_mime_types.get(name))
+    for name, capacity in config.extraction_lanes.items()
+], config.extraction_project_lanes, config.extraction_lane_demand_window_seconds)
+
+lane_jobs = Gauge("extraction_lane_jobs", "Jobs in progress by lane.", ("lane",),
+                  collect=lambda: {(lane.name,): lane.total() for lane in lane_scheduler.lanes})
+lane_projects = Gauge("extraction_lane_projects", "Projects sharing the lane.", ("lane",),
+                      collect=lambda: {(lane.name,): len(lane.demand) for lane in lane_scheduler.lanes})
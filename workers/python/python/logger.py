@@ -12,12 +12,90 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
+import copy
 import logging
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+from opentelemetry import context
 
 from config import config
 from telemetry import logging_handler
 
 
+def parse_level(level: str):
+    return logging.DEBUG if level == 'trace' else level.upper()
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Let through at most limit records of each call site and level per window.
+
+    The first record of the next window reports how many were dropped.
+    """
+
+    def __init__(self, limit: int, window: float):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        # Window start, records seen and records dropped by call site
+        self.sites: dict[tuple, list] = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord):
+        key = (record.pathname, record.lineno, record.levelno)
+        now = time.monotonic()
+        with self.lock:
+            site = self.sites.get(key)
+            if site is None or now - site[0] >= self.window:
+                dropped = site[2] if site is not None else 0
+                self.sites[key] = [now, 1, 0]
+            elif site[1] < self.limit:
+                site[1] += 1
+                return True
+            else:
+                site[2] += 1
+                return False
+        if dropped > 0 and isinstance(record.msg, str):
+            record.msg = f"{record.msg} ({dropped} similar records dropped)"
+        return True
+
+
+class LocalQueueHandler(QueueHandler):
+    """
+    Queue handler for listeners of the same process, records keep their exception info for the handlers
+    and the context they were logged in.
+    """
+
+    def prepare(self, record: logging.LogRecord):
+        # Arguments may change once the call returns, the message is rendered upfront
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        # The current span is read by the OpenTelemetry handler on the listener thread
+        record.otel_context = context.get_current()
+        return record
+
+
 def setup_logging():
-    logging.basicConfig(level=logging.DEBUG if config.log_level ==
-                        'trace' else config.log_level.upper(), handlers=[logging_handler, logging.StreamHandler()])
+    """
+    Log through a queue so that the handlers run on a background thread instead of the event loop and conversion threads.
+    """
+    records = queue.SimpleQueue()
+    handler = LocalQueueHandler(records)
+    if config.log_rate_limit > 0:
+        handler.addFilter(RateLimitFilter(
+            config.log_rate_limit, config.log_rate_limit_window_seconds))
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    listener = QueueListener(
+        records, logging_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    logging.basicConfig(level=parse_level(config.log_level), handlers=[handler])
+    for name, level in config.log_levels.items():
+        logging.getLogger(name).setLevel(parse_level(level))
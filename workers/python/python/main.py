@@ -17,12 +17,15 @@ from logger import setup_logging
 from telemetry import setup_telemetry
 
 import asyncio
+import hmac
 import signal
 from aiohttp import web
-from bullmq import Worker
 
-from workers import run_workers, shutdown_workers
+from workers import is_live, is_ready, queue_load, run_workers, shutdown_workers, warm_up_state, with_followers, workers
+from storage import start_storage, stop_storage
 from config import config
+import metrics
+from profiling import dump_stacks, profiler
 
 logger = logging.getLogger()
 
@@ -40,6 +43,16 @@ async def create_shudown_event():
     return shutdown_event
 
 
+async def create_storage():
+    await start_storage()
+    logger.info("Storage client started")
+
+    async def stop():
+        await stop_storage()
+        logger.info("Storage client shut down successfully.")
+    return stop
+
+
 async def create_workers():
     runners = await run_workers(config.run_bullmq_workers)
     logger.info("Workers started")
@@ -47,22 +60,86 @@ async def create_workers():
     async def stop_workers():
         await shutdown_workers(runners)
         logger.info("Workers shut down successfully.")
-    return ([worker for worker, _ in runners], stop_workers)
-
-
-async def create_web_app(workers: list[Worker]):
+    return stop_workers
+
+
+def create_admin_routes():
+    def admin(handler):
+        async def authorized_handler(request):
+            if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {config.admin_token}"):
+                return web.Response(status=401)
+            return await handler(request)
+        return authorized_handler
+
+    async def profiling_status(request):
+        return web.json_response(profiler.status())
+
+    async def start_profiling(request):
+        try:
+            body = await request.json() if request.can_read_body else {}
+        except ValueError:
+            return web.json_response({"error": "Invalid JSON body"}, status=400)
+        if not isinstance(body, dict):
+            return web.json_response({"error": "Expected a JSON object"}, status=400)
+        if profiler.session is not None:
+            return web.json_response({"error": "A profiling session is already running"}, status=409)
+        try:
+            session = profiler.start(body.get("mode", "sample"), body.get("jobs"), body.get("seconds"))
+        except ValueError as e:
+            return web.json_response({"error": str(e)}, status=400)
+        return web.json_response(session.status(), status=201)
+
+    async def stop_profiling(request):
+        session = profiler.stop()
+        if session is None:
+            return web.json_response({"error": "No profiling session is running"}, status=404)
+        return web.json_response(session.status())
+
+    async def stacks(request):
+        return web.Response(text=dump_stacks())
+
+    return [web.get('/admin/profiling', admin(profiling_status)),
+            web.post('/admin/profiling', admin(start_profiling)),
+            web.delete('/admin/profiling', admin(stop_profiling)),
+            web.get('/admin/stacks', admin(stacks))]
+
+
+async def create_web_app():
     async def healthcheck(request):
         healthy = True
-        for worker in workers:
-            if not worker.running:
+        for name, state in warm_up_state.items():
+            if state == "ready" and not workers[name].running:
                 healthy = False
         if healthy:
             return web.Response(status=200)
         else:
             return web.Response(status=503)
 
+    async def liveness(request):
+        return web.Response(status=200 if is_live() else 503)
+
+    async def readiness(request):
+        return web.Response(status=200 if is_ready() else 503)
+
+    async def load(request):
+        names = [name for name in with_followers(config.run_bullmq_workers) if name in workers]
+        loads = await asyncio.gather(*[queue_load(name) for name in names])
+        return web.json_response({
+            "ready": is_ready(),
+            "queues": dict(zip(names, loads))
+        })
+
+    async def metrics_handler(request):
+        return web.Response(body=metrics.render().encode("utf-8"), headers={"Content-Type": metrics.CONTENT_TYPE})
+
     app = web.Application()
-    app.add_routes([web.get('/health', healthcheck)])
+    app.add_routes([web.get('/health', healthcheck),
+                   web.get('/live', liveness),
+                   web.get('/ready', readiness),
+                   web.get('/load', load),
+                   web.get('/metrics', metrics_handler)])
+    if config.admin_token is not None:
+        app.add_routes(create_admin_routes())
     runner = web.AppRunner(app, access_log=None)
     await runner.setup()
     site = web.TCPSite(runner, '0.0.0.0', config.port)
@@ -80,13 +157,16 @@ async def main():
     setup_telemetry()
 
     shutdown_event = await create_shudown_event()
-    workers, stop_workers = await create_workers()
-    stop_web_app = await create_web_app(workers)
+    stop_storage_client = await create_storage()
+    # Serve probes while the workers warm up
+    stop_web_app = await create_web_app()
+    stop_workers = await create_workers()
 
     await shutdown_event.wait()
 
     await stop_workers()
     await stop_web_app()
+    await stop_storage_client()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,177 @@
+# Copyright 2024 IBM Corp.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import math
+import os
+import threading
+from typing import Callable, Optional
+
+import stages
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+registry: list["Metric"] = []
+
+
+def format_value(value: float):
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def escape(value: str):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names: tuple[str, ...], values: tuple[str, ...]):
+    if len(names) == 0:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(str(value))}"' for name, value in zip(names, values)) + "}"
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values: dict[tuple[str, ...], object] = {}
+        # Observations come from the event loop and from worker threads
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def key(self, labels: dict[str, str]):
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def samples(self) -> list[tuple[str, tuple[str, ...], tuple[str, ...], float]]:
+        with self.lock:
+            return [(self.name, self.labels, key, value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} {self.type}"]
+        for name, label_names, label_values, value in self.samples():
+            lines.append(
+                f"{name}{format_labels(label_names, label_values)} {format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Gauge which is either set directly or collected from a function on each scrape.
+    """
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (),
+                 collect: Optional[Callable[[], dict[tuple[str, ...], float]]] = None):
+        super().__init__(name, documentation, labels)
+        self.collect = collect
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.collect is not None:
+            return [(self.name, self.labels, key, value) for key, value in self.collect().items()]
+        return super().samples()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            values = [(key, list(counts), total)
+                      for key, (counts, total) in self.values.items()]
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", self.labels + ("le",),
+                               key + (format_value(bound),), cumulative))
+            samples.append((f"{self.name}_sum", self.labels, key, total))
+            samples.append((f"{self.name}_count", self.labels, key, cumulative))
+        return samples
+
+
+def resident_memory_bytes():
+    try:
+        with open("/proc/self/statm") as statm:
+            return {(): int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")}
+    except (OSError, ValueError):
+        return {}
+
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+stage_seconds = Histogram("extraction_stage_seconds", "Duration of extraction stages.",
+                          ("stage", "backend"), STAGE_BUCKETS)
+extraction_jobs = Counter("extraction_jobs_total", "Extraction jobs by backend and outcome.",
+                          ("backend", "outcome"))
+extractions_in_flight = Gauge("extraction_in_flight", "Extractions in progress by backend.",
+                              ("backend",))
+input_bytes = Histogram("extraction_input_bytes", "Size of extracted files.", ("backend",),
+                        tuple(2 ** exponent for exponent in range(10, 31, 2)))
+input_pages = Histogram("extraction_input_pages", "Page count of extracted documents.", ("backend",),
+                        (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+worker_jobs = Counter("worker_jobs_total", "Jobs finished by queue and outcome.",
+                      ("queue", "outcome"))
+process_memory = Gauge("process_resident_memory_bytes", "Resident memory size in bytes.",
+                       collect=resident_memory_bytes)
+
+
+def observe_stage(name: str, backend: Optional[str], seconds: float):
+    stage_seconds.observe(seconds, stage=name, backend=backend or "")
+
+
+stages.observers.append(observe_stage)
+
+
+def render():
+    return "\n".join(metric.render() for metric in registry) + "\n"
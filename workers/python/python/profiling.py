@@ -0,0 +1,328 @@
+# Copyright 2024 IBM Corp.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import cProfile
+import functools
+import io
+import logging
+import math
+import os
+import pstats
+import socket
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Callable, Literal, Optional, get_args
+
+from config import config
+from storage import s3_client, upload
+
+logger = logging.getLogger()
+
+Mode = Literal["sample", "cprofile"]
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_qualname}"
+
+
+def collapse(thread_name: str, frame) -> str:
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ";".join([thread_name, *reversed(names)])
+
+
+class Sampler:
+    """
+    Samples the stacks of all threads at a fixed interval, aggregated in the collapsed stack format of flame graphs.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self.run, name="profiling-sampler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self.stacks[collapse(names.get(ident, str(ident)), frame)] += 1
+            self.samples += 1
+
+    def render(self) -> bytes:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common()).encode("utf-8")
+
+
+def dump_stacks() -> str:
+    """
+    Format the stacks of all threads and of all asyncio tasks of the running loop.
+    """
+    out = io.StringIO()
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    for ident, frame in sys._current_frames().items():
+        out.write(f"Thread {names.get(ident, ident)} ({ident}):\n")
+        out.write("".join(traceback.format_stack(frame)))
+        out.write("\n")
+    try:
+        tasks = asyncio.all_tasks()
+    except RuntimeError:
+        tasks = set()
+    for task in tasks:
+        out.write(f"Task {task.get_name()}:\n")
+        task.print_stack(file=out)
+        out.write("\n")
+    return out.getvalue()
+
+
+def diagnostics_key(name: str):
+    timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    return f"{config.diagnostics_prefix}/{socket.gethostname()}/{timestamp}-{name}"
+
+
+async def upload_diagnostics(files: dict[str, tuple[bytes, str]]):
+    async with s3_client() as s3:
+        await asyncio.gather(*[upload(s3, key, body, content_type) for key, (body, content_type) in files.items()])
+    return list(files.keys())
+
+
+class Session:
+    """
+    Profiles the process until the given number of jobs finished, the deadline passed or it is stopped.
+
+    cProfile only sees the event loop thread and calls wrapped by profiled, the sampler sees all threads.
+    """
+
+    def __init__(self, mode: Mode, jobs: Optional[int], seconds: Optional[float]):
+        self.id = uuid.uuid4().hex[:12]
+        self.mode = mode
+        self.jobs = jobs
+        self.seconds = seconds
+        self.finished_jobs = 0
+        self.started_at = time.time()
+        self.sampler = Sampler(
+            config.profiling_sample_interval_ms / 1000) if mode == "sample" else None
+        self.loop_profile = cProfile.Profile() if mode == "cprofile" else None
+        self.profiles: list[cProfile.Profile] = []
+        self.lock = threading.Lock()
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    def start(self):
+        if self.sampler is not None:
+            self.sampler.start()
+        if self.loop_profile is not None:
+            self.loop_profile.enable()
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.sampler is not None:
+            self.sampler.stop()
+        if self.loop_profile is not None:
+            self.loop_profile.disable()
+
+    def add(self, profile: cProfile.Profile):
+        with self.lock:
+            self.profiles.append(profile)
+
+    def files(self, prefix: str) -> dict[str, tuple[bytes, str]]:
+        if self.sampler is not None:
+            return {f"{prefix}.collapsed.txt": (self.sampler.render(), "text/plain")}
+        with self.lock:
+            stats = pstats.Stats(self.loop_profile)
+            for profile in self.profiles:
+                stats.add(profile)
+        with tempfile.NamedTemporaryFile() as dump:
+            stats.dump_stats(dump.name)
+            raw = dump.read()
+        summary = io.StringIO()
+        stats.stream = summary
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(100)
+        return {
+            f"{prefix}.pstats": (raw, "application/octet-stream"),
+            f"{prefix}.txt": (summary.getvalue().encode("utf-8"), "text/plain")
+        }
+
+    def status(self):
+        return {
+            "id": self.id,
+            "mode": self.mode,
+            "jobs": self.jobs,
+            "finishedJobs": self.finished_jobs,
+            "seconds": self.seconds,
+            "elapsedSeconds": time.time() - self.started_at
+        }
+
+
+def validate_session(mode, jobs, seconds):
+    if mode not in get_args(Mode):
+        raise ValueError(f"Unsupported mode {mode}")
+    # bool is an int as well
+    if jobs is not None and (not isinstance(jobs, int) or isinstance(jobs, bool) or jobs < 0):
+        raise ValueError("jobs must be a non-negative integer")
+    if seconds is not None and (not isinstance(seconds, (int, float)) or isinstance(seconds, bool)
+                                or not 0 < seconds < math.inf):
+        raise ValueError("seconds must be a positive number")
+
+
+class Profiler:
+    """
+    Holds the profiling session started on demand and the automatic profiles of slow jobs.
+    """
+
+    def __init__(self):
+        self.session: Optional[Session] = None
+        self.last_upload: Optional[dict] = None
+        self.slow_job_sampler: Optional[Sampler] = None
+        self.tasks: set[asyncio.Task] = set()
+
+    def start(self, mode: Mode, jobs: Optional[int] = None, seconds: Optional[float] = None):
+        """
+        Start a session, raising ValueError on invalid options.
+        """
+        if self.session is not None:
+            raise RuntimeError("A profiling session is already running")
+        validate_session(mode, jobs, seconds)
+        session = Session(mode, jobs, seconds)
+        # Set before the sampler thread starts, which nothing would stop otherwise
+        if seconds is not None:
+            session.timer = asyncio.get_running_loop().call_later(seconds, self.stop)
+        session.start()
+        self.session = session
+        logger.info(f"Profiling session {session.id} started")
+        return session
+
+    def stop(self):
+        """
+        Stop the running session and upload its profile in the background.
+        """
+        session = self.session
+        if session is None:
+            return None
+        self.session = None
+        session.stop()
+        logger.info(f"Profiling session {session.id} stopped")
+        key = diagnostics_key(session.id)
+        self.upload(lambda: session.files(key))
+        return session
+
+    def upload(self, build_files: Callable[[], dict[str, tuple[bytes, str]]]):
+        """
+        Build the profile files off the event loop and upload them in the background.
+        """
+        async def run():
+            try:
+                files = await asyncio.to_thread(build_files)
+                self.last_upload = {"keys": await upload_diagnostics(files), "error": None}
+            except Exception as e:
+                logger.exception("Unable to upload profile")
+                self.last_upload = {"keys": None, "error": str(e)}
+        task = asyncio.create_task(run())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def job_finished(self):
+        session = self.session
+        if session is None or session.jobs is None:
+            return
+        session.finished_jobs += 1
+        if session.finished_jobs >= session.jobs:
+            self.stop()
+
+    @contextmanager
+    def job(self, job_id: str):
+        """
+        Count the job towards the running session and profile it once it exceeds the slow job threshold.
+        """
+        timer = None
+        sampler: Optional[Sampler] = None
+        stacks = None
+        if config.profiling_slow_job_seconds > 0:
+            def start_sampler():
+                nonlocal sampler, stacks
+                # Sampling covers all threads, a single sampler at a time is enough
+                if self.slow_job_sampler is not None:
+                    return
+                logger.info(
+                    f"Job {job_id} exceeded {config.profiling_slow_job_seconds}s, profiling it")
+                stacks = dump_stacks()
+                sampler = Sampler(config.profiling_sample_interval_ms / 1000)
+                sampler.start()
+                self.slow_job_sampler = sampler
+            timer = asyncio.get_running_loop().call_later(
+                config.profiling_slow_job_seconds, start_sampler)
+        try:
+            yield
+        finally:
+            if timer is not None:
+                timer.cancel()
+            if sampler is not None:
+                sampler.stop()
+                self.slow_job_sampler = None
+                prefix = diagnostics_key(f"slow-job-{job_id}")
+                self.upload(lambda: {
+                    f"{prefix}.collapsed.txt": (sampler.render(), "text/plain"),
+                    f"{prefix}.stacks.txt": (stacks.encode("utf-8"), "text/plain")
+                })
+            self.job_finished()
+
+    def status(self):
+        return {
+            "session": self.session.status() if self.session is not None else None,
+            "lastUpload": self.last_upload,
+            "slowJobSeconds": config.profiling_slow_job_seconds or None
+        }
+
+
+profiler = Profiler()
+
+
+def profiled(fn):
+    """
+    Wrap a function run on another thread so that the cProfile session, when running, covers its calls.
+    """
+    @functools.wraps(fn)
+    def call(*args, **kwargs):
+        session = profiler.session
+        if session is None or session.mode != "cprofile":
+            return fn(*args, **kwargs)
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profile.disable()
+            session.add(profile)
+    return call
@@ -0,0 +1,81 @@
+# Copyright 2024 IBM Corp.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+from config import config
+from workers import redis_client
+
+KEY_PREFIX = "extraction:quota:"
+
+# Refills the bucket for the time elapsed, then takes the tokens. The bucket goes negative when it does not hold them,
+# so that each caller reserves its own tokens. Returns the milliseconds until the tokens taken are refilled, 0 when
+# they were held. Negative tokens are given back.
+#   KEYS[1] bucket key
+#   ARGV[1] rate in tokens per second, ARGV[2] burst, ARGV[3] now in milliseconds, ARGV[4] tokens
+TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(now - updated, 0) * rate / 1000)
+tokens = math.min(burst, tokens - cost)
+local wait = 0
+if tokens < 0 then
+  wait = math.ceil(-tokens * 1000 / rate)
+end
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "updated", now)
+-- A full bucket is the same as a missing one
+redis.call("PEXPIRE", KEYS[1], math.ceil((burst - tokens) * 1000 / rate) + 1000)
+return wait
+"""
+
+
+class ProjectQuotas:
+    """
+    Token buckets of extraction jobs by project, shared by all workers through Redis.
+
+    Buckets refill at the rate of the project up to burst tokens, a job takes a token before its conversion starts.
+    Jobs finding the bucket empty reserve a token ahead, each of them waits until its own token is refilled.
+    """
+
+    def __init__(self, client, default_rate: float, burst: int, rates: dict[str, float]):
+        self.default_rate = default_rate
+        self.burst = max(burst, 1)
+        self.rates = rates
+        self.script = client.register_script(TAKE_SCRIPT)
+
+    @property
+    def enabled(self):
+        return self.default_rate > 0 or any(rate > 0 for rate in self.rates.values())
+
+    def rate(self, project: str):
+        return self.rates.get(project, self.default_rate)
+
+    async def take(self, project: str, tokens: int = 1) -> int:
+        """
+        Take tokens of the project, returning 0 when they were held and the milliseconds until they are otherwise.
+        """
+        rate = self.rate(project)
+        if rate <= 0:
+            return 0
+        return int(await self.script(keys=[f"{KEY_PREFIX}{project}"],
+                                     args=[rate, self.burst, round(time.time() * 1000), tokens]))
+
+
+project_quotas = ProjectQuotas(redis_client, config.extraction_project_rate,
+                               config.extraction_project_burst, config.extraction_project_rates)
@@ -0,0 +1,71 @@
+# Copyright 2024 IBM Corp.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+# Stages of an extraction job
+MONGO_FETCH = "mongo_fetch"
+DOWNLOAD = "download"
+CONVERT = "convert"
+CHUNK = "chunk"
+EMBED = "embed"
+SERIALIZE = "serialize"
+UPLOAD = "upload"
+MONGO_UPDATE = "mongo_update"
+
+# Called with the stage, backend and duration in seconds of every recorded stage
+observers: list[Callable[[str, Optional[str], float], None]] = []
+
+
+def record_stage(name: str, seconds: float, backend: Optional[str] = None):
+    for observer in observers:
+        observer(name, backend, seconds)
+
+
+def record_timings(timings: dict[str, float], backend: Optional[str] = None):
+    for name, seconds in timings.items():
+        record_stage(name, seconds, backend)
+
+
+@contextmanager
+def stage(name: str, backend: Optional[str] = None):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start, backend)
+
+
+@contextmanager
+def timed(timings: dict[str, float], name: str):
+    """
+    Accumulate the duration into timings, for stages timed where observers are not available, e.g. in child processes.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0) + time.perf_counter() - start
+
+
+def measure_cpu(clock: Callable[[], float], fn: Callable, *args):
+    """
+    Call fn and return its result along with the CPU time it took by the clock, e.g. time.process_time
+    in processes running a single call at a time.
+    """
+    start = clock()
+    result = fn(*args)
+    return result, clock() - start
@@ -0,0 +1,127 @@
+# Copyright 2024 IBM Corp.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from contextlib import AsyncExitStack, asynccontextmanager
+from io import BytesIO
+from typing import Optional
+
+import aioboto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import ClientError
+
+from config import config
+
+session = aioboto3.Session()
+
+DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+
+# Long-lived client shared by all jobs, its connection pool is reused across them
+shared_client = None
+exit_stack = AsyncExitStack()
+
+
+def create_client():
+    return session.client("s3",
+                          endpoint_url=config.s3_endpoint,
+                          aws_access_key_id=config.s3_access_key_id,
+                          aws_secret_access_key=config.s3_secret_access_key,
+                          aws_session_token=None,
+                          config=BotoConfig(
+                              max_pool_connections=config.s3_max_pool_connections,
+                              connect_timeout=config.s3_connect_timeout,
+                              read_timeout=config.s3_read_timeout,
+                              tcp_keepalive=True
+                          ))
+
+
+async def start_storage():
+    global shared_client
+    shared_client = await exit_stack.enter_async_context(create_client())
+
+
+async def stop_storage():
+    global shared_client
+    shared_client = None
+    await exit_stack.aclose()
+
+
+@asynccontextmanager
+async def s3_client():
+    if shared_client is not None:
+        yield shared_client
+        return
+    async with create_client() as client:
+        yield client
+
+
+async def download_bytes(s3, key: str) -> bytes:
+    obj = await s3.get_object(Bucket=config.s3_bucket_file_storage, Key=key)
+    async with obj["Body"] as body:
+        return await body.read()
+
+
+async def download_if_changed(s3, key: str, etag: Optional[str], path: Optional[str] = None):
+    """
+    Download the object unless its ETag is etag, to path when given and in memory otherwise.
+
+    Returns the ETag of the object with its body, None when written to path, or None when the ETag matched.
+    """
+    conditions = {"IfNoneMatch": f'"{etag}"'} if etag is not None else {}
+    try:
+        obj = await s3.get_object(Bucket=config.s3_bucket_file_storage, Key=key, **conditions)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") == "304":
+            return None
+        raise
+    async with obj["Body"] as body:
+        if path is None:
+            data = await body.read()
+        else:
+            data = None
+            with open(path, "wb") as file:
+                while chunk := await body.read(DOWNLOAD_CHUNK_BYTES):
+                    await asyncio.to_thread(file.write, chunk)
+    return obj["ETag"].strip('"'), data
+
+
+def transfer_config():
+    return TransferConfig(
+        multipart_threshold=config.s3_multipart_threshold,
+        multipart_chunksize=config.s3_multipart_chunksize
+    )
+
+
+async def upload(s3, key: str, body: bytes, content_type: str, content_encoding: Optional[str] = None):
+    """
+    Upload the body, large bodies are sent as concurrent multipart uploads.
+    """
+    extra_args = {"ContentType": content_type}
+    if content_encoding is not None:
+        extra_args["ContentEncoding"] = content_encoding
+    if len(body) < config.s3_multipart_threshold:
+        await s3.put_object(Bucket=config.s3_bucket_file_storage, Key=key, Body=body, **extra_args)
+        return
+    await s3.upload_fileobj(BytesIO(body), config.s3_bucket_file_storage, key, ExtraArgs=extra_args, Config=transfer_config())
+
+
+async def upload_file(s3, key: str, path: str, content_type: str, content_encoding: Optional[str] = None):
+    """
+    Upload a local file, streamed from disk in multipart chunks when large.
+    """
+    extra_args = {"ContentType": content_type}
+    if content_encoding is not None:
+        extra_args["ContentEncoding"] = content_encoding
+    await s3.upload_file(path, config.s3_bucket_file_storage, key, ExtraArgs=extra_args, Config=transfer_config())
@@ -0,0 +1,251 @@
+# Copyright 2024 IBM Corp.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+from typing import Callable, Optional
+
+from metrics import Counter
+
+logger = logging.getLogger()
+
+# How often the memory of busy processes is checked
+CHECK_INTERVAL = 1
+
+SHUTDOWN_TIMEOUT = 10
+
+recycled_processes = Counter("supervised_processes_recycled_total", "Supervised processes replaced by reason.",
+                             ("pool", "reason"))
+
+
+class ProcessLimitExceeded(RuntimeError):
+    def __init__(self, message: str, reason: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+def process_rss_mb(pid: int) -> Optional[float]:
+    try:
+        with open(f"/proc/{pid}/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        return None
+
+
+def child_main(conn, initializer: Optional[Callable]):
+    # Shutdown is driven by the parent
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    conn.send(("ready", initializer() if initializer is not None else None))
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        fn, args = task
+        try:
+            result = ("ok", fn(*args))
+        except Exception as e:
+            result = ("error", e)
+        try:
+            conn.send(result)
+        except Exception as e:
+            # The result or the error could not be pickled
+            conn.send(("error", RuntimeError(f"{type(e).__name__}: {e}")))
+
+
+class ChildProcess:
+    def __init__(self, context, name: str, initializer: Optional[Callable]):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=child_main, args=(child_conn, initializer), name=name, daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.jobs = 0
+        # Result of the initializer
+        self.initialized = None
+
+    def rss_mb(self):
+        return process_rss_mb(self.process.pid)
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(SHUTDOWN_TIMEOUT)
+        self.kill()
+
+    async def receive(self, deadline: Optional[float] = None, max_rss_mb: float = 0):
+        """
+        Wait for the next message of the process, enforcing the deadline and the memory ceiling meanwhile.
+        """
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+
+        def on_readable():
+            if not readable.done():
+                readable.set_result(None)
+        loop.add_reader(self.conn.fileno(), on_readable)
+        try:
+            while not readable.done():
+                timeout = CHECK_INTERVAL if deadline is None else min(
+                    CHECK_INTERVAL, deadline - loop.time())
+                if timeout <= 0:
+                    raise ProcessLimitExceeded(
+                        "Conversion exceeded its deadline", "deadline")
+                await asyncio.wait([readable], timeout=timeout)
+                if max_rss_mb > 0 and not readable.done():
+                    rss_mb = self.rss_mb()
+                    if rss_mb is not None and rss_mb > max_rss_mb:
+                        raise ProcessLimitExceeded(
+                            f"Conversion exceeded the memory limit with {rss_mb:.0f}MB", "memory")
+        finally:
+            loop.remove_reader(self.conn.fileno())
+        try:
+            # Large results are read and unpickled off the event loop
+            return await asyncio.to_thread(self.conn.recv)
+        except EOFError:
+            self.process.join()
+            raise RuntimeError(
+                f"Conversion process exited with code {self.process.exitcode}")
+
+
+class SupervisedPool:
+    """
+    Runs functions in long-lived child processes which are killed when a call exceeds its deadline or memory ceiling.
+
+    A process is replaced after max_jobs calls or once its memory grows past the recycle threshold,
+    reclaiming memory that leaks across calls.
+    """
+
+    def __init__(self, name: str, size: int, initializer: Optional[Callable] = None, timeout: float = 0,
+                 max_rss_mb: float = 0, recycle_rss_mb: float = 0, max_jobs: int = 0):
+        self.name = name
+        self.size = size
+        self.initializer = initializer
+        self.timeout = timeout
+        self.max_rss_mb = max_rss_mb
+        self.recycle_rss_mb = recycle_rss_mb
+        self.max_jobs = max_jobs
+        # Forking a process with loaded torch state is unsafe
+        self.context = multiprocessing.get_context("spawn")
+        self.children: set[ChildProcess] = set()
+        self.idle: asyncio.Queue[ChildProcess] = asyncio.Queue()
+        self.tasks: set[asyncio.Task] = set()
+        self.closed = False
+        self.counter = 0
+
+    async def spawn(self):
+        self.counter += 1
+        child = ChildProcess(self.context, f"{self.name}-{self.counter}", self.initializer)
+        self.children.add(child)
+        try:
+            _, child.initialized = await child.receive()
+        except Exception:
+            self.children.discard(child)
+            await asyncio.to_thread(child.kill)
+            raise
+        if self.closed:
+            self.children.discard(child)
+            await asyncio.to_thread(child.stop)
+            return None
+        return child
+
+    async def start(self):
+        """
+        Start all processes upfront so that they are initialized before the first calls arrive.
+
+        Returns the results of the initializer in each process.
+        """
+        children = await asyncio.gather(*[self.spawn() for _ in range(self.size)])
+        for child in children:
+            self.idle.put_nowait(child)
+        return [child.initialized for child in children]
+
+    def replace(self, child: ChildProcess, reason: str):
+        recycled_processes.inc(pool=self.name, reason=reason)
+        self.children.discard(child)
+
+        async def run():
+            await asyncio.to_thread(child.kill if reason != "recycled" else child.stop)
+            while not self.closed:
+                try:
+                    replacement = await self.spawn()
+                    if replacement is not None:
+                        self.idle.put_nowait(replacement)
+                    return
+                except Exception:
+                    logger.exception(
+                        f"Unable to start a {self.name} process, retrying")
+                    await asyncio.sleep(CHECK_INTERVAL)
+        task = asyncio.create_task(run())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def release(self, child: ChildProcess):
+        rss_mb = child.rss_mb()
+        if 0 < self.max_jobs <= child.jobs:
+            logger.info(
+                f"Recycling {child.process.name} after {child.jobs} jobs")
+            self.replace(child, "recycled")
+        elif self.recycle_rss_mb > 0 and rss_mb is not None and rss_mb > self.recycle_rss_mb:
+            logger.info(
+                f"Recycling {child.process.name} at {rss_mb:.0f}MB after {child.jobs} jobs")
+            self.replace(child, "recycled")
+        else:
+            self.idle.put_nowait(child)
+
+    async def run(self, fn: Callable, *args):
+        if self.closed:
+            raise RuntimeError(f"{self.name} pool is shut down")
+        child = await self.idle.get()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout if self.timeout > 0 else None
+        try:
+            await asyncio.to_thread(child.conn.send, (fn, args))
+            status, result = await child.receive(deadline, self.max_rss_mb)
+        except ProcessLimitExceeded as e:
+            logger.warning(f"Killing {child.process.name}: {e}")
+            self.replace(child, e.reason)
+            raise
+        except RuntimeError:
+            self.replace(child, "exited")
+            raise
+        except BaseException:
+            # Cancelled or broken while the call was running, the process state is unknown
+            self.replace(child, "interrupted")
+            raise
+        child.jobs += 1
+        self.release(child)
+        if status == "error":
+            raise result
+        return result
+
+    def shutdown(self):
+        self.closed = True
+        for child in list(self.children):
+            child.stop()
+        self.children.clear()
@@ -12,35 +12,117 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from opentelemetry import trace
+import logging
+import threading
+from collections import OrderedDict
+
+from opentelemetry import context, trace
 from opentelemetry._logs import set_logger_provider
 from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
 from opentelemetry.exporter.otlp.proto.http._log_exporter import OTLPLogExporter
 from opentelemetry.sdk.resources import SERVICE_NAME, Resource
-from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace import ReadableSpan, SpanProcessor, TracerProvider
 from opentelemetry.sdk.trace.export import BatchSpanProcessor
 from opentelemetry.sdk._logs import LoggerProvider, LoggingHandler
 from opentelemetry.sdk._logs.export import BatchLogRecordProcessor
+from opentelemetry.trace import StatusCode
 
 from config import config
+from metrics import Counter
 
 resource = Resource.create(attributes={
     SERVICE_NAME: "bee-api"
 })
 
+sampled_traces = Counter("traces_sampled_total", "Traces by sampling decision.", ("decision",))
+
+
+class TailSamplingProcessor(SpanProcessor):
+    """
+    Holds the spans of each trace until its local root span ends, then passes the whole trace on
+    when it failed, was slow or falls within the sampling ratio, dropping it otherwise.
+    """
+
+    def __init__(self, processor: SpanProcessor, ratio: float, slow_seconds: float, max_pending: int):
+        self.processor = processor
+        # Compared with the lower bits of the trace id, as the ratio based sampler of the SDK does
+        self.bound = round(min(max(ratio, 0), 1) * (2 ** 64 - 1))
+        self.slow_ns = slow_seconds * 1e9
+        self.max_pending = max_pending
+        self.pending: OrderedDict[int, list[ReadableSpan]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def decide(self, root: ReadableSpan):
+        # Deferred jobs leave through an exception without failing
+        if root.status.status_code == StatusCode.ERROR and not root.attributes.get("job.deferred"):
+            return "error"
+        if root.end_time - root.start_time >= self.slow_ns:
+            return "slow"
+        if root.context.trace_id & (2 ** 64 - 1) < self.bound:
+            return "sampled"
+        return "dropped"
+
+    def on_end(self, span: ReadableSpan):
+        trace_id = span.context.trace_id
+        with self.lock:
+            if span.parent is not None and not span.parent.is_remote:
+                self.pending.setdefault(trace_id, []).append(span)
+                if len(self.pending) > self.max_pending:
+                    self.pending.popitem(last=False)
+                    sampled_traces.inc(decision="evicted")
+                return
+            spans = self.pending.pop(trace_id, [])
+        decision = self.decide(span)
+        sampled_traces.inc(decision=decision)
+        if decision == "dropped":
+            return
+        for child in spans:
+            self.processor.on_end(child)
+        self.processor.on_end(span)
+
+    def shutdown(self):
+        self.processor.shutdown()
+
+    def force_flush(self, timeout_millis: int = 30000):
+        return self.processor.force_flush(timeout_millis)
+
+
+class QueuedLoggingHandler(LoggingHandler):
+    """
+    Emits records handled on another thread within the context they were logged in, as captured on the record
+    under otel_context, so that they keep their trace and span ids.
+    """
+
+    def emit(self, record: logging.LogRecord):
+        # Removed so that it is not exported as an attribute
+        captured = record.__dict__.pop("otel_context", None)
+        if captured is None:
+            super().emit(record)
+            return
+        token = context.attach(captured)
+        try:
+            super().emit(record)
+        finally:
+            context.detach(token)
+
+
 traceProvider = TracerProvider(resource=resource)
 logger_provider = LoggerProvider(
     resource=resource
 )
-logging_handler = LoggingHandler(logger_provider=logger_provider)
+logging_handler = QueuedLoggingHandler(logger_provider=logger_provider)
 
 
 def setup_telemetry():
     if config.otel_sdk_disabled:
         return
 
-    traceProvider.add_span_processor(BatchSpanProcessor(
-        OTLPSpanExporter()))
+    traceProvider.add_span_processor(TailSamplingProcessor(
+        BatchSpanProcessor(OTLPSpanExporter()),
+        config.otel_traces_sample_ratio,
+        config.otel_traces_slow_seconds,
+        config.otel_traces_max_pending
+    ))
     trace.set_tracer_provider(traceProvider)
 
     set_logger_provider(logger_provider)
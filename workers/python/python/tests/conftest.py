@@ -0,0 +1,31 @@
+# Copyright 2024 IBM Corp.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+
+# Settings required by the config, no service is contacted by the tests
+for name, value in {
+    "RUN_BULLMQ_WORKERS": "files-extraction-python",
+    "REDIS_URL": "redis://localhost:6379/0",
+    "MONGODB_URL": "mongodb://localhost:27017",
+    "MONGODB_DATABASE_NAME": "test",
+    "S3_ENDPOINT": "http://localhost:9000",
+    "S3_BUCKET_FILE_STORAGE": "test",
+    "S3_ACCESS_KEY_ID": "test",
+    "S3_SECRET_ACCESS_KEY": "test"
+}.items():
+    os.environ.setdefault(name, value)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
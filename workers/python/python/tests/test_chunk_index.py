@@ -0,0 +1,79 @@
+# Copyright 2024 IBM Corp.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import struct
+from array import array
+
+from chunk_index import MAGIC, VERSION, ChunkIndex
+
+
+def decode(body: bytes):
+    assert body[:4] == MAGIC
+    version, header_length = struct.unpack_from("<II", body, 4)
+    assert version == VERSION
+    header = json.loads(body[12:12 + header_length])
+    offset = 12 + header_length
+    columns = {}
+    for name, typecode, itemsize in header["columns"]:
+        column = array(typecode)
+        assert column.itemsize == itemsize
+        column.frombytes(body[offset:offset + itemsize * header["count"]])
+        columns[name] = list(column)
+        offset += itemsize * header["count"]
+    assert offset == len(body)
+    return header, columns
+
+
+def test_locate_finds_chunks_in_order():
+    text = b"# Title\n\nFirst paragraph.\n\nSecond paragraph\nover two lines.\n\nFirst paragraph."
+    index = ChunkIndex(text)
+    assert index.locate("First paragraph.") == (9, 25)
+    assert index.locate("Second paragraph\nover two lines.") == (27, 59)
+    # The repeated chunk is found after the previous one
+    assert index.locate("First paragraph.") == (61, 77)
+    assert index.locate("Not in the text") == (-1, -1)
+
+
+def test_locate_matches_escaped_underscores():
+    text = b"Call snake\\_case here."
+    start, end = ChunkIndex(text).locate("Call snake_case here.")
+    assert text[start:end] == text
+
+
+def test_encode_round_trips():
+    text = b"Intro text.\n\nBody text here."
+    index = ChunkIndex(text)
+    index.add("Intro text.", [1], [])
+    index.add("Body text here.", [1, 3], ["Chapter", "Section"])
+    index.add("| a | b |", [], ["Chapter", "Section"])
+
+    header, columns = decode(index.encode())
+    assert header["count"] == 3
+    assert header["tokenizer"] == "whitespace"
+    assert header["headings"] == [[], ["Chapter", "Section"]]
+    assert columns == {
+        "text_start": [0, 13, -1],
+        "text_end": [11, 28, -1],
+        "tokens": [2, 3, 5],
+        "page_first": [1, 1, 0],
+        "page_last": [1, 3, 0],
+        "headings": [0, 1, 1]
+    }
+
+
+def test_encode_of_an_empty_index():
+    header, columns = decode(ChunkIndex().encode())
+    assert header["count"] == 0
+    assert all(values == [] for values in columns.values())
@@ -0,0 +1,46 @@
+# Copyright 2024 IBM Corp.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import disk_cache
+from disk_cache import DiskCache
+
+
+def test_init_removes_stale_temporary_files(tmp_path, monkeypatch):
+    (tmp_path / ".1234-5678").write_bytes(b"left over")
+    (tmp_path / ".tmpabcdef").write_bytes(b"left over")
+    cache = DiskCache(str(tmp_path), 1024)
+    cache.put_bytes("object", "etag", b"cached")
+    assert len(os.listdir(tmp_path)) == 4
+
+    # Every file predates the cutoff, only the temporary ones go
+    monkeypatch.setattr(disk_cache, "STALE_TEMPORARY_SECONDS", -60)
+    DiskCache(str(tmp_path), 1024)
+    assert sorted(os.listdir(tmp_path)) == sorted(
+        os.path.basename(path) for path in (cache.entry("object", "etag"), cache.tag("object")))
+    assert cache.read("object", "etag") == b"cached"
+
+
+def test_latest_etag_follows_the_last_cached_version(tmp_path):
+    cache = DiskCache(str(tmp_path), 1024)
+    assert cache.latest_etag("object") is None
+    cache.put_bytes("object", "first", b"first version")
+    assert cache.latest_etag("object") == "first"
+    source = tmp_path / "source"
+    source.write_bytes(b"second version")
+    cache.put_file("object", "second", str(source))
+    assert cache.latest_etag("object") == "second"
+    assert cache.read("object", "second") == b"second version"
+    assert cache.latest_etag("other") is None
@@ -0,0 +1,74 @@
+# Copyright 2024 IBM Corp.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from extraction.shards import merge_documents, merge_short_runs, offset_pages, plan_shards
+
+
+def text(index: int, page_no: int, parent: str = "#/body"):
+    return {"self_ref": f"#/texts/{index}", "parent": {"$ref": parent}, "children": [],
+            "text": f"text {index}", "prov": [{"page_no": page_no, "bbox": {}}]}
+
+
+def document(texts: list[dict], pages: list[int], body: list[int], furniture: list[int]):
+    return {
+        "body": {"self_ref": "#/body", "children": [{"$ref": f"#/texts/{i}"} for i in body]},
+        "furniture": {"self_ref": "#/furniture", "children": [{"$ref": f"#/texts/{i}"} for i in furniture]},
+        "groups": [],
+        "texts": texts,
+        "pictures": [],
+        "tables": [],
+        "pages": {str(page_no): {"page_no": page_no, "size": {}} for page_no in pages}
+    }
+
+
+def test_plan_shards_splits_by_routing_and_size():
+    assert plan_shards([False] * 5, 0) == [(0, 5, False)]
+    assert plan_shards([False] * 5, 2) == [(0, 2, False), (2, 4, False), (4, 5, False)]
+    assert plan_shards([False, False, True, True, False], 0) == [(0, 2, False), (2, 4, True), (4, 5, False)]
+    assert plan_shards([], 2) == []
+
+
+def test_merge_short_runs_follows_the_pages_before():
+    lone_figure = [False] * 10 + [True] + [False] * 10
+    assert merge_short_runs(lone_figure, 8) == [False] * 21
+    assert merge_short_runs([True] * 3 + [False] * 10, 8) == [False] * 13
+    assert merge_short_runs([True] * 8 + [False] * 8, 8) == [True] * 8 + [False] * 8
+    assert merge_short_runs([True] * 3, 8) == [True] * 3
+
+
+def test_offset_pages_shifts_pages_and_provenance():
+    shard = offset_pages(document([text(0, 1), text(1, 2)], [1, 2], [0, 1], []), 10)
+    assert sorted(shard["pages"]) == ["11", "12"]
+    assert shard["pages"]["11"]["page_no"] == 11
+    assert [item["prov"][0]["page_no"] for item in shard["texts"]] == [11, 12]
+
+
+def test_merge_documents_rebases_refs_and_keeps_child_order():
+    first = document([text(0, 1), text(1, 2, "#/texts/0")], [1, 2], [0], [])
+    first["texts"][0]["children"] = [{"$ref": "#/texts/1"}]
+    second = offset_pages(document([text(0, 1), text(1, 1), text(2, 2)], [1, 2], [1, 2], [0]), 2)
+
+    merged = merge_documents([first, second])
+
+    assert [item["self_ref"] for item in merged["texts"]] == [f"#/texts/{i}" for i in range(5)]
+    assert [item["text"] for item in merged["texts"]] == ["text 0", "text 1", "text 0", "text 1", "text 2"]
+    # Refs within the first document are left as they are
+    assert merged["texts"][1]["parent"] == {"$ref": "#/texts/0"}
+    assert merged["texts"][0]["children"] == [{"$ref": "#/texts/1"}]
+    # Refs to the roots are not rebased
+    assert merged["texts"][3]["parent"] == {"$ref": "#/body"}
+    assert merged["body"]["children"] == [{"$ref": "#/texts/0"}, {"$ref": "#/texts/3"}, {"$ref": "#/texts/4"}]
+    assert merged["furniture"]["children"] == [{"$ref": "#/texts/2"}]
+    assert sorted(merged["pages"], key=int) == ["1", "2", "3", "4"]
+    assert [item["prov"][0]["page_no"] for item in merged["texts"]] == [1, 2, 3, 3, 4]
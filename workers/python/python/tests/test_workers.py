@@ -0,0 +1,134 @@
+# Copyright 2024 IBM Corp.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import time
+
+from bullmq import Queue
+
+import workers
+
+
+class Timer:
+    def __init__(self):
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+
+class DrainingWorker:
+    """
+    Stands in for a bullmq 2.9.4 worker whose run loop ends, once closing, as soon as a fetch comes back empty,
+    leaving its jobs in flight running.
+    """
+
+    def __init__(self, job_seconds: list[float]):
+        self.name = "test"
+        self.opts = {"lockDuration": 200}
+        self.closing = False
+        self.forceClosing = False
+        self.jobs = set()
+        self.processing = set()
+        self.completed = []
+        self.extended = 0
+        self.timer = Timer()
+        self.stalledCheckTimer = Timer()
+        for index, seconds in enumerate(job_seconds):
+            self.processing.add(asyncio.ensure_future(self.process((f"job-{index}", f"token-{index}"), seconds)))
+
+    async def process(self, job, seconds):
+        self.jobs.add(job)
+        try:
+            await asyncio.sleep(seconds)
+            if not self.forceClosing:
+                self.completed.append(job[0])
+        finally:
+            self.jobs.remove(job)
+
+    async def run(self):
+        while not self.closing:
+            await asyncio.sleep(0.01)
+        # An empty fetch ends the loop, the timer renewing the locks is stopped
+        await asyncio.sleep(0.01)
+        self.timer.stop()
+        self.stalledCheckTimer.stop()
+
+    async def extendLocks(self):
+        self.extended += 1
+
+    def cancelProcessing(self):
+        for task in self.processing:
+            if not task.done():
+                task.cancel()
+
+
+def drain(job_seconds: list[float], grace: float, monkeypatch):
+    handed_off = []
+
+    async def handoff_job(job, token):
+        handed_off.append(job)
+    monkeypatch.setattr(workers, "handoff_job", handoff_job)
+    monkeypatch.setattr(workers, "DRAIN_POLL_SECONDS", 0.01)
+
+    async def main():
+        worker = DrainingWorker(job_seconds)
+        task = asyncio.create_task(worker.run())
+        await asyncio.sleep(0.01)
+        await workers.drain_worker(worker, task, time.monotonic() + grace)
+        return worker
+    return asyncio.run(main()), handed_off
+
+
+def test_drain_waits_for_jobs_outliving_the_run_loop(monkeypatch):
+    worker, handed_off = drain([0.3, 0.4], 2, monkeypatch)
+    assert sorted(worker.completed) == ["job-0", "job-1"]
+    assert handed_off == []
+    # Locks are renewed every lockDuration / 2 once the run loop has ended
+    assert worker.extended >= 2
+
+
+def test_drain_hands_off_jobs_past_the_deadline(monkeypatch):
+    worker, handed_off = drain([0.1, 5, 5], 0.5, monkeypatch)
+    assert worker.completed == ["job-0"]
+    assert sorted(handed_off) == ["job-1", "job-2"]
+    assert worker.forceClosing
+    assert len(worker.jobs) == 0
+    assert all(task.done() for task in worker.processing)
+
+
+class IdleScripts:
+    """
+    Stands in for the Redis scripts of a queue without jobs.
+    """
+
+    async def getCounts(self, types):
+        return [0] * len(types)
+
+    async def getRanges(self, types, start, end, asc):
+        return []
+
+
+def test_queue_load_of_an_idle_queue(monkeypatch):
+    queue = Queue.__new__(Queue)
+    queue.scripts = IdleScripts()
+    worker = DrainingWorker([])
+    worker.opts["concurrency"] = 2
+    monkeypatch.setitem(workers.queues, "test", queue)
+    monkeypatch.setitem(workers.workers, "test", worker)
+
+    load = asyncio.run(workers.queue_load("test"))
+    assert load["waiting"] == 0
+    assert load["oldestWaitingSeconds"] == 0
+    assert load["utilization"] == 0
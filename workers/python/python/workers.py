@@ -15,18 +15,33 @@
 from config import config
 import logging
 import asyncio
-from typing import List
-from bullmq import Worker
+import socket
+import time
+from typing import Callable, List
+from bullmq import Job, Queue, Worker
+from bullmq.custom_errors import WaitingChildrenError
 from redis.asyncio import Redis
 from redis.asyncio.retry import Retry
 from redis.exceptions import (TimeoutError, ConnectionError)
 from redis.backoff import ExponentialBackoff
 from opentelemetry.instrumentation.redis import RedisInstrumentor
 
+from metrics import Gauge, worker_jobs
+
 logger = logging.getLogger()
 
 
 workers: dict[str, Worker] = dict()
+lifecycle_hooks: dict[str, tuple[Callable | None, Callable | None]] = dict()
+# Queues used to inspect the backlog of the workers
+queues: dict[str, Queue] = dict()
+# Names of the workers run along with a worker, e.g. the lanes of its queue
+followers: dict[str, list[str]] = dict()
+# "warming" while the startup hook of the worker runs, "ready" once the worker is started
+warm_up_state: dict[str, str] = dict()
+warm_up_seconds: dict[str, float] = dict()
+# Time spent on each step of the startup hook, when it reports them
+warm_up_steps: dict[str, dict[str, float]] = dict()
 
 redis_options = {
     "decode_responses": True,
@@ -42,15 +57,31 @@ redis_client = Redis.from_url(
     config.redis_url, ssl_ca_data=config.redis_ca_cert, **redis_options)
 
 
-def create_worker(queue_name: str, processor, opts):
+jobs_in_flight = Gauge("worker_jobs_in_flight", "Jobs being processed by queue.", ("queue",),
+                       collect=lambda: {(name,): len(worker.jobs) for name, worker in workers.items()})
+jobs_capacity = Gauge("worker_jobs_capacity", "Concurrency of the worker by queue.", ("queue",),
+                      collect=lambda: {(name,): worker.opts["concurrency"] for name, worker in workers.items()})
+warm_up_gauge = Gauge("worker_warm_up_seconds", "Time spent warming up the worker by queue and step.", ("queue", "step"),
+                      collect=lambda: {
+                          **{(name, step): seconds for name, steps in warm_up_steps.items() for step, seconds in steps.items()},
+                          **{(name, "total"): seconds for name, seconds in warm_up_seconds.items()}})
+
+
+def create_worker(queue_name: str, processor, opts, on_startup: Callable | None = None, on_shutdown: Callable | None = None,
+                  run_with: str | None = None):
+    concurrency = config.worker_concurrency.get(queue_name)
+    if concurrency is not None:
+        opts = {**opts, "concurrency": concurrency}
     worker = Worker(queue_name, processor, {
                     **opts, "autorun": False, "connection": redis_client})
 
     def completedCallback(job, result):
+        worker_jobs.inc(queue=queue_name, outcome="completed")
         logger.info("Job done")
     worker.on('completed', completedCallback)
 
     def failedCallback(job, err):
+        worker_jobs.inc(queue=queue_name, outcome="failed")
         logger.error("Job Failed", err)
     worker.on('failed', failedCallback)
 
@@ -59,26 +90,174 @@ def create_worker(queue_name: str, processor, opts):
     worker.on('error', errorCallback)
 
     workers[queue_name] = worker
+    lifecycle_hooks[queue_name] = (on_startup, on_shutdown)
+    queues[queue_name] = Queue(queue_name, {"connection": redis_client})
+    if run_with is not None:
+        followers.setdefault(run_with, []).append(queue_name)
     return worker
 
 
+def with_followers(names: List[str]) -> List[str]:
+    return [name for leader in names for name in [leader, *followers.get(leader, [])]]
+
+
+async def move_to_delayed(job: Job, token: str, delay_ms: int):
+    """
+    Move the active job back to the delayed set without consuming an attempt.
+    """
+    keys, args = job.scripts.moveToDelayedArgs(
+        job.id, round(time.time() * 1000), token, delay_ms, {"skipAttempt": True})
+    result = await job.scripts.commands["moveToDelayed"](keys=keys, args=args)
+    if result is not None and result < 0:
+        raise job.scripts.finishedErrors(result, job.id, "moveToDelayed", "active")
+
+
+async def defer_job(job: Job, token: str, delay_ms: int):
+    """
+    Postpone the job from its processor.
+
+    Raises WaitingChildrenError, which makes the worker drop the job without completing or failing it.
+    """
+    await move_to_delayed(job, token, delay_ms)
+    worker_jobs.inc(queue=job.queue.name, outcome="deferred")
+    raise WaitingChildrenError()
+
+
+async def wait_for_children(job: Job, token: str):
+    """
+    Move the job to the waiting-children state until its child jobs finish, returning when none is pending.
+
+    Raises WaitingChildrenError otherwise, like defer_job.
+    """
+    if await job.moveToWaitingChildren(token, {}):
+        raise WaitingChildrenError()
+
+
+async def handoff_job(job: Job, token: str):
+    """
+    Record where the job was left in its progress and move it back to the queue for another worker to take it at once.
+    """
+    progress = job.progress if isinstance(job.progress, dict) else {}
+    handoff = progress.get("handoff") or {}
+    try:
+        await job.updateProgress({**progress, "handoff": {
+            "host": socket.gethostname(),
+            "timestamp": round(time.time() * 1000),
+            "runningSeconds": round(time.time() - job.processedOn / 1000, 3) if job.processedOn else None,
+            "count": handoff.get("count", 0) + 1
+        }})
+        await move_to_delayed(job, token, 0)
+        worker_jobs.inc(queue=job.queue.name, outcome="requeued")
+    except Exception:
+        # The lock of the job expires and the stalled jobs check moves it back to the queue
+        logger.warning(f"Unable to hand off job {job.id}", exc_info=True)
+
+
 Runners = list[tuple[Worker, asyncio.Task]]
 
+# How often draining workers check for their jobs in flight
+DRAIN_POLL_SECONDS = 0.5
+
 
 async def run_workers(names: List[str]):
     # TODO add autodiscovery
     import extraction.extraction
 
     tuples: Runners = []
-    for name in names:
+    for name in with_followers(names):
         worker = workers.get(name)
         if worker is not None:
+            warm_up_state[name] = "warming"
+            start = time.perf_counter()
+            on_startup, _ = lifecycle_hooks[name]
+            if on_startup is not None:
+                warm_up_steps[name] = await on_startup() or {}
             task = asyncio.create_task(worker.run())
             tuples.append((worker, task))
+            warm_up_seconds[name] = time.perf_counter() - start
+            warm_up_state[name] = "ready"
     return tuples
 
 
+def is_live():
+    """
+    Workers that have been started must still be running, workers that are warming up are live.
+    """
+    return all(workers[name].running or workers[name].closing for name, state in warm_up_state.items() if state == "ready")
+
+
+def is_ready():
+    """
+    Ready once all workers are warmed up and taking jobs.
+    """
+    return len(warm_up_state) > 0 and all(
+        state == "ready" and workers[name].running and not workers[name].closing for name, state in warm_up_state.items())
+
+
+async def oldest_waiting(queue: Queue, waiting: int) -> list[Job]:
+    # bullmq waits on an empty set of tasks when no job is listed, which raises
+    if waiting == 0:
+        return []
+    try:
+        return await queue.getWaiting(0, 0)
+    except ValueError:
+        # Taken meanwhile
+        return []
+
+
+async def queue_load(name: str):
+    worker = workers[name]
+    queue = queues[name]
+    counts = await queue.getJobCounts("wait", "active", "delayed", "prioritized")
+    oldest = await oldest_waiting(queue, counts["wait"])
+    in_flight = len(worker.jobs)
+    capacity = worker.opts["concurrency"]
+    return {
+        "inFlight": in_flight,
+        "capacity": capacity,
+        "utilization": in_flight / capacity if capacity > 0 else None,
+        "waiting": counts["wait"] + counts["prioritized"],
+        "active": counts["active"],
+        "delayed": counts["delayed"],
+        "oldestWaitingSeconds": max(time.time() - oldest[0].timestamp / 1000, 0) if len(oldest) > 0 else 0,
+        "warmUp": warm_up_state.get(name, "pending"),
+        "warmUpSeconds": warm_up_seconds.get(name),
+        "warmUpSteps": warm_up_steps.get(name)
+    }
+
+
+async def drain_worker(worker: Worker, task: asyncio.Task, deadline: float):
+    """
+    Stop taking jobs and let the jobs in flight finish until the deadline, then hand off the remaining ones.
+    """
+    # The worker stops fetching jobs and reports not ready
+    worker.closing = True
+    lock_interval = worker.opts["lockDuration"] / 2 / 1000
+    extended_at = None
+    while (len(worker.jobs) > 0 or not task.done()) and time.monotonic() < deadline:
+        # The run loop ends once a fetch comes back empty, stopping the renewal of the locks of the jobs still in flight
+        if task.done() and (extended_at is None or time.monotonic() - extended_at >= lock_interval):
+            await worker.extendLocks()
+            extended_at = time.monotonic()
+        await asyncio.sleep(min(DRAIN_POLL_SECONDS, max(deadline - time.monotonic(), 0)))
+    if len(worker.jobs) > 0:
+        in_flight = list(worker.jobs)
+        logger.info(f"Handing off {len(in_flight)} jobs of {worker.name}")
+        # Jobs finishing from now on are neither completed nor failed, they are handed off
+        worker.forceClosing = True
+        await asyncio.gather(*[handoff_job(job, token) for job, token in in_flight])
+    # Pending fetches are dropped as well, cancelled tasks end the run loop without stopping its timers
+    worker.cancelProcessing()
+    await asyncio.gather(task, *worker.processing, return_exceptions=True)
+    worker.timer.stop()
+    worker.stalledCheckTimer.stop()
+
+
 async def shutdown_workers(runners: Runners):
+    deadline = time.monotonic() + config.worker_drain_grace_seconds
+    await asyncio.gather(*[drain_worker(worker, task, deadline) for (worker, task) in runners])
     for (worker, task) in runners:
         await worker.close()
-        await task
+        _, on_shutdown = lifecycle_hooks[worker.name]
+        if on_shutdown is not None:
+            await on_shutdown()